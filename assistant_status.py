@@ -0,0 +1,190 @@
+"""Mr Assistant's status document: whether each target's Mr Deploy is
+running and when she'll next poll, plus a heartbeat showing Mr Assistant
+herself is alive.
+
+Mr Assistant keeps the document in Redis under DOC_KEY and publishes it on
+CHANNEL whenever it changes and every HEARTBEAT_SECS regardless. The
+document's version goes up with every change (but not with heartbeats), so
+(run_id, version) identifies its contents. Each server worker keeps a copy
+up to date from the channel in a StatusCache, so answering /deploy/status
+costs no Redis round trip. If the heartbeat is more than STALE_SECS old,
+Mr Assistant is taken to be down.
+"""
+
+import json
+import threading
+import time
+import uuid
+
+import redis
+
+import stream_hub
+
+
+DOC_KEY = 'mr_assistant_status'
+CHANNEL = 'mr_assistant_status'
+
+HEARTBEAT_SECS = 1
+STALE_SECS = 5
+
+
+class StatusPublisher(object):
+    """Keeps the status document of Mr Assistant's deploy targets, and
+    publishes it on changes and heartbeats.
+    """
+
+    def __init__(self, red, targets):
+        self.red = red
+        self.targets = targets
+        self.lock = threading.Lock()
+        self.doc = {
+            'run_id': uuid.uuid4().hex,
+            'version': 0,
+            'heartbeat_at': None,
+            'targets': dict((target.name, {'running': False,
+                                           'scheduler': None})
+                            for target in targets),
+        }
+
+    def set_running(self, target_name, running):
+        with self.lock:
+            if self._set(target_name, 'running', running):
+                self._publish()
+
+    def _set(self, target_name, field, value):
+        """Update the document, returning whether it changed."""
+        target_status = self.doc['targets'][target_name]
+        if target_status[field] == value:
+            return False
+        target_status[field] = value
+        self.doc['version'] += 1
+        return True
+
+    def _publish(self, up=True):
+        self.doc['heartbeat_at'] = time.time() if up else 0
+        doc = json.dumps(self.doc)
+        try:
+            pipe = self.red.pipeline(transaction=False)
+            pipe.set(DOC_KEY, doc)
+            pipe.publish(CHANNEL, doc)
+            pipe.execute()
+        except redis.RedisError as e:
+            print "Couldn't publish status: %s" % e
+
+    def _beat(self):
+        """Pick up the Mr Deploys' poll scheduler states, and publish."""
+        try:
+            schedulers = self.red.mget([target.key('mr_deploy_scheduler')
+                                        for target in self.targets])
+        except redis.RedisError as e:
+            print "Couldn't read poll scheduler states: %s" % e
+            schedulers = None
+
+        with self.lock:
+            if schedulers is not None:
+                for target, scheduler in zip(self.targets, schedulers):
+                    self._set(target.name, 'scheduler',
+                              scheduler and json.loads(scheduler))
+            self._publish()
+
+    def run(self):
+        """Publish a heartbeat every HEARTBEAT_SECS. Intended to be run in a
+        separate thread.
+        """
+        while True:
+            self._beat()
+            time.sleep(HEARTBEAT_SECS)
+
+    def publish_down(self):
+        """Say right away that Mr Assistant is going, rather than leaving
+        servers to notice the heartbeat stop.
+        """
+        with self.lock:
+            self.doc['version'] += 1
+            self._publish(up=False)
+
+
+def is_up(doc):
+    """Return whether Mr Assistant's heartbeat in doc is fresh."""
+    return bool(doc and doc['heartbeat_at'] and
+                time.time() - doc['heartbeat_at'] < STALE_SECS)
+
+
+def get_etag(doc):
+    """Return an ETag for what doc says, including whether Mr Assistant is
+    up, which changes with time alone.
+    """
+    if doc is None:
+        return 'none'
+    return '%s.%d.%s' % (doc['run_id'], doc['version'],
+                         'up' if is_up(doc) else 'down')
+
+
+class StatusCache(object):
+    """A server process's copy of the status document, kept up to date over
+    its own hub subscription to CHANNEL. The subscription is opened on
+    first use, so that it belongs to the worker process and not the
+    pre-fork parent.
+    """
+
+    def __init__(self, red):
+        self.red = red
+        self.hub = stream_hub.StreamHub(red, [CHANNEL],
+                                        coalesced_channels=[CHANNEL])
+        self.cond = threading.Condition()
+        self.doc = None
+        self.follower = None
+        self.fetched_at = 0
+
+    def _follow(self, client):
+        while True:
+            _, data = client.get()
+            self._set(json.loads(data))
+
+    def _set(self, doc):
+        with self.cond:
+            changed = get_etag(doc) != get_etag(self.doc)
+            self.doc = doc
+            if changed:
+                self.cond.notify_all()
+
+    def get(self):
+        """Return the latest status document, or None if Mr Assistant has
+        never published one.
+        """
+        with self.cond:
+            if self.follower is None:
+                self.follower = threading.Thread(
+                    target=self._follow, args=(self.hub.subscribe(),))
+                self.follower.daemon = True
+                self.follower.start()
+            doc = self.doc
+
+        # Only go to Redis if we've missed heartbeats (e.g. before the first
+        # one arrives, or while reconnecting), and not often even then
+        if not is_up(doc) and time.time() - self.fetched_at > HEARTBEAT_SECS:
+            self.fetched_at = time.time()
+            stored = self.red.get(DOC_KEY)
+            if stored:
+                stored = json.loads(stored)
+                if doc is None or stored['heartbeat_at'] > doc['heartbeat_at']:
+                    self._set(stored)
+                    doc = stored
+        return doc
+
+    def wait_for_change(self, etag, timeout):
+        """Wait up to timeout seconds for the document's ETag to differ from
+        etag, returning the latest document either way.
+        """
+        deadline = time.time() + timeout
+        doc = self.get()
+        while get_etag(doc) == etag:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            with self.cond:
+                # Wake up now and then to notice the heartbeat going stale
+                if get_etag(self.doc) == etag:
+                    self.cond.wait(min(remaining, HEARTBEAT_SECS))
+            doc = self.get()
+        return doc
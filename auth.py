@@ -8,15 +8,27 @@ Example usage:
     @auth.login_required
     def secret_page():
         pass
+
+    @app.route('/hook-for-robots', methods=['POST'])
+    @auth.hook_token_required
+    def hook_for_robots():
+        pass
 """
 
-import datetime
+import collections
 from functools import wraps
+import hashlib
 import json
 import logging
+import threading
+import time
 import urllib2
+import uuid
 
 import flask
+import redis
+
+import redis_connection
 from third_party.oauth import OAuth
 
 try:
@@ -24,12 +36,14 @@ try:
     GOOGLE_CLIENT_ID = secrets.GOOGLE_CLIENT_ID
     GOOGLE_CLIENT_SECRET = secrets.GOOGLE_CLIENT_SECRET
     SECRET_KEY = secrets.SECRET_KEY
+    DEPLOY_HOOK_TOKEN = getattr(secrets, 'deploy_hook_token', None)
     FAKED_SECRETS = False
 except ImportError:
     logging.critical("Unable to find secrets.py. Cannot force authentication")
     GOOGLE_CLIENT_ID = 'dummy google client id'
     GOOGLE_CLIENT_SECRET = 'dummy google client secret'
     SECRET_KEY = 'dummy secret key'
+    DEPLOY_HOOK_TOKEN = None
     FAKED_SECRETS = True
 
 
@@ -118,37 +132,242 @@ def login_required(func):
     return auth_wrapper
 
 
-# TODO(benkomalo): replace this hacky cache with a real one.
-# access_token -> (email, expiry)
-_TOKEN_CACHE = {}
-_CACHE_EXPIRY = datetime.timedelta(minutes=5)
+def hook_token_required(func):
+    """For endpoints called by other services rather than people, which
+    must pass the shared secret deploy_hook_token as the `token` parameter.
+    """
+    @wraps(func)
+    def hook_auth_wrapper(*args, **kwargs):
+        if FAKED_SECRETS or not auth_required:
+            return func(*args, **kwargs)
+
+        token = flask.request.args.get('token', '')
+        if DEPLOY_HOOK_TOKEN and _constant_time_equals(token,
+                                                       DEPLOY_HOOK_TOKEN):
+            return func(*args, **kwargs)
+        return "Unauthorized. Bad or missing token.", 403
+    return hook_auth_wrapper
+
 
+def _constant_time_equals(a, b):
+    """Compare two strings without leaking where they differ via timing."""
+    if len(a) != len(b):
+        return False
+    diff = 0
+    for x, y in zip(a, b):
+        diff |= ord(x) ^ ord(y)
+    return diff == 0
 
-def _get_verified_user(access_token):
-    if access_token in _TOKEN_CACHE:
-        email, expiry = _TOKEN_CACHE[access_token]
-        if expiry <= datetime.datetime.utcnow():
-            # Expired. Purge from cache
-            del _TOKEN_CACHE[access_token]
-        else:
-            return email
 
+USERINFO_URL = 'https://www.googleapis.com/oauth2/v1/userinfo'
+VERIFY_TIMEOUT_SECS = 10
+
+# Verified tokens are cached in Redis, shared by all server processes, for
+# TOKEN_CACHE_SECS, and tokens Google rejects for INVALID_TOKEN_CACHE_SECS.
+# Each process also keeps up to LOCAL_CACHE_SIZE recently used tokens for up
+# to LOCAL_CACHE_SECS, saving the trip to Redis.
+TOKEN_CACHE_SECS = 5 * 60
+INVALID_TOKEN_CACHE_SECS = 60
+LOCAL_CACHE_SIZE = 1000
+LOCAL_CACHE_SECS = 30
+
+# A process verifying a token holds a lock on it in Redis, so that the
+# others wait for its result instead of verifying it too. Verifying can take
+# VERIFY_TIMEOUT_SECS to connect to Google and as long again for it to
+# respond, so the lock is held for at most twice that.
+VERIFY_LOCK_SECS = 2 * VERIFY_TIMEOUT_SECS
+
+_TOKEN_KEY = 'auth_token:%s'  # % token hash -> email, or '' if invalid
+_LOCK_KEY = 'auth_token_lock:%s'  # % token hash -> holder's lock token
+
+# Take the lock KEYS[1] for holder ARGV[1] for ARGV[2] milliseconds, if it's
+# free. Returns whether it was.
+_ACQUIRE_LOCK_SCRIPT = """
+if redis.call('setnx', KEYS[1], ARGV[1]) == 1 then
+    redis.call('pexpire', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Release the lock KEYS[1] if holder ARGV[1] still holds it, rather than
+# whoever took it after it expired
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+red = redis_connection.connect()
+
+# token hash -> (email or '', expiry time), least recently used first
+_local_cache = collections.OrderedDict()
+# token hash -> _Verification of that token in progress in this process
+_verifications = {}
+_lock = threading.Lock()
+
+
+def verify_with_google(access_token):
+    """Return the email address of the user an access token belongs to if
+    Google has verified it, '' if the token or email isn't valid, or None if
+    we can't tell because Google couldn't be reached.
+    """
     headers = {'Authorization': 'OAuth ' + access_token}
-    req = urllib2.Request('https://www.googleapis.com/oauth2/v1/userinfo',
-                          None,
-                          headers)
+    req = urllib2.Request(USERINFO_URL, None, headers)
     try:
-        res = urllib2.urlopen(req)
-    except urllib2.URLError, e:
+        res = urllib2.urlopen(req, timeout=VERIFY_TIMEOUT_SECS)
+    except urllib2.HTTPError, e:
+        if e.code in (400, 401, 403):
+            return ''
+        logging.error("Google failed to authenticate. [%s]" % e)
+        return None
+    except Exception, e:
         logging.error("Can't reach Google to authenticate. [%s]" % e)
         return None
 
     resp = json.loads(res.read())
-    email = resp.get('email', '')
-    verified = resp.get('verified_email', False)
-    if verified:
-        expiry = datetime.datetime.utcnow() + _CACHE_EXPIRY
-        _TOKEN_CACHE[access_token] = (email, expiry)
-        return email
-    return None
+    if resp.get('verified_email', False):
+        return resp.get('email', '')
+    return ''
+
+
+_verifier = verify_with_google
+
 
+def set_verifier(verifier):
+    """Use the given function, which must behave like verify_with_google(),
+    to verify access tokens. For swapping in a stand-in for Google in tests.
+    """
+    global _verifier
+    _verifier = verifier
+
+
+class _Verification(object):
+    """A token verification in progress, which other requests for the same
+    token wait on instead of verifying it again.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.email = None
+
+
+def _get_verified_user(access_token):
+    """Return the verified email address of the user with the given access
+    token, or None if it isn't valid or can't be verified.
+    """
+    token_hash = hashlib.sha1(access_token).hexdigest()
+    email = _get_cached(token_hash)
+    if email is None:
+        email = _verify_once(token_hash, access_token)
+    return email or None
+
+
+def _get_cached(token_hash):
+    """Return the cached email for a token, '' if it is cached as invalid, or
+    None if it isn't cached.
+    """
+    now = time.time()
+    with _lock:
+        if token_hash in _local_cache:
+            email, expiry = _local_cache.pop(token_hash)
+            if expiry > now:
+                _local_cache[token_hash] = (email, expiry)
+                return email
+
+    try:
+        email = red.get(_TOKEN_KEY % token_hash)
+    except redis.RedisError, e:
+        logging.error("Can't reach Redis for cached tokens. [%s]" % e)
+        return None
+
+    if email is not None:
+        _cache_locally(token_hash, email)
+    return email
+
+
+def _cache_locally(token_hash, email):
+    with _lock:
+        _local_cache.pop(token_hash, None)
+        _local_cache[token_hash] = (email, time.time() + LOCAL_CACHE_SECS)
+        while len(_local_cache) > LOCAL_CACHE_SIZE:
+            _local_cache.popitem(last=False)
+
+
+def _cache(token_hash, email):
+    _cache_locally(token_hash, email)
+    try:
+        red.setex(_TOKEN_KEY % token_hash,
+                  TOKEN_CACHE_SECS if email else INVALID_TOKEN_CACHE_SECS,
+                  email)
+    except redis.RedisError, e:
+        logging.error("Can't reach Redis to cache token. [%s]" % e)
+
+
+def _verify_once(token_hash, access_token):
+    """Verify a token that isn't cached, unless another request in this
+    process is already verifying it, in which case wait for its result.
+    """
+    with _lock:
+        verification = _verifications.get(token_hash)
+        in_progress = verification is not None
+        if not in_progress:
+            verification = _verifications[token_hash] = _Verification()
+
+    if in_progress:
+        # Long enough for it to wait out another process's lock, then verify
+        # the token itself
+        verification.done.wait(2 * VERIFY_LOCK_SECS + 1)
+        return verification.email
+
+    try:
+        verification.email = _verify_across_processes(token_hash,
+                                                      access_token)
+        return verification.email
+    finally:
+        with _lock:
+            del _verifications[token_hash]
+        verification.done.set()
+
+
+def _verify_across_processes(token_hash, access_token):
+    """Verify a token, unless another server process is already verifying
+    it, in which case wait for its result to show up in the cache.
+    """
+    lock_key = _LOCK_KEY % token_hash
+    lock_token = uuid.uuid4().hex
+    locked = False
+    try:
+        try:
+            # The lock is free once its holder has cached the result, or
+            # failed to verify the token or died, so we can try ourselves.
+            # It's held for at most VERIFY_LOCK_SECS, so if we haven't got
+            # it by then something's up with Redis; go ahead anyway.
+            deadline = time.time() + VERIFY_LOCK_SECS + 1
+            while True:
+                locked = red.execute_command(
+                    'EVAL', _ACQUIRE_LOCK_SCRIPT, 1, lock_key, lock_token,
+                    int(VERIFY_LOCK_SECS * 1000))
+                # Checked even once we hold the lock, in case the last
+                # holder released it just before we asked
+                email = _get_cached(token_hash)
+                if email is not None:
+                    return email
+                if locked or time.time() >= deadline:
+                    break
+                time.sleep(0.05)
+        except redis.RedisError, e:
+            logging.error("Can't reach Redis to lock token. [%s]" % e)
+
+        email = _verifier(access_token)
+        if email is not None:
+            _cache(token_hash, email)
+        return email
+    finally:
+        if locked:
+            try:
+                red.execute_command('EVAL', _RELEASE_LOCK_SCRIPT, 1,
+                                    lock_key, lock_token)
+            except redis.RedisError:
+                pass  # It expires anyway
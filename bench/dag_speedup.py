@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""Measures how much running deploy stages concurrently saves, by running
+mr_deploy.deploy_to_staging() against a simulated repository whose stages
+just take a set time each: once with the stages chained one after another
+as they used to be, and once with the declared dependencies.
+
+Also runs a deploy whose dangerous-file check fails, to show which of the
+stages started speculatively ran, and which were cancelled.
+
+Runs in a scratch directory and Redis database, but mr_deploy needs a
+secrets.py to import.
+
+    python bench/dag_speedup.py --install_deps 20 --deploy 30
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import deploy_metrics
+import mr_deploy
+
+
+class SequentialPipeline(mr_deploy.DeployPipeline):
+    """Runs the stages one at a time, in the order they were added."""
+
+    def add(self, name, func, deps=(), timed=True):
+        deps = list(deps)
+        if self.stages:
+            deps.append(next(reversed(self.stages)))
+        super(SequentialPipeline, self).add(name, func, deps, timed)
+
+
+def sleeper(secs, result=None):
+    def sleep(*args, **kwargs):
+        time.sleep(secs)
+        return result
+    return sleep
+
+
+def simulate_repo(repo_dir, options, dangerous):
+    """Replace mr_deploy's repository operations with ones that just take
+    the given times, with install_deps and the deploy script as real
+    commands so that they can be cancelled.
+    """
+    os.makedirs(os.path.join(repo_dir, 'deploy'))
+    with open(os.path.join(repo_dir, 'deploy', 'deploy.py'), 'w') as f:
+        f.write('import time\ntime.sleep(%f)\n' % options.deploy)
+
+    mr_deploy.REPO_DIR = repo_dir
+    mr_deploy.get_incoming_changes = lambda: ['abc Fake Dev: Change']
+    mr_deploy.update_repo = sleeper(options.update_repo)
+    mr_deploy.get_affected_files = sleeper(options.hg_query, set())
+    mr_deploy.check_dangerous_files = lambda *args, **kwargs: dangerous
+    mr_deploy.get_last_changeset_and_author = sleeper(
+        options.hg_query, ('abc', 'Fake Dev'))
+    mr_deploy.get_last_deployed = lambda: None
+    mr_deploy.decrypt_secrets = sleeper(options.decrypt_secrets)
+    mr_deploy.shutil.copy2 = lambda *args: None
+    mr_deploy.install_deps = lambda: mr_deploy.check_call(
+        ['sleep', str(options.install_deps)])
+    mr_deploy.last_version_attempted = None
+
+
+def run_deploy(pipeline_class, options, dangerous=False):
+    work_dir = tempfile.mkdtemp()
+    old_dir = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        simulate_repo(os.path.join(work_dir, 'repo'), options, dangerous)
+        mr_deploy.DeployPipeline = pipeline_class
+
+        start = time.time()
+        try:
+            mr_deploy.deploy_to_staging(notify=False)
+        except SystemExit:
+            pass
+        return time.time() - start
+    finally:
+        os.chdir(old_dir)
+        shutil.rmtree(work_dir)
+
+
+def main():
+    parser = optparse.OptionParser()
+    for stage, secs in [('update_repo', 3), ('hg_query', 0.5),
+                        ('decrypt_secrets', 0.5), ('install_deps', 10),
+                        ('deploy', 15)]:
+        parser.add_option('--%s' % stage, type='float', default=secs,
+            help="Seconds %s takes (default %s)." % (stage, secs))
+    options, _ = parser.parse_args()
+
+    red = mr_deploy.red = redis.StrictRedis(db=15)
+    red.flushdb()
+    mr_deploy.record_history = lambda *args: None
+
+    concurrent_pipeline = mr_deploy.DeployPipeline
+    sequential_secs = run_deploy(SequentialPipeline, options)
+    concurrent_secs = run_deploy(concurrent_pipeline, options)
+    print "Sequential stages:  %.1fs" % sequential_secs
+    print "Concurrent stages:  %.1fs (%.0f%% faster)" % (
+        concurrent_secs, 100 * (1 - concurrent_secs / sequential_secs))
+
+    abort_secs = run_deploy(concurrent_pipeline, options, dangerous=True)
+    _, last = deploy_metrics.get_deploys(red)
+    print "Dangerous changes:  aborted after %.1fs; %s" % (
+        abort_secs, ", ".join("%s %s" % (span['stage'], span['outcome'])
+                              for span in last['spans']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+"""End-to-end benchmark of Mr Deploy, run entirely offline.
+
+Builds a synthetic hg "remote" with --history changesets of history, whose
+deploy/deploy.py is a fake that prints --output_lines lines. Then runs the
+real Mr Assistant (and through her Mr Deploy) and stream server against it
+from a scratch directory, pushes to the remote --pushes times at
+--push_interval seconds apart, and watches the dashboard stream. Reports:
+
+- poll-loop latency: how long Mr Deploy's idle polls take
+- push-to-deploy-start latency: from a push to the fake deploy.py starting
+  on a working copy including it
+- output publish throughput: lines per second reaching the stream
+- SSE delivery latency: from the fake deploy.py printing a line to the
+  stream delivering it
+
+Needs hg and redis-server. It runs its own Redis on --redis_port, which
+it points Mr Deploy at with MR_DEPLOY_REDIS_PORT, so that it neither sees nor
+disturbs the keys and channels of any other Mr Deploy on the box.
+
+    python bench/e2e.py --history 5000 --pushes 5 --output_lines 50000
+"""
+
+import glob
+import optparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import redis
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+import deploy_metrics
+
+sys.path.insert(0, BENCH_DIR)
+import fake_push
+
+
+SECRETS = """
+hipchat_token = 'bench'
+hipchat_room_id = 1
+hipchat_api_url = 'http://localhost:9/v1/rooms/message'
+secrets_decrypt_key = 'bench'
+GOOGLE_CLIENT_ID = 'bench'
+GOOGLE_CLIENT_SECRET = 'bench'
+SECRET_KEY = 'bench'
+deploy_hook_token = 'bench'
+"""
+
+# Prints the push it's deploying, then output_lines lines, every
+# STAMP_EVERY-th of which carries the time it was printed
+FAKE_DEPLOY = """
+import time
+
+STAMP_EVERY = 100
+
+push = open('pushes.txt').read().split('\\n')[-2]
+print 'bench-deploy-start %%s' %% push
+for i in xrange(%(output_lines)d):
+    if i %% STAMP_EVERY:
+        print 'x' * %(line_bytes)d
+    else:
+        print 'bench-line %%d %%f' %% (i, time.time())
+print 'bench-deploy-end %%s' %% push
+"""
+
+FAKE_MAKEFILE = """
+install_deps:
+\t@echo Installing nothing
+"""
+
+# mr_deploy runs `sudo make install_deps`; this just runs make
+FAKE_SUDO = """#!/bin/sh
+exec "$@"
+"""
+
+# mr_deploy decrypts secrets.py.cast5 with openssl; this just copies it
+FAKE_OPENSSL = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -in) in="$2"; shift;;
+        -out) out="$2"; shift;;
+    esac
+    shift
+done
+cat > /dev/null
+cp "$in" "$out"
+"""
+
+
+def hg(repo, *args):
+    subprocess.check_call(["hg"] + list(args), cwd=repo)
+
+
+def build_remote(repo, options):
+    """Create the remote repository: --history changesets each adding a
+    file, then the fake deploy setup, with the master bookmark on top.
+    """
+    print "Building remote with %d changesets of history" % options.history
+    os.makedirs(repo)
+    hg(repo, "init")
+    if options.history:
+        hg(repo, "debugbuilddag", "--new-file", "+%d" % options.history)
+        hg(repo, "update", "-q", "tip")
+
+    os.makedirs(os.path.join(repo, 'deploy'))
+    with open(os.path.join(repo, 'deploy', 'deploy.py'), 'w') as f:
+        f.write(FAKE_DEPLOY % vars(options))
+    with open(os.path.join(repo, 'Makefile'), 'w') as f:
+        f.write(FAKE_MAKEFILE)
+    with open(os.path.join(repo, 'pushes.txt'), 'w') as f:
+        f.write('initial\n')
+    with open(os.path.join(repo, 'secrets.py.cast5'), 'w') as f:
+        f.write('')
+
+    hg(repo, "add", "-q")
+    hg(repo, "commit", "-q", "-u", "Fake Dev", "-m", "Fake deploy setup")
+    hg(repo, "bookmark", "master")
+
+
+def build_work_dir(work_dir):
+    """Copy Mr Deploy into work_dir, with fake secrets, sudo and openssl.
+    Returns the directory of the fake commands, for the front of PATH.
+    """
+    for path in glob.glob(os.path.join(ROOT_DIR, '*.py')):
+        shutil.copy(path, work_dir)
+    for name in ('templates', 'static', 'third_party'):
+        shutil.copytree(os.path.join(ROOT_DIR, name),
+                        os.path.join(work_dir, name))
+
+    with open(os.path.join(work_dir, 'secrets.py'), 'w') as f:
+        f.write(SECRETS)
+    with open(os.path.join(work_dir, 'secrets_dev.py'), 'w') as f:
+        f.write('')
+
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    for name, script in [('sudo', FAKE_SUDO), ('openssl', FAKE_OPENSSL)]:
+        with open(os.path.join(bin_dir, name), 'w') as f:
+            f.write(script)
+        os.chmod(os.path.join(bin_dir, name), 0755)
+    return bin_dir
+
+
+def start_redis(port):
+    """Start a redis-server of our own on port, returning the process."""
+    red = redis.StrictRedis(port=port)
+    try:
+        red.ping()
+    except redis.ConnectionError:
+        pass
+    else:
+        raise Exception("Something's already listening on port %d; pass "
+                        "another --redis_port" % port)
+
+    print "Starting redis-server on port %d" % port
+    proc = subprocess.Popen(["redis-server", "--port", str(port),
+                             "--save", ""],
+                            stdout=open(os.devnull, 'w'))
+    for _ in xrange(50):
+        time.sleep(0.1)
+        try:
+            red.ping()
+            return proc
+        except redis.ConnectionError:
+            pass
+    proc.terminate()
+    raise Exception("redis-server didn't start on port %d" % port)
+
+
+class StreamWatcher(object):
+    """Reads the dashboard stream, noting when deploys start and end and
+    how late stamped lines arrive.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.connected = threading.Event()
+        self.lock = threading.Lock()
+        self.deploy_starts = []  # (time, push)
+        self.deploy_ends = []  # (time, push)
+        self.num_lines = 0
+        self.latencies = []
+
+        thread = threading.Thread(target=self._watch)
+        thread.daemon = True
+        thread.start()
+
+    def _watch(self):
+        while True:
+            try:
+                sock = socket.create_connection(('localhost', self.port))
+                break
+            except socket.error:
+                time.sleep(0.2)
+
+        sock.sendall('GET /deploy/stream HTTP/1.1\r\nHost: localhost\r\n'
+                     'Accept: text/event-stream\r\n\r\n')
+        self.connected.set()
+        for line in sock.makefile('rb'):
+            if line.startswith('data: '):
+                self._handle(time.time(), line[len('data: '):].rstrip('\n'))
+
+    def _handle(self, now, line):
+        with self.lock:
+            self.num_lines += 1
+            if line.startswith('bench-line '):
+                self.latencies.append(now - float(line.split()[2]))
+            elif line.startswith('bench-deploy-start '):
+                self.deploy_starts.append((now, line.split(' ', 1)[1]))
+            elif line.startswith('bench-deploy-end '):
+                self.deploy_ends.append((now, line.split(' ', 1)[1]))
+
+    def wait_for_deploy_end(self, push, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if any(p == push for _, p in self.deploy_ends):
+                    return True
+            time.sleep(0.1)
+        return False
+
+
+def push_number(push):
+    """Order pushes by their number, with the initial commit first."""
+    return -1 if push == 'initial' else int(push.split()[-1])
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return "n/a"
+    def percentile(fraction):
+        return values[int(round(fraction * (len(values) - 1)))]
+    return "p50 %.3fs, p95 %.3fs, max %.3fs (n=%d)" % (
+        percentile(0.5), percentile(0.95), values[-1], len(values))
+
+
+def report(watcher, pushes, poll_secs, output_lines):
+    print
+    print "Poll-loop latency:            %s" % percentiles(poll_secs)
+
+    # Each push is deployed by the first deploy to start after it
+    push_latencies = []
+    for pushed_at, push in pushes:
+        starts = [t for t, p in watcher.deploy_starts
+                  if t > pushed_at and push_number(p) >= push_number(push)]
+        if starts:
+            push_latencies.append(min(starts) - pushed_at)
+    print "Push-to-deploy-start latency: %s" % percentiles(push_latencies)
+
+    # Lines per second from each deploy's start to its end on the stream
+    rates = []
+    for (start, push), (end, _) in zip(watcher.deploy_starts,
+                                       watcher.deploy_ends):
+        if end > start:
+            rates.append(output_lines / (end - start))
+    if rates:
+        print ("Output publish throughput:    %d lines/s (mean of %d "
+               "deploys)" % (sum(rates) / len(rates), len(rates)))
+    print "SSE delivery latency:         %s" % percentiles(watcher.latencies)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--history', type='int', default=1000,
+        help="Changesets of history in the remote.")
+    parser.add_option('--pushes', type='int', default=3,
+        help="Number of pushes to make.")
+    parser.add_option('--push_interval', type='float', default=30,
+        help="Seconds between pushes.")
+    parser.add_option('--output_lines', type='int', default=20000,
+        help="Lines printed by the fake deploy.py.")
+    parser.add_option('--line_bytes', type='int', default=80,
+        help="Length of the lines printed by the fake deploy.py.")
+    parser.add_option('--port', type='int', default=5099,
+        help="Port to run the stream server on.")
+    parser.add_option('--redis_port', type='int', default=6399,
+        help="Port to run the benchmark's own redis-server on.")
+    parser.add_option('--deploy_timeout', type='float', default=300,
+        help="Seconds to wait for a deploy to finish.")
+    parser.add_option('--keep', action='store_true', default=False,
+        help="Keep the scratch directory (for looking at logs).")
+    options, _ = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='mr_deploy_bench.')
+    remote = os.path.join(scratch, 'remote')
+    work_dir = os.path.join(scratch, 'work')
+    os.makedirs(work_dir)
+    procs = []
+
+    red = redis.StrictRedis(port=options.redis_port)
+    try:
+        procs.append(start_redis(options.redis_port))
+        build_remote(remote, options)
+        bin_dir = build_work_dir(work_dir)
+        env = dict(os.environ,
+                   PATH=bin_dir + os.pathsep + os.environ['PATH'],
+                   PYTHONUNBUFFERED='1',
+                   MR_DEPLOY_REDIS_PORT=str(options.redis_port),
+                   FLASK_CONFIG=os.path.join(work_dir,
+                                             'flask_debug_config.py'))
+        output = open(os.path.join(scratch, 'processes.log'), 'w')
+
+        procs.append(subprocess.Popen(
+            ["python", "stream_server.py",
+                "--bind", "localhost:%d" % options.port],
+            cwd=work_dir, env=env, stdout=output, stderr=output))
+        watcher = StreamWatcher(options.port)
+        watcher.connected.wait(30)
+
+        print "Starting Mr Assistant"
+        procs.append(subprocess.Popen(
+            ["python", "mr_assistant.py", "--no_notify",
+                "--clone_url", remote,
+                "--repo_dir", os.path.join(scratch, 'webapp')],
+            cwd=work_dir, env=env, stdout=output, stderr=output))
+
+        # Mr Deploy deploys once when she first starts
+        if not watcher.wait_for_deploy_end('initial', options.deploy_timeout):
+            print "Initial deploy didn't finish; see %s" % scratch
+            options.keep = True
+            return 1
+
+        pushes = []
+        for i in xrange(options.pushes):
+            time.sleep(options.push_interval)
+            push = 'bench push %d' % i
+            fake_push.commit(remote, push)
+            pushes.append((time.time(), push))
+            red.publish(fake_push.TRIGGER_CHANNEL, 'push')
+            print "Pushed %s" % push
+
+        if pushes and not watcher.wait_for_deploy_end(
+                pushes[-1][1], options.deploy_timeout):
+            print "Last push wasn't deployed in time; see %s" % scratch
+            options.keep = True
+
+        # Our Redis is empty but for this run, so these are all our polls,
+        # or the last MAX_SAMPLES of them
+        poll_key = deploy_metrics.SAMPLES_KEY % (deploy_metrics.TIMING,
+                                                 'poll', 'skipped')
+        poll_secs = [float(s) for s in red.lrange(poll_key, 0, -1)]
+        report(watcher, pushes, poll_secs, options.output_lines)
+        return 0
+
+    finally:
+        for proc in reversed(procs):
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+        if options.keep:
+            print "Scratch directory kept at %s" % scratch
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
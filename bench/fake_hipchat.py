@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""A fake HipChat, for trying out Mr Deploy's notification queue without
+spamming a real room. Accepts v1 rooms/message calls, printing each
+message, and can be made slow or flaky.
+
+Point Mr Assistant at it by setting hipchat_api_url in secrets.py:
+
+    python bench/fake_hipchat.py --port 5001 --fail_rate 0.3
+
+Or, with --bench, run notifications.NotificationWorker against it using a
+scratch Redis database, queue bursts of notifications and report how they
+were coalesced and how long they took to arrive. Needs a local
+redis-server.
+
+    python bench/fake_hipchat.py --bench --bursts 5 --burst_size 10
+"""
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import deploy_metrics
+import notifications
+
+
+class FakeHipChat(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, fail_rate, latency_secs, quiet):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', port),
+                                           FakeHipChatHandler)
+        self.fail_rate = fail_rate
+        self.latency_secs = latency_secs
+        self.quiet = quiet
+        self.messages = []
+        self.failures = 0
+
+
+class FakeHipChatHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        time.sleep(server.latency_secs)
+
+        if random.random() < server.fail_rate:
+            server.failures += 1
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        length = int(self.headers.getheader('content-length', 0))
+        form = cgi.parse_qs(self.rfile.read(length))
+        message = dict((key, values[0]) for key, values in form.iteritems())
+        server.messages.append(message)
+        if not server.quiet:
+            print "[room %s, %s] %s" % (message.get('room_id'),
+                                        message.get('color'),
+                                        message.get('message'))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write('{"status": "sent"}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench(server, options):
+    red = redis.StrictRedis(db=15)
+    red.delete(notifications.QUEUE_KEY, notifications.PROCESSING_KEY,
+               deploy_metrics.SAMPLES_KEY % (deploy_metrics.TIMING,
+                                             notifications.METRICS_TIMING,
+                                             'delivered'))
+
+    notifications.HIPCHAT_API_URL = ('http://localhost:%d/v1/rooms/message'
+                                     % options.port)
+    worker = threading.Thread(
+        target=notifications.NotificationWorker(red).run)
+    worker.daemon = True
+    worker.start()
+
+    total = options.bursts * options.burst_size
+    for burst in xrange(options.bursts):
+        if burst:
+            time.sleep(options.burst_interval)
+        for i in xrange(options.burst_size):
+            notifications.enqueue(red, 1 + i % options.rooms,
+                                  random.choice(notifications.COLORS),
+                                  "Burst %d message %d" % (burst, i))
+
+    samples_key = deploy_metrics.SAMPLES_KEY % (deploy_metrics.TIMING,
+                                                notifications.METRICS_TIMING,
+                                                'delivered')
+    while red.llen(samples_key) < total:
+        time.sleep(0.1)
+
+    latencies = sorted(float(s) for s in red.lrange(samples_key, 0, -1))
+    print "Notifications queued:  %d" % total
+    print "HipChat posts made:    %d (%d failed and were retried)" % (
+        len(server.messages), server.failures)
+    print "Delivery latency:      p50 %.2fs, p95 %.2fs, max %.2fs" % (
+        latencies[len(latencies) // 2],
+        latencies[int(0.95 * (len(latencies) - 1))],
+        latencies[-1])
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type='int', default=5001,
+        help="Port to listen on.")
+    parser.add_option('--fail_rate', type='float', default=0.0,
+        help="Fraction of calls to fail with a 503.")
+    parser.add_option('--latency', type='float', default=0.0,
+        help="Seconds to take over each call.")
+    parser.add_option('--bench', action='store_true', default=False,
+        help="Queue notifications and report on their delivery.")
+    parser.add_option('--bursts', type='int', default=5,
+        help="Number of bursts of notifications to queue.")
+    parser.add_option('--burst_size', type='int', default=10,
+        help="Notifications per burst.")
+    parser.add_option('--burst_interval', type='float', default=5.0,
+        help="Seconds between bursts.")
+    parser.add_option('--rooms', type='int', default=2,
+        help="Number of rooms the notifications are spread over.")
+    options, _ = parser.parse_args()
+
+    server = FakeHipChat(options.port, options.fail_rate, options.latency,
+                         quiet=options.bench)
+    if not options.bench:
+        print "Fake HipChat listening on port %d" % options.port
+        server.serve_forever()
+        return
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    bench(server, options)
+
+
+if __name__ == '__main__':
+    main()
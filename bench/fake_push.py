@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""Pretends to be developers pushing to the website repository, for trying
+out Mr Deploy against a local repository instead of Kiln.
+
+Commits to a local hg repository (creating it if needed) and then announces
+the push the way the real webhook would: by POSTing to /deploy/hook, or, if
+no --hook_url is given, by publishing straight to Mr Deploy's trigger
+channel in Redis.
+
+    python bench/fake_push.py --repo /tmp/fake_webapp --pushes 3
+    python mr_deploy.py --clone_url /tmp/fake_webapp --repo_dir /tmp/wc -n
+"""
+
+import optparse
+import os
+import subprocess
+import time
+import urllib
+import urllib2
+
+import redis
+
+
+TRIGGER_CHANNEL = 'mr_deploy_triggers'
+
+
+def ensure_repo(repo):
+    if os.path.isdir(os.path.join(repo, '.hg')):
+        return
+
+    subprocess.check_call(["hg", "init", repo])
+    with open(os.path.join(repo, 'pushes.txt'), 'w') as f:
+        f.write('')
+    subprocess.check_call(["hg", "add", "pushes.txt"], cwd=repo)
+    subprocess.check_call(["hg", "commit", "-q", "-u", "Fake Dev",
+                           "-m", "Initial commit"], cwd=repo)
+    subprocess.check_call(["hg", "bookmark", "master"], cwd=repo)
+
+
+def commit(repo, message, files=('pushes.txt',)):
+    for filename in files:
+        path = os.path.join(repo, filename)
+        with open(path, 'a') as f:
+            f.write('%s\n' % message)
+        subprocess.check_call(["hg", "add", "-q", path], cwd=repo)
+    subprocess.check_call(["hg", "commit", "-q", "-u", "Fake Dev",
+                           "-m", message], cwd=repo)
+
+
+def announce_push(hook_url, token):
+    if hook_url:
+        url = '%s?%s' % (hook_url, urllib.urlencode({'token': token}))
+        urllib2.urlopen(urllib2.Request(url, data=''))
+    else:
+        redis.StrictRedis().publish(TRIGGER_CHANNEL, 'push')
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--repo', default='/tmp/fake_webapp',
+        help="Local repository to push to (created if missing).")
+    parser.add_option('--pushes', type='int', default=1,
+        help="Number of pushes to make.")
+    parser.add_option('--interval', type='float', default=1.0,
+        help="Seconds between pushes.")
+    parser.add_option('--hook_url',
+        help="URL of /deploy/hook to call; publish to Redis if not given.")
+    parser.add_option('--token', default='',
+        help="deploy_hook_token to pass to --hook_url.")
+    options, _ = parser.parse_args()
+
+    ensure_repo(options.repo)
+    for i in xrange(options.pushes):
+        if i:
+            time.sleep(options.interval)
+        message = "Fake push %d at %s" % (i, time.ctime())
+        commit(options.repo, message)
+        announce_push(options.hook_url, options.token)
+        print message
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""Benchmarks the hg queries Mr Deploy makes on each poll with no incoming
+changes: run as separate hg processes (the old way), through one long-lived
+hg command server, and through the command server probing the remote head
+instead of running `hg incoming`'s discovery.
+
+Builds a throwaway "remote" repository with --history changesets, served
+over HTTP by `hg serve` so that each round trip to it is real, and a clone
+of it, then reports the wall time and CPU time (ours plus hg's, but not the
+remote's) and the number of HTTP requests to the remote per poll. Over
+loopback round trips are nearly free, but to a real remote each costs
+network latency.
+
+    python bench/hg_poll.py --polls 50 --history 2000
+"""
+
+import optparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import hg_cmdserver
+
+
+# The queries made by each poll when there are no incoming changes
+POLL_QUERIES = [
+    ["incoming"],
+    ["log", "-r", "master", "--template", "{node|short}"],
+    ["log", "-r", "master", "--template", "{author|person}"],
+]
+
+COMBINED_POLL_QUERIES = [
+    ["incoming"],
+    ["log", "-r", "master", "--template", "{node|short}\n{author|person}"],
+]
+
+# The remote head is the same as last time, so there's no discovery
+PROBE_POLL_QUERIES = [
+    ["identify", "--debug", "--id", "-r", "master", "default"],
+    ["log", "-r", "master", "--template", "{node}\n"],
+]
+
+
+def make_repos(root, history):
+    remote = os.path.join(root, 'remote')
+    subprocess.check_call(["hg", "init", remote])
+    with open(os.path.join(remote, 'file.txt'), 'w') as f:
+        f.write('0\n')
+    subprocess.check_call(["hg", "add", "file.txt"], cwd=remote)
+    for i in xrange(history):
+        with open(os.path.join(remote, 'file.txt'), 'a') as f:
+            f.write('%d\n' % i)
+        subprocess.check_call(["hg", "commit", "-q", "-u", "bench",
+                               "-m", "change %d" % i], cwd=remote)
+    subprocess.check_call(["hg", "bookmark", "master"], cwd=remote)
+
+    # Serve the remote, and have the clone use it from there
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    server = subprocess.Popen(["hg", "serve", "-R", remote, "-a", "localhost",
+                               "-p", str(port),
+                               "-A", os.path.join(root, 'access.log')],
+                              stdout=open(os.devnull, 'w'),
+                              stderr=subprocess.STDOUT)
+    url = 'http://localhost:%d/' % port
+    devnull = open(os.devnull, 'w')
+    while subprocess.call(["hg", "identify", url],
+                          stdout=devnull, stderr=devnull):
+        time.sleep(0.1)
+
+    clone = os.path.join(root, 'clone')
+    subprocess.check_call(["hg", "clone", "-q", url, clone])
+    return clone, server
+
+
+def count_requests(root):
+    """Return the number of requests the remote has served so far."""
+    with open(os.path.join(root, 'access.log')) as f:
+        return sum(1 for _ in f)
+
+
+def proc_cpu_secs(pid):
+    """CPU time used so far by the given live process, from /proc."""
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(
+        os.sysconf('SC_CLK_TCK'))
+
+
+def self_and_children_cpu_secs():
+    times = os.times()
+    return sum(times[:4])
+
+
+def bench_subprocess(repo, polls):
+    devnull = open(os.devnull, 'w')
+    cpu_start = self_and_children_cpu_secs()
+    start = time.time()
+    for _ in xrange(polls):
+        for args in POLL_QUERIES:
+            subprocess.call(["hg"] + args, cwd=repo, stdout=devnull)
+    return time.time() - start, self_and_children_cpu_secs() - cpu_start
+
+
+def bench_cmdserver(repo, polls, queries=COMBINED_POLL_QUERIES):
+    hg = hg_cmdserver.HgCommandServer(repo)
+    hg.run(["root"])  # Start the server outside of the timing
+    server_cpu_start = proc_cpu_secs(hg.proc.pid)
+    cpu_start = self_and_children_cpu_secs()
+
+    start = time.time()
+    for _ in xrange(polls):
+        for args in queries:
+            hg.run(args)
+    elapsed = time.time() - start
+
+    cpu = (self_and_children_cpu_secs() - cpu_start +
+           proc_cpu_secs(hg.proc.pid) - server_cpu_start)
+    hg.close()
+    return elapsed, cpu
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--polls', type='int', default=20,
+        help="Number of polls to time.")
+    parser.add_option('--history', type='int', default=500,
+        help="Number of changesets in the synthetic repository.")
+    options, _ = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='hg_poll_bench')
+    server = None
+    try:
+        repo, server = make_repos(root, options.history)
+        for name, bench in [
+                ('subprocess', bench_subprocess),
+                ('cmdserver', bench_cmdserver),
+                ('probe', lambda repo, polls: bench_cmdserver(
+                    repo, polls, PROBE_POLL_QUERIES))]:
+            requests_before = count_requests(root)
+            elapsed, cpu = bench(repo, options.polls)
+            requests = count_requests(root) - requests_before
+            print ("%-10s %7.1fms wall  %7.1fms cpu  %4.1f requests  "
+                   "per poll" % (
+                       name, 1000 * elapsed / options.polls,
+                       1000 * cpu / options.polls,
+                       float(requests) / options.polls))
+    finally:
+        if server:
+            server.terminate()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
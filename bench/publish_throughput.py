@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""Benchmarks how fast Mr Assistant can publish Mr Deploy's output to Redis,
+using a synthetic child process that prints lines as fast as it can.
+
+Compares the old approach (read a line, publish it, repeat) with
+mr_assistant.read_line_batches() feeding output_ring.append(). Needs a local
+redis-server; uses a scratch database so real deploy output is untouched.
+
+    python bench/publish_throughput.py --lines 200000
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import mr_assistant
+import output_ring
+
+
+CHANNEL = 'bench_output'
+
+CHILD_SCRIPT = """
+import sys
+num_lines, line_bytes = int(sys.argv[1]), int(sys.argv[2])
+line = 'x' * (line_bytes - 1) + '\\n'
+for _ in xrange(num_lines):
+    sys.stdout.write(line)
+"""
+
+
+def spawn_child(num_lines, line_bytes):
+    return subprocess.Popen(
+        [sys.executable, '-u', '-c', CHILD_SCRIPT,
+            str(num_lines), str(line_bytes)],
+        stdout=subprocess.PIPE,
+    )
+
+
+def publish_per_line(red, proc):
+    num_lines = 0
+    for line in iter(proc.stdout.readline, ''):
+        red.publish(CHANNEL, line)
+        num_lines += 1
+    return num_lines
+
+
+def publish_batched(red, proc):
+    num_lines = 0
+    for lines in mr_assistant.read_line_batches(proc.stdout.fileno()):
+        output_ring.append(red, CHANNEL, lines)
+        num_lines += len(lines)
+    return num_lines
+
+
+def run(name, publish, red, options):
+    red.flushdb()
+    proc = spawn_child(options.lines, options.line_bytes)
+
+    start = time.time()
+    num_lines = publish(red, proc)
+    elapsed = time.time() - start
+    proc.wait()
+
+    print "%-10s %8d lines in %6.2fs  %10.0f lines/s" % (
+        name, num_lines, elapsed, num_lines / elapsed)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--lines', type='int', default=100000,
+        help="Number of lines the child prints.")
+    parser.add_option('--line_bytes', type='int', default=80,
+        help="Length of each line, including the newline.")
+    parser.add_option('--db', type='int', default=15,
+        help="Scratch Redis database to publish through (it is flushed!).")
+    options, _ = parser.parse_args()
+
+    red = redis.StrictRedis(db=options.db)
+    run('per-line', publish_per_line, red, options)
+    run('batched', publish_batched, red, options)
+    red.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""Load tests the dashboard's /deploy/stream: opens many SSE connections,
+reports how much memory the server needed per connection, then publishes
+output lines through Redis and reports how long they took to fan out to
+every client.
+
+Run it against each setup in turn, passing the pid of the server process
+(for gunicorn, the master; its workers are counted too). The server must
+not require login, i.e. run with flask_debug_config.py. The test lines go
+to the real output channel, so don't point this at production.
+
+    FLASK_CONFIG=flask_debug_config.py python stream_server.py &
+    python bench/sse_load.py --url http://localhost:5002/deploy/stream \\
+        --pid $! --clients 2000
+
+    FLASK_CONFIG=flask_debug_config.py gunicorn --worker-class=gevent \\
+        -w 24 -b localhost:5000 server:app &
+    python bench/sse_load.py --url http://localhost:5000/deploy/stream \\
+        --pid $! --clients 2000
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import optparse
+import os
+import socket
+import sys
+import time
+import urlparse
+
+import gevent
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import output_ring
+
+
+OUTPUT_CHANNEL = 'mr_deploy_output'
+
+
+def get_process_tree(pid):
+    """Return pid and the pids of all its descendants."""
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                # The command name may contain spaces, but is in parentheses
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+
+    pids, pending = [], [pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(children.get(pid, []))
+    return pids
+
+
+def get_rss_kb(pid):
+    """Return the resident memory of pid and its descendants, in KB."""
+    total = 0
+    for tree_pid in get_process_tree(pid):
+        try:
+            with open('/proc/%d/status' % tree_pid) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except IOError:
+            pass  # Exited
+    return total
+
+
+class Client(object):
+    """One SSE connection, recording when each test line arrives."""
+
+    def __init__(self, url):
+        self.url = urlparse.urlparse(url)
+        self.connected = False
+        self.latencies = {}
+
+    def run(self):
+        sock = socket.create_connection((self.url.hostname,
+                                         self.url.port or 80))
+        sock.sendall('GET %s HTTP/1.1\r\nHost: %s\r\n'
+                     'Accept: text/event-stream\r\n\r\n'
+                     % (self.url.path or '/', self.url.netloc))
+        f = sock.makefile('rb')
+        for line in f:
+            if line == '\r\n':
+                self.connected = True  # End of headers
+            elif line.startswith('data: sse_load '):
+                _, _, number, sent_at = line.split()
+                self.latencies[int(number)] = time.time() - float(sent_at)
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--url', default='http://localhost:5002/deploy/stream',
+        help="URL of the stream to load.")
+    parser.add_option('--pid', type='int',
+        help="Pid of the server, to measure its memory.")
+    parser.add_option('--clients', type='int', default=1000,
+        help="Number of connections to open.")
+    parser.add_option('--messages', type='int', default=50,
+        help="Number of lines to publish once connected.")
+    parser.add_option('--interval', type='float', default=0.1,
+        help="Seconds between published lines.")
+    options, _ = parser.parse_args()
+
+    red = redis.StrictRedis()
+
+    rss_before = options.pid and get_rss_kb(options.pid)
+
+    start = time.time()
+    clients = [Client(options.url) for _ in xrange(options.clients)]
+    greenlets = [gevent.spawn(client.run) for client in clients]
+    while not all(c.connected or g.ready()
+                  for c, g in zip(clients, greenlets)):
+        gevent.sleep(0.1)
+    connected = sum(1 for c in clients if c.connected)
+    print "Connected %d of %d clients in %.1fs" % (
+        connected, options.clients, time.time() - start)
+    if not connected:
+        return
+
+    gevent.sleep(1)  # Let the server settle
+    if options.pid:
+        rss_after = get_rss_kb(options.pid)
+        print "Server memory: %d KB before, %d KB after, %.1f KB/connection" % (
+            rss_before, rss_after,
+            float(rss_after - rss_before) / connected)
+
+    for number in xrange(options.messages):
+        output_ring.append(red, OUTPUT_CHANNEL,
+                           ['sse_load %d %f' % (number, time.time())])
+        gevent.sleep(options.interval)
+    gevent.sleep(2)  # Stragglers
+
+    latencies = sorted(latency for client in clients
+                       for latency in client.latencies.itervalues())
+    expected = connected * options.messages
+    print "Delivered %d of %d lines" % (len(latencies), expected)
+    if latencies:
+        print "Fan-out latency: p50 %.1fms, p95 %.1fms, max %.1fms" % (
+            1000 * percentile(latencies, 0.5),
+            1000 * percentile(latencies, 0.95),
+            1000 * latencies[-1])
+
+    gevent.killall(greenlets)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""Replays a recorded deploy log through the dashboard stream's event
+formatting, to compare sending a line per event with coalescing lines into
+frames and gzipping the stream.
+
+Reports the events and bytes each way sends and the server CPU time taken.
+Every event is a DOM write in the dashboard, so fewer events means less
+work in the browser too. Doesn't need Redis.
+
+    python bench/sse_replay.py --log log/mr_deploy/000000.log
+"""
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('FLASK_CONFIG', os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..', 'flask_debug_config.py')))
+import output_ring
+import server
+import stream_hub
+
+
+def synthetic_log(num_lines):
+    return ['Compiling templates/page_%d.html ... done in %dms\n' % (i, i % 97)
+            for i in xrange(num_lines)]
+
+
+def until_event_id(events, last_id):
+    """Pass events through up to the one with id last_id."""
+    last_id_line = 'id: %d\n' % last_id
+    for event in events:
+        yield event
+        if event.startswith(last_id_line):
+            return
+
+
+def replay(lines, frame_max_lines, gzip):
+    """Stream lines to a client and return (events, bytes, cpu secs)."""
+    client = stream_hub.ClientQueue(len(lines))
+    for i, line in enumerate(lines):
+        client.put('mr_deploy_output', output_ring.encode(i + 1, line))
+
+    server.FRAME_MAX_LINES = frame_max_lines
+
+    start = time.clock()
+    num_events = num_bytes = 0
+    chunks = until_event_id(server.client_events(client), len(lines))
+    if gzip:
+        chunks = server.gzip_stream(chunks)
+    for chunk in chunks:
+        num_events += 1
+        num_bytes += len(chunk)
+    return num_events, num_bytes, time.clock() - start
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--log',
+        help="Log file to replay; synthetic lines are used if not given.")
+    parser.add_option('--lines', type='int', default=200000,
+        help="Number of synthetic lines to replay.")
+    options, _ = parser.parse_args()
+
+    if options.log:
+        with open(options.log) as f:
+            lines = f.readlines()
+    else:
+        lines = synthetic_log(options.lines)
+    print "Replaying %d lines (%d bytes)" % (len(lines),
+                                             sum(len(l) for l in lines))
+
+    frame_max_lines = server.FRAME_MAX_LINES
+    for name, max_lines, gzip in [
+            ("Event per line", 1, False),
+            ("Coalesced frames", frame_max_lines, False),
+            ("Coalesced + gzip", frame_max_lines, True)]:
+        num_events, num_bytes, cpu_secs = replay(lines, max_lines, gzip)
+        print "%-18s %8d events %12d bytes %8.2fs CPU" % (
+            name, num_events, num_bytes, cpu_secs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""A content-addressed cache of the outputs of Mr Deploy's builds, such as
+compressed JavaScript, so that a deploy can reuse those of earlier deploys
+whose inputs haven't changed.
+
+The outputs to cache, and the inputs each is built from, are configured in
+CONFIG_PATH (see build_cache.json.example). Without it nothing is cached.
+
+Each output is cached under a hash of the files tracked under its inputs at
+the changeset deployed, as listed by `hg manifest --debug`, so its key
+depends only on what's committed and never on what a build left lying
+around in the working copy. A file's node hashes its history as well as its
+contents, so a change that's later backed out still misses; that loses a
+hit but never restores a wrong output.
+
+Entries are kept in CACHE_DIR, shared by the Mr Deploys of all targets,
+with an SQLite index of their sizes and when each was last used. Whenever
+the cache grows past its budget, the least recently used entries are
+evicted.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+
+CONFIG_PATH = 'build_cache.json'
+
+CACHE_DIR = 'build_cache'
+
+DEFAULT_MAX_MB = 2048
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_by_last_used ON entries (last_used);
+"""
+
+
+class BuildOutput(object):
+    def __init__(self, path, inputs):
+        """path - The output, a file or directory relative to the root of
+            the working copy. It mustn't be tracked by hg.
+        inputs - The tracked files and directories it's built from,
+            including whatever builds it.
+        """
+        self.path = str(path).strip('/')
+        self.inputs = [str(input).strip('/') for input in inputs]
+
+    def _is_input(self, filename):
+        return any(filename == input or filename.startswith(input + '/')
+                   for input in self.inputs)
+
+    def get_key(self, manifest):
+        """Return this output's key, given the manifest of the changeset
+        being deployed as returned by parse_manifest().
+        """
+        key = hashlib.sha1(self.path)
+        for filename, node, flags in manifest:
+            if self._is_input(filename):
+                key.update('\0%s\0%s\0%s' % (filename, node, flags))
+        return key.hexdigest()
+
+
+def load(config_path=CONFIG_PATH):
+    """Return (outputs, max_bytes): the list of configured BuildOutputs,
+    empty if there's no config, and the cache's budget.
+    """
+    if not os.path.isfile(config_path):
+        return [], DEFAULT_MAX_MB << 20
+
+    with open(config_path) as f:
+        config = json.load(f)
+    outputs = [BuildOutput(**output) for output in config['outputs']]
+    return outputs, config.get('max_mb', DEFAULT_MAX_MB) << 20
+
+
+def parse_manifest(output):
+    """Parse the output of `hg manifest --debug` into a list of (filename,
+    node, flags) for each tracked file, flags being the mode and whether
+    it's executable (*) or a symlink (@).
+    """
+    manifest = []
+    for line in output.splitlines():
+        # e.g. "<40 hex digits> 755 * deploy/deploy.py"
+        manifest.append((line[47:], line[:40], line[41:46]))
+    return manifest
+
+
+def _get_size(path):
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size
+
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_size
+    return size
+
+
+def _copy(src, dest):
+    if os.path.isdir(src) and not os.path.islink(src):
+        shutil.copytree(src, dest, symlinks=True)
+    elif os.path.islink(src):
+        os.symlink(os.readlink(src), dest)
+    else:
+        shutil.copy2(src, dest)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+class BuildCache(object):
+    """The build outputs in cache_dir, keeping to max_bytes."""
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=DEFAULT_MAX_MB << 20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _connect(self):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        conn = sqlite3.connect(os.path.join(self.cache_dir, 'index.db'),
+                               timeout=10)
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self, key, dest):
+        """Replace dest with the output cached under key, returning whether
+        there was one. If there wasn't, dest is removed, so that an output
+        built from other inputs is never taken for this one.
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                found = conn.execute(
+                    "UPDATE entries SET last_used = ? WHERE key = ?",
+                    (time.time(), key)).rowcount
+        finally:
+            conn.close()
+
+        # Copied aside then renamed, so dest is never half restored. The
+        # entry may be evicted while we copy, which we take as a miss.
+        restoring = '%s.restoring' % dest
+        _remove(restoring)
+        if found:
+            try:
+                _copy(self._entry_path(key), restoring)
+            except (IOError, OSError, shutil.Error):
+                _remove(restoring)
+                found = False
+
+        _remove(dest)
+        if not found:
+            return False
+        os.rename(restoring, dest)
+        return True
+
+    def store(self, key, src):
+        """Cache a copy of the output src under key, then evict the least
+        recently used entries until the cache is within budget. Returns
+        whether it was cached, which it isn't if it's bigger than the
+        whole budget.
+        """
+        size = _get_size(src)
+        if size > self.max_bytes:
+            return False
+
+        conn = self._connect()
+        try:
+            path = self._entry_path(key)
+            if not os.path.lexists(path):
+                # Copied aside then renamed, so that restore() never sees
+                # half an entry. Another Mr Deploy may beat us to it.
+                storing = os.path.join(self.cache_dir,
+                                       'storing.%s' % uuid.uuid4().hex)
+                try:
+                    _copy(src, storing)
+                    os.rename(storing, path)
+                except OSError:
+                    if not os.path.lexists(path):
+                        raise
+                finally:
+                    _remove(storing)
+
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, bytes, last_used) "
+                    "VALUES (?, ?, ?)", (key, size, time.time()))
+            self._evict(conn)
+        finally:
+            conn.close()
+        return True
+
+    def _evict(self, conn):
+        total = conn.execute(
+            "SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        entries = conn.execute(
+            "SELECT key, bytes FROM entries ORDER BY last_used").fetchall()
+        for key, size in entries:
+            if total <= self.max_bytes:
+                break
+            with conn:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            _remove(self._entry_path(key))
+            total -= size
@@ -0,0 +1,68 @@
+"""A persistent cache of what Mr Deploy has looked up about changesets, kept
+in SQLite and keyed by changeset node.
+
+A changeset never changes once made, so what we learn about one (its author
+and the files it touched) stays true forever: across failed deploy
+attempts, restarts and even re-clones of the repository. Queries about a
+range of changesets therefore only need to ask hg which changesets are in
+it, and about the ones never seen before.
+"""
+
+import sqlite3
+
+DB_PATH = 'changeset_cache.db'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS changesets (
+    node TEXT PRIMARY KEY,
+    author TEXT NOT NULL,
+    files TEXT NOT NULL
+);
+"""
+
+# Most nodes to look up in one query, to stay under SQLite's limit on the
+# number of parameters
+_MAX_NODES_PER_QUERY = 500
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=10)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def get(nodes, db_path=DB_PATH):
+    """Return a dict of the cached changesets among the given full nodes,
+    each a dict with its author and list of files.
+    """
+    nodes = list(nodes)
+    changesets = {}
+    conn = _connect(db_path)
+    try:
+        for i in xrange(0, len(nodes), _MAX_NODES_PER_QUERY):
+            batch = nodes[i:i + _MAX_NODES_PER_QUERY]
+            rows = conn.execute(
+                "SELECT node, author, files FROM changesets "
+                "WHERE node IN (%s)" % ', '.join('?' * len(batch)), batch)
+            for node, author, files in rows:
+                changesets[node] = {
+                    'author': author,
+                    'files': files.split('\n') if files else [],
+                }
+    finally:
+        conn.close()
+    return changesets
+
+
+def put(changesets, db_path=DB_PATH):
+    """Cache changesets, given as a dict like get() returns."""
+    conn = _connect(db_path)
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO changesets (node, author, files) "
+                "VALUES (?, ?, ?)",
+                [(node, changeset['author'], '\n'.join(changeset['files']))
+                 for node, changeset in changesets.iteritems()])
+    finally:
+        conn.close()
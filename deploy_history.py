@@ -0,0 +1,122 @@
+"""A structured record of every deploy Mr Deploy attempts, kept in SQLite.
+
+Each attempt records the target deployed to, the changeset deployed, its
+author, how many files changed, how long each stage took, the outcome, and
+the range of lines of the target's deploy log it wrote, so it can be found
+there directly.
+"""
+
+import json
+import sqlite3
+
+import deploy_targets
+
+DB_PATH = 'deploy_history.db'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deploys (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    changeset TEXT,
+    author TEXT,
+    num_files INTEGER,
+    outcome TEXT NOT NULL,
+    stage_secs TEXT NOT NULL,
+    log_from INTEGER,
+    log_to INTEGER,
+    target TEXT NOT NULL DEFAULT '%s'
+);
+CREATE INDEX IF NOT EXISTS deploys_by_started_at ON deploys (started_at);
+CREATE INDEX IF NOT EXISTS deploys_by_changeset ON deploys (changeset);
+CREATE INDEX IF NOT EXISTS deploys_by_outcome ON deploys (outcome, id);
+""" % deploy_targets.DEFAULT_TARGET
+
+# Deploys were all to the default target before there were targets
+_ADD_TARGET = """
+ALTER TABLE deploys ADD COLUMN target TEXT NOT NULL DEFAULT '%s'
+""" % deploy_targets.DEFAULT_TARGET
+
+_TARGET_INDEX = """
+CREATE INDEX IF NOT EXISTS deploys_by_target ON deploys (target, id)
+"""
+
+_COLUMNS = ['id', 'started_at', 'finished_at', 'changeset', 'author',
+            'num_files', 'outcome', 'stage_secs', 'log_from', 'log_to',
+            'target']
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=10)
+    conn.executescript(_SCHEMA)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(deploys)")]
+    if 'target' not in columns:
+        try:
+            conn.execute(_ADD_TARGET)
+        except sqlite3.OperationalError:
+            pass  # Another process just added it
+    conn.execute(_TARGET_INDEX)
+    return conn
+
+
+def record(started_at, finished_at, changeset, author, num_files, outcome,
+           stage_secs, log_from, log_to,
+           target=deploy_targets.DEFAULT_TARGET, db_path=DB_PATH):
+    """Add a deploy attempt to the history and return its id. stage_secs is
+    a dict of stage name to seconds taken, and log_from and log_to give the
+    range of the target's deploy log lines written during the attempt
+    (log_to exclusive).
+    """
+    conn = _connect(db_path)
+    try:
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO deploys (%s) VALUES (%s)" % (
+                    ', '.join(_COLUMNS[1:]),
+                    ', '.join('?' * (len(_COLUMNS) - 1))),
+                (started_at, finished_at, changeset, author, num_files,
+                 outcome, json.dumps(stage_secs), log_from, log_to, target))
+            return cursor.lastrowid
+    finally:
+        conn.close()
+
+
+def query(before_id=None, limit=20, outcome=None, changeset=None,
+          target=None, db_path=DB_PATH):
+    """Return up to limit deploy attempts as dicts, newest first. For the
+    next page, pass the id of the last one returned as before_id.
+    Optionally only return attempts with the given outcome, changeset or
+    target.
+    """
+    conditions, params = [], []
+    if target is not None:
+        conditions.append("target = ?")
+        params.append(target)
+    if before_id is not None:
+        conditions.append("id < ?")
+        params.append(before_id)
+    if outcome is not None:
+        conditions.append("outcome = ?")
+        params.append(outcome)
+    if changeset is not None:
+        conditions.append("changeset = ?")
+        params.append(changeset)
+
+    sql = "SELECT %s FROM deploys" % ', '.join(_COLUMNS)
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+
+    conn = _connect(db_path)
+    try:
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+    deploys = []
+    for row in rows:
+        deploy = dict(zip(_COLUMNS, row))
+        deploy['stage_secs'] = json.loads(deploy['stage_secs'])
+        deploys.append(deploy)
+    return deploys
@@ -0,0 +1,510 @@
+"""Storage for Mr Deploy's output log.
+
+The log is a sequence of append-only segment files in LOG_DIR. Each segment
+has a sidecar index of line offsets, so any range of lines can be located
+without scanning the log. Once a segment grows past SEGMENT_BYTES it is
+closed, and a new one is started. The closed one's search index is then
+sealed (see log_search) and the segment compressed in the background.
+
+A manifest lists the segments in order along with the number of the first
+line in each, so together they still read as one log. The last segment in
+the manifest is the one being written to.
+
+An index is a flat array of little-endian 64-bit integers, one per line,
+each giving the byte offset just past the end of that line in the
+uncompressed segment. A line is only indexed after its bytes have been
+flushed to the segment, so readers never see a partially written line.
+"""
+
+import bisect
+import gzip
+import json
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+
+import log_search
+
+LOG_DIR = 'log/mr_deploy'
+MANIFEST_NAME = 'manifest.json'
+
+# Where the log lived before it was split into segments. If found, it is
+# adopted as the first segment.
+LEGACY_LOG_PATH = 'log/mr_deploy.log'
+
+# Size at which the segment being written is closed and a new one started
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+# How often buffered writes are flushed (made visible to readers) and
+# fsync'd (made durable)
+FLUSH_SECS = 0.25
+FSYNC_SECS = 5
+
+_OFFSET = struct.Struct('<Q')
+
+# How much of a segment to read at a time when rebuilding its index
+_SCAN_CHUNK_BYTES = 1024 * 1024
+
+
+def _index_path(segment_path):
+    return segment_path + '.idx'
+
+
+def _segment_name(number):
+    return '%06d.log' % number
+
+
+def read_manifest(log_dir=LOG_DIR):
+    """Return the list of segments in the log, oldest first. Each segment is
+    a dict with its file name, first line number, number of lines (None for
+    the segment being written) and whether it has been compressed.
+    """
+    try:
+        with open(os.path.join(log_dir, MANIFEST_NAME)) as f:
+            return json.load(f)['segments']
+    except IOError:
+        return []
+
+
+def _write_manifest(log_dir, segments):
+    path = os.path.join(log_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'segments': segments}, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+
+class _SegmentWriter(object):
+    """Appends lines to one segment and keeps its index up to date, and
+    unless searchable is False, its search index too. Writes are buffered
+    until flush().
+    """
+
+    def __init__(self, path, searchable=True):
+        self.log_file = open(path, 'ab')
+        self.index_file = open(_index_path(path), 'ab')
+        self.size = os.fstat(self.log_file.fileno()).st_size
+        self.num_lines = 0
+        self.pending_offsets = []
+        self.postings = None  # Set up once the segment is reconciled
+        self._reconcile_index()
+        if searchable:
+            self.postings = log_search.PostingsWriter(path)
+            self._index_unsearchable_lines()
+
+    def _reconcile_index(self):
+        """Bring the index in sync with the segment, e.g. for a segment
+        written before the index existed or after a crash between the two
+        writes.
+        """
+        index_fd = self.index_file.fileno()
+        num_lines = os.fstat(index_fd).st_size // _OFFSET.size
+
+        last_end = 0
+        if num_lines:
+            with open(self.index_file.name, 'rb') as f:
+                f.seek((num_lines - 1) * _OFFSET.size)
+                last_end, = _OFFSET.unpack(f.read(_OFFSET.size))
+
+        if last_end > self.size:
+            # The segment was truncated or replaced underneath us; start over
+            num_lines, last_end = 0, 0
+
+        # Drop any torn trailing entry (or everything, if starting over)
+        os.ftruncate(index_fd, num_lines * _OFFSET.size)
+        self.num_lines = num_lines
+
+        with open(self.log_file.name, 'rb') as f:
+            f.seek(last_end)
+            position = last_end
+            while True:
+                chunk = f.read(_SCAN_CHUNK_BYTES)
+                if not chunk:
+                    break
+                newline = chunk.find('\n')
+                while newline != -1:
+                    last_end = position + newline + 1
+                    self.pending_offsets.append(_OFFSET.pack(last_end))
+                    newline = chunk.find('\n', newline + 1)
+                position += len(chunk)
+        self.num_lines += len(self.pending_offsets)
+
+        if self.size > last_end:
+            # Terminate a dangling partial line so it gets its own entry
+            self.write(['\n'])
+        self.flush()
+
+    def _index_unsearchable_lines(self):
+        """Add lines missing from the search index, e.g. those written
+        before it existed or lost in a crash, to the search index.
+        """
+        first_line = self.postings.num_lines
+        if first_line >= self.num_lines:
+            return
+
+        start = 0
+        if first_line:
+            with open(self.index_file.name, 'rb') as f:
+                f.seek((first_line - 1) * _OFFSET.size)
+                start, = _OFFSET.unpack(f.read(_OFFSET.size))
+
+        with open(self.log_file.name, 'rb') as f:
+            f.seek(start)
+            for line_number in xrange(first_line, self.num_lines):
+                self.postings.add(line_number, f.readline())
+        self.postings.flush()
+
+    def write(self, lines):
+        """Append the given lines. Lines missing a trailing newline get one.
+        """
+        for line in lines:
+            if not line.endswith('\n'):
+                line += '\n'
+            self.log_file.write(line)
+            self.size += len(line)
+            self.pending_offsets.append(_OFFSET.pack(self.size))
+            if self.postings:
+                self.postings.add(self.num_lines, line)
+            self.num_lines += 1
+
+    def flush(self):
+        if not self.pending_offsets:
+            return
+
+        # Flush the log before the index so indexed lines are always complete
+        self.log_file.flush()
+        self.index_file.write(''.join(self.pending_offsets))
+        self.index_file.flush()
+        self.pending_offsets = []
+        if self.postings:
+            self.postings.flush()
+
+    def fsync(self):
+        self.flush()
+        os.fsync(self.log_file.fileno())
+        os.fsync(self.index_file.fileno())
+
+    def close(self):
+        self.fsync()
+        self.log_file.close()
+        self.index_file.close()
+        if self.postings:
+            self.postings.close()
+
+
+class DeployLogWriter(object):
+    """Appends lines to the deploy log, rotating and compressing segments as
+    they fill up. Only one writer (Mr Assistant) should have the log open at
+    a time.
+
+    Writes are buffered and flushed every FLUSH_SECS by a background thread,
+    and fsync'd every FSYNC_SECS.
+    """
+
+    def __init__(self, log_dir=LOG_DIR, segment_bytes=SEGMENT_BYTES):
+        self.log_dir = log_dir
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+
+        self.segments = read_manifest(log_dir)
+        if not self.segments:
+            self.segments = self._adopt_legacy_log()
+            _write_manifest(log_dir, self.segments)
+
+        self.active = _SegmentWriter(self._path(self.segments[-1]))
+
+        # Finish sealing and compressing segments from before a restart
+        for segment in self.segments[:-1]:
+            if (not segment['compressed'] or
+                    log_search.needs_sealing(self._path(segment))):
+                self._compress_in_background(segment)
+
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_periodically)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def _path(self, segment):
+        return os.path.join(self.log_dir, segment['name'])
+
+    def _adopt_legacy_log(self):
+        """Return the segments of a new log: the legacy log as a closed
+        segment, if there is one, then an empty one to write to.
+        """
+        segments = []
+        # The legacy log was the default deploy target's
+        if self.log_dir == LOG_DIR and os.path.isfile(LEGACY_LOG_PATH):
+            legacy = {'name': _segment_name(0), 'first_line': 0,
+                      'num_lines': None, 'compressed': False}
+            path = self._path(legacy)
+            os.rename(LEGACY_LOG_PATH, path)
+            if os.path.isfile(_index_path(LEGACY_LOG_PATH)):
+                os.rename(_index_path(LEGACY_LOG_PATH), _index_path(path))
+
+            # Only its line offsets are indexed now. Indexing it for search
+            # can take minutes, so is left to sealing it in the background,
+            # like any other closed segment.
+            writer = _SegmentWriter(path, searchable=False)
+            legacy['num_lines'] = writer.num_lines
+            writer.close()
+            segments.append(legacy)
+
+        segments.append({
+            'name': _segment_name(len(segments)),
+            'first_line': sum(segment['num_lines'] for segment in segments),
+            'num_lines': None,
+            'compressed': False,
+        })
+        return segments
+
+    def write(self, lines):
+        """Append the given lines to the log. Lines missing a trailing
+        newline get one.
+        """
+        with self.lock:
+            self.active.write(lines)
+            if self.active.size >= self.segment_bytes:
+                self._rotate()
+
+    def flush(self):
+        with self.lock:
+            self.active.flush()
+
+    def _flush_periodically(self):
+        last_fsync = time.time()
+        while not self.closed.wait(FLUSH_SECS):
+            with self.lock:
+                if time.time() - last_fsync >= FSYNC_SECS:
+                    self.active.fsync()
+                    last_fsync = time.time()
+                else:
+                    self.active.flush()
+
+    def _rotate(self):
+        """Close the active segment and start a new one. Must hold the lock.
+        """
+        self.active.close()
+
+        closed = self.segments[-1]
+        closed['num_lines'] = self.active.num_lines
+        self.segments.append({
+            'name': _segment_name(len(self.segments)),
+            'first_line': closed['first_line'] + closed['num_lines'],
+            'num_lines': None,
+            'compressed': False,
+        })
+        _write_manifest(self.log_dir, self.segments)
+
+        self.active = _SegmentWriter(self._path(self.segments[-1]))
+        self._compress_in_background(closed)
+
+    def _compress_in_background(self, segment):
+        thread = threading.Thread(target=self._compress, args=(segment,))
+        thread.daemon = True
+        thread.start()
+
+    def _open_segment(self, segment):
+        path = self._path(segment)
+        if segment['compressed']:
+            return gzip.open(path + '.gz', 'rb')
+        return open(path, 'rb')
+
+    def _compress(self, segment):
+        """Seal a closed segment's search index, then compress it."""
+        path = self._path(segment)
+        try:
+            log_search.seal(path, segment['num_lines'],
+                            lambda: self._open_segment(segment))
+        except (IOError, OSError) as e:
+            print "Couldn't seal the search index of %s: %s" % (path, e)
+
+        if segment['compressed']:
+            return
+        with open(path, 'rb') as f_in:
+            f_out = gzip.open(path + '.gz.tmp', 'wb')
+            try:
+                shutil.copyfileobj(f_in, f_out)
+            finally:
+                f_out.close()
+        os.rename(path + '.gz.tmp', path + '.gz')
+
+        with self.lock:
+            segment['compressed'] = True
+            _write_manifest(self.log_dir, self.segments)
+        os.remove(path)
+
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        with self.lock:
+            self.active.close()
+
+
+class _SegmentIndex(object):
+    """Memory map of a segment's index, remapped as the segment grows."""
+
+    def __init__(self, path):
+        self.path = path
+        self.index_map = None
+        self.num_mapped = 0
+
+    def end_offset(self, line):
+        """Byte offset just past the end of the given line of the segment
+        (0-based).
+        """
+        if line < 0:
+            return 0
+
+        if line >= self.num_mapped:
+            self._remap()
+
+        return _OFFSET.unpack_from(self.index_map, line * _OFFSET.size)[0]
+
+    def _remap(self):
+        if self.index_map is not None:
+            self.index_map.close()
+            self.index_map = None
+
+        with open(self.path, 'rb') as f:
+            num_lines = os.fstat(f.fileno()).st_size // _OFFSET.size
+            if not num_lines:
+                raise IndexError("Deploy log index %s is empty" % self.path)
+            self.index_map = mmap.mmap(f.fileno(), num_lines * _OFFSET.size,
+                                       access=mmap.ACCESS_READ)
+        self.num_mapped = num_lines
+
+
+class DeployLog(object):
+    """Read-only view of the whole deploy log, across segments. Lines are
+    numbered from 0 at the start of the oldest segment.
+    """
+
+    def __init__(self, log_dir=LOG_DIR):
+        self.log_dir = log_dir
+        self.indexes = {}
+
+    def _path(self, segment):
+        return os.path.join(self.log_dir, segment['name'])
+
+    def segments(self):
+        """Return the manifest's segments, with num_lines filled in for the
+        one being written.
+        """
+        segments = read_manifest(self.log_dir)
+        if segments:
+            active = segments[-1]
+            try:
+                index_size = os.path.getsize(_index_path(self._path(active)))
+            except OSError:
+                index_size = 0
+            active['num_lines'] = index_size // _OFFSET.size
+        return segments
+
+    def num_lines(self, segments=None):
+        if segments is None:
+            segments = self.segments()
+        if not segments:
+            return 0
+        return segments[-1]['first_line'] + segments[-1]['num_lines']
+
+    def _end_offset(self, segment, line):
+        name = segment['name']
+        if name not in self.indexes:
+            self.indexes[name] = _SegmentIndex(
+                _index_path(self._path(segment)))
+        return self.indexes[name].end_offset(line)
+
+    def _open_segment(self, segment):
+        path = self._path(segment)
+        if not segment['compressed']:
+            try:
+                return open(path, 'rb')
+            except IOError:
+                pass  # Compressed since we read the manifest
+        return gzip.open(path + '.gz', 'rb')
+
+    def _read_segment(self, segment, extents):
+        """Return the bytes of the segment in each of a list of (start, end)
+        byte ranges. Overlapping ranges are read together, and the segment
+        is read front to back, since seeking backwards in a compressed one
+        means decompressing it again from the start.
+        """
+        spans = []
+        for start, end in sorted(extents):
+            if spans and start <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], end)
+            else:
+                spans.append([start, end])
+
+        f = self._open_segment(segment)
+        try:
+            for span in spans:
+                f.seek(span[0])
+                span.append(f.read(span[1] - span[0]))
+        finally:
+            f.close()
+
+        span_starts = [span[0] for span in spans]
+        data = []
+        for start, end in extents:
+            span_start, _, span_data = spans[
+                bisect.bisect_right(span_starts, start) - 1]
+            data.append(span_data[start - span_start:end - span_start])
+        return data
+
+    def read_lines(self, first_line, limit):
+        """Return (first_line, end_line, data) for up to limit lines starting
+        at first_line, where data is the raw bytes of those lines and
+        end_line is exclusive. The range is clamped to the lines in the log.
+        """
+        return self.read_ranges([(first_line, limit)])[0]
+
+    def read_ranges(self, ranges):
+        """Like read_lines(), for each of a list of (first_line, limit), but
+        reading each segment only once however many of the ranges are in it.
+        """
+        segments = self.segments()
+        num_lines = self.num_lines(segments)
+
+        clamped = []
+        for first_line, limit in ranges:
+            first_line = max(0, min(first_line, num_lines))
+            end_line = max(first_line, min(first_line + limit, num_lines))
+            clamped.append((first_line, end_line))
+
+        chunks = [[] for _ in clamped]
+        for segment in segments:
+            segment_first = segment['first_line']
+            segment_end = segment_first + segment['num_lines']
+
+            wanted = []  # Ranges in this segment
+            extents = []  # and the bytes they cover in it
+            for i, (first_line, end_line) in enumerate(clamped):
+                if segment_end <= first_line or segment_first >= end_line:
+                    continue
+
+                local_first = max(first_line, segment_first) - segment_first
+                local_end = min(end_line, segment_end) - segment_first
+                wanted.append(i)
+                extents.append((self._end_offset(segment, local_first - 1),
+                                self._end_offset(segment, local_end - 1)))
+
+            if wanted:
+                for i, data in zip(wanted,
+                                   self._read_segment(segment, extents)):
+                    chunks[i].append(data)
+
+        return [(first_line, end_line, ''.join(range_chunks))
+                for (first_line, end_line), range_chunks
+                in zip(clamped, chunks)]
+
+    def tail(self, limit):
+        """Like read_lines(), but for the last limit lines of the log."""
+        return self.read_lines(self.num_lines() - limit, limit)
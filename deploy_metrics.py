@@ -0,0 +1,216 @@
+"""Timing of the stages of Mr Deploy's deploy pipeline, and of other things
+Mr Deploy and Mr Assistant do (e.g. polling), kept in Redis.
+
+For each stage or other timing and outcome we keep the durations of the
+last MAX_SAMPLES runs, from which /deploy/metrics reports rolling
+percentiles. The spans of the deploy in progress and of the last finished
+deploy to each target are kept too, to draw them as a waterfall.
+"""
+
+import contextlib
+import json
+import threading
+import time
+
+import redis
+
+
+# The kinds of durations kept, each in its own keys and reported as its own
+# metric: the stages of deploys, and timings of anything else
+STAGE = 'stage'
+TIMING = 'timing'
+
+SAMPLES_KEY = 'mr_deploy_%s_secs:%s:%s'  # % (kind, name, outcome)
+SERIES_KEY = 'mr_deploy_%s_series'  # % kind; set of "name:outcome"
+CURRENT_DEPLOY_KEY = 'mr_deploy_current_deploy'
+LAST_DEPLOY_KEY = 'mr_deploy_last_deploy'
+
+# Number of most recent durations kept for each stage and outcome
+MAX_SAMPLES = 500
+
+
+def record(red, name, outcome, secs, kind=STAGE):
+    """Record that a run of the stage (or other timing, by kind) name with
+    the given outcome took secs.
+    """
+    key = SAMPLES_KEY % (kind, name, outcome)
+    series = '%s:%s' % (name, outcome)
+    pipe = red.pipeline(transaction=False)
+    pipe.lpush(key, secs)
+    pipe.ltrim(key, 0, MAX_SAMPLES - 1)
+    pipe.sadd(SERIES_KEY % kind, series)
+    pipe.execute()
+
+
+def _percentile(sorted_samples, fraction):
+    index = int(round(fraction * (len(sorted_samples) - 1)))
+    return sorted_samples[index]
+
+
+def get_stats(red, kind=STAGE):
+    """Return a list of dicts of rolling statistics for each stage (or
+    other timing, by kind) and outcome seen, sorted by name.
+    """
+    series = sorted(red.smembers(SERIES_KEY % kind))
+    pipe = red.pipeline(transaction=False)
+    for name in series:
+        pipe.lrange(SAMPLES_KEY % ((kind,) + tuple(name.split(':', 1))),
+                    0, -1)
+
+    stats = []
+    for name, samples in zip(series, pipe.execute()):
+        if not samples:
+            continue
+        samples = sorted(float(s) for s in samples)
+        name, outcome = name.split(':', 1)
+        stats.append({
+            'name': name,
+            'outcome': outcome,
+            'count': len(samples),
+            'sum': sum(samples),
+            'p50': _percentile(samples, 0.5),
+            'p95': _percentile(samples, 0.95),
+            'max': samples[-1],
+        })
+    return stats
+
+
+def _deploy_keys(target):
+    """Return the keys of the current and last deploy to a DeployTarget,
+    or to the default target if None.
+    """
+    if target is None:
+        return CURRENT_DEPLOY_KEY, LAST_DEPLOY_KEY
+    return target.key(CURRENT_DEPLOY_KEY), target.key(LAST_DEPLOY_KEY)
+
+
+def get_deploys(red, target=None):
+    """Return (current, last): the spans of the deploy in progress and of
+    the last finished deploy to target, or None for either if there isn't
+    one.
+    """
+    current, last = red.mget(_deploy_keys(target))
+    return (current and json.loads(current)), (last and json.loads(last))
+
+
+_DESCRIPTIONS = {
+    STAGE: 'deploy pipeline stages',
+    TIMING: 'other operations of Mr Deploy and Mr Assistant',
+}
+
+
+def to_prometheus(stats, kind=STAGE):
+    """Format statistics of the given kind in the Prometheus text
+    exposition format, as the metric mr_deploy_<kind>_seconds labelled with
+    <kind> and outcome.
+    """
+    metric = 'mr_deploy_%s_seconds' % kind
+    lines = [
+        '# HELP %s Duration of %s over their last %d runs.' % (
+            metric, _DESCRIPTIONS[kind], MAX_SAMPLES),
+        '# TYPE %s summary' % metric,
+    ]
+    for stat in stats:
+        labels = '%s="%s",outcome="%s"' % (kind, stat['name'],
+                                           stat['outcome'])
+        lines.extend([
+            '%s{%s,quantile="0.5"} %f' % (metric, labels, stat['p50']),
+            '%s{%s,quantile="0.95"} %f' % (metric, labels, stat['p95']),
+            '%s_sum{%s} %f' % (metric, labels, stat['sum']),
+            '%s_count{%s} %d' % (metric, labels, stat['count']),
+        ])
+
+    lines.extend([
+        '# HELP %s_max Longest of the last %d runs of each of the %s.' % (
+            metric, MAX_SAMPLES, _DESCRIPTIONS[kind]),
+        '# TYPE %s_max gauge' % metric,
+    ])
+    for stat in stats:
+        lines.append('%s_max{%s="%s",outcome="%s"} %f' % (
+            metric, kind, stat['name'], stat['outcome'], stat['max']))
+
+    return '\n'.join(lines) + '\n'
+
+
+class Cancelled(Exception):
+    """Raised by a stage that was stopped because it was no longer needed,
+    which is recorded as the outcome 'cancelled' rather than 'failed'.
+    """
+
+
+class DeployTimer(object):
+    """Times the stages of one deploy attempt. Wrap each stage in
+    `with timer.stage(name):` and call finish() at the end.
+
+    Failing to save timings is reported but never fails the deploy.
+    """
+
+    def __init__(self, red, target=None):
+        self.red = red
+        self.current_key, self.last_key = _deploy_keys(target)
+        self.started_at = time.time()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        span = {'stage': name, 'start': time.time(), 'end': None,
+                'outcome': 'running'}
+        with self.lock:
+            self.spans.append(span)
+        self._save(self.current_key, 'running')
+
+        try:
+            yield
+            span['outcome'] = 'succeeded'
+        except SystemExit:
+            span['outcome'] = 'aborted'
+            raise
+        except Cancelled:
+            span['outcome'] = 'cancelled'
+            raise
+        except BaseException:
+            span['outcome'] = 'failed'
+            raise
+        finally:
+            span['end'] = time.time()
+            self._save(self.current_key, 'running')
+            try:
+                record(self.red, name, span['outcome'],
+                       span['end'] - span['start'])
+            except redis.RedisError as e:
+                print "Couldn't record timing of %s: %s" % (name, e)
+
+    def get_stage_secs(self):
+        """Return a dict of the seconds taken by each finished stage."""
+        with self.lock:
+            return dict((span['stage'], span['end'] - span['start'])
+                        for span in self.spans if span['end'] is not None)
+
+    def get_document(self, outcome):
+        with self.lock:
+            return {
+                'started_at': self.started_at,
+                'finished_at': None if outcome == 'running' else time.time(),
+                'outcome': outcome,
+                'spans': [dict(span) for span in self.spans],
+            }
+
+    def _save(self, key, outcome):
+        try:
+            self.red.set(key, json.dumps(self.get_document(outcome)))
+        except redis.RedisError as e:
+            print "Couldn't save deploy timings: %s" % e
+
+    def finish(self, outcome):
+        """Mark the deploy as finished with the given outcome, making it the
+        last deploy if any stages were timed.
+        """
+        if not self.spans:
+            return
+
+        self._save(self.last_key, outcome)
+        try:
+            self.red.delete(self.current_key)
+        except redis.RedisError as e:
+            print "Couldn't clear current deploy timings: %s" % e
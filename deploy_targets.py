@@ -0,0 +1,75 @@
+"""The targets Mr Deploy deploys to: each a branch of the repository deployed
+to an App Engine version, with its own Mr Deploy process, working copy,
+state, log and Redis keys.
+
+Targets are configured in CONFIG_PATH, a JSON list of objects taking the
+arguments of DeployTarget (see deploy_targets.json.example). Without it,
+there's just the one target DEFAULT_TARGET, deploying master to staging.
+
+The default target keeps the names used from before there were several
+targets, so its history, logs and state carry on where they left off.
+Every other target's names are suffixed with its name.
+"""
+
+import json
+import os
+import re
+
+CONFIG_PATH = 'deploy_targets.json'
+
+DEFAULT_TARGET = 'staging'
+
+
+class DeployTarget(object):
+    def __init__(self, name, branch='master', version=None, clone_url=None,
+                 repo_dir=None):
+        """name - A short name, which is also the version deployed to unless
+            given.
+        branch - The branch or bookmark to deploy.
+        clone_url, repo_dir - Where to deploy from and keep the working copy,
+            if not mr_deploy.py's defaults.
+        """
+        if not re.match(r'^[a-z0-9-]+$', name):
+            raise ValueError("Bad deploy target name %r: use lowercase "
+                             "letters, digits and -" % name)
+        self.name = str(name)
+        self.branch = str(branch)
+        self.version = str(version or name)
+        self.clone_url = clone_url
+        self.repo_dir = repo_dir
+
+    def is_default(self):
+        return self.name == DEFAULT_TARGET
+
+    def key(self, base):
+        """Name this target's Redis key or channel, e.g. mr_deploy_output."""
+        return base if self.is_default() else '%s:%s' % (base, self.name)
+
+    def path(self, base):
+        """Name this target's file or directory, e.g. log/mr_deploy."""
+        if self.is_default():
+            return base
+        root, ext = os.path.splitext(base)
+        return '%s.%s%s' % (root, self.name, ext)
+
+
+def load(config_path=CONFIG_PATH):
+    """Return the list of configured targets."""
+    if not os.path.isfile(config_path):
+        return [DeployTarget(DEFAULT_TARGET)]
+
+    with open(config_path) as f:
+        targets = [DeployTarget(**config) for config in json.load(f)]
+    names = [target.name for target in targets]
+    if len(set(names)) != len(names):
+        raise ValueError("Deploy targets in %s have the same name" % (
+            config_path))
+    return targets
+
+
+def get(name, config_path=CONFIG_PATH):
+    """Return the configured target with the given name."""
+    for target in load(config_path):
+        if target.name == name:
+            return target
+    raise KeyError("No deploy target %s in %s" % (name, config_path))
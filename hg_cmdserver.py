@@ -0,0 +1,139 @@
+"""A client for Mercurial's command server, which runs many hg commands in
+one long-lived `hg serve --cmdserver pipe` process instead of paying Python
+startup and a repository open for each.
+
+See http://mercurial.selenic.com/wiki/CommandServer for the protocol.
+"""
+
+import struct
+import subprocess
+import sys
+import threading
+
+# Every message from the server starts with a one byte channel name and a
+# big-endian length
+_HEADER = struct.Struct('>cI')
+_LENGTH = struct.Struct('>I')
+_RESULT = struct.Struct('>i')
+
+
+class CommandServerError(subprocess.CalledProcessError):
+    """The command server failed, rather than the command run in it. It's
+    a CalledProcessError with hg's exit code for an abort, 255, so callers
+    handle it like any other failed hg command.
+    """
+
+    def __init__(self, reason, args=()):
+        subprocess.CalledProcessError.__init__(self, 255,
+                                               ["hg"] + list(args))
+        self.reason = reason
+
+    def __str__(self):
+        return self.reason
+
+
+class HgCommandServer(object):
+    """Runs hg commands in repo_dir through a command server process, which
+    is started on first use and respawned if it dies or misbehaves.
+
+    The server caches repository state, so call close() after changing the
+    repository from outside it (e.g. by a separate `hg pull`) to get a fresh
+    server for the next command. Commands from different threads take turns.
+    """
+
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self.proc = None
+        self.lock = threading.RLock()
+
+    def _start(self):
+        self.proc = subprocess.Popen(
+            ["hg", "serve", "--cmdserver", "pipe",
+                "--config", "ui.interactive=False"],
+            cwd=self.repo_dir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+        channel, hello = self._read_message()
+        if channel != 'o' or 'runcommand' not in hello:
+            raise CommandServerError("Unexpected hello from hg command "
+                    "server: %r" % hello)
+
+    def _read_message(self):
+        header = self.proc.stdout.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise CommandServerError("hg command server hung up")
+
+        channel, length = _HEADER.unpack(header)
+        if channel in 'IL':
+            # Input requests carry the wanted size rather than data
+            return channel, length
+
+        data = self.proc.stdout.read(length)
+        if len(data) < length:
+            raise CommandServerError("hg command server hung up")
+        return channel, data
+
+    def _runcommand(self, args):
+        data = '\0'.join(args)
+        self.proc.stdin.write('runcommand\n' + _LENGTH.pack(len(data)) + data)
+        self.proc.stdin.flush()
+
+        output, error = [], []
+        while True:
+            channel, data = self._read_message()
+            if channel == 'o':
+                output.append(data)
+            elif channel == 'e':
+                error.append(data)
+            elif channel == 'r':
+                return _RESULT.unpack(data)[0], ''.join(output), ''.join(error)
+            elif channel in 'IL':
+                # We have no input to give; an empty reply means EOF
+                self.proc.stdin.write(_LENGTH.pack(0))
+                self.proc.stdin.flush()
+            elif channel.isupper():
+                raise CommandServerError("Unsupported required channel %r "
+                        "from hg command server" % channel)
+
+    def run(self, args):
+        """Run `hg <args>` and return (returncode, output, error output).
+        If the server fails mid-command it is restarted and the command
+        retried once, so only use this for commands that are safe to repeat.
+        """
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    if self.proc is None or self.proc.poll() is not None:
+                        self._start()
+                    return self._runcommand(args)
+                except (CommandServerError, IOError, OSError) as e:
+                    self.close()
+                    if attempt == 2:
+                        raise CommandServerError("hg %s failed: %s" % (
+                                ' '.join(args), e), args)
+
+    def check_output(self, args):
+        """Like subprocess.check_output(["hg"] + args, cwd=repo_dir). hg's
+        error output is passed through to our stderr.
+        """
+        returncode, output, error = self.run(args)
+        sys.stderr.write(error)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, ["hg"] + args,
+                                                output)
+        return output
+
+    def close(self):
+        """Stop the server process, if running."""
+        with self.lock:
+            if self.proc is None:
+                return
+
+            proc, self.proc = self.proc, None
+            try:
+                proc.stdin.close()
+                proc.wait()
+            except (IOError, OSError):
+                proc.kill()
@@ -0,0 +1,353 @@
+"""Full-text search over the deploy log, using an inverted index of which
+lines of each log segment contain which tokens.
+
+While a segment is being written, the log writer appends the postings of
+each batch of lines it flushes to <segment>.terms.log, as lines of
+"<token>\t<line>,<line>,...", each batch ending with "#<lines indexed>".
+Every RUN_LINES lines it also writes the postings since its last run as a
+sorted run, <segment>.terms.<offset>-<lines>: one line per token, sorted by
+token, covering the first <offset> bytes of the .terms.log (and so its
+first <lines> lines). Searches binary search the runs through memory maps
+and only read the .terms.log written since the last of them, so neither
+they nor the writer ever hold more than a run's worth of postings.
+
+Once a segment is closed, the writer seals it, merging its runs in one pass
+into <segment>.terms, which is searched the same way. Segments closed
+without complete postings (e.g. ones written before indexing existed) have
+the rest of their lines indexed from the log itself as they're sealed.
+
+Tokens are runs of 2-64 letters, digits and underscores, lowercased.
+"""
+
+import collections
+import heapq
+import itertools
+import mmap
+import os
+import re
+
+TOKEN_RE = re.compile(r'[a-z0-9_]{2,64}')
+
+# Lines of postings the writer collects before writing them out as a run
+RUN_LINES = 20000
+
+# Most sorted indexes of sealed segments kept mapped, by path: (mmap, size),
+# least recently used first
+_MAX_MAPPED_INDEXES = 64
+_sorted_indexes = collections.OrderedDict()
+
+
+def tokenize(text):
+    return set(TOKEN_RE.findall(text.lower()))
+
+
+def _chunks_path(segment_path):
+    return segment_path + '.terms.log'
+
+
+def _sorted_path(segment_path):
+    return segment_path + '.terms'
+
+
+def _run_path(segment_path, offset, num_lines):
+    return '%s.terms.%d-%d' % (segment_path, offset, num_lines)
+
+
+def _list_runs(segment_path):
+    """Return a list of (offset, num_lines, path) for the runs of a segment,
+    oldest first.
+    """
+    log_dir, name = os.path.split(segment_path)
+    run_re = re.compile(re.escape(name) + r'\.terms\.(\d+)-(\d+)$')
+    runs = []
+    for entry in os.listdir(log_dir or '.'):
+        match = run_re.match(entry)
+        if match:
+            runs.append((int(match.group(1)), int(match.group(2)),
+                         os.path.join(log_dir, entry)))
+    runs.sort()
+    return runs
+
+
+def _read_batches(path, start=0):
+    """Yield (postings, num_lines, end) for each complete batch of a
+    .terms.log file from byte offset start, which must be the end of a
+    batch: a list of (token, comma-separated line numbers), the number of
+    lines indexed, and the offset just past the batch.
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return
+
+    with f:
+        f.seek(start)
+        position = start
+        batch = []
+        for line in f:
+            position += len(line)
+            if not line.endswith('\n'):
+                break  # Torn write
+            if line.startswith('#'):
+                yield batch, int(line[1:]), position
+                batch = []
+            else:
+                token, _, line_numbers = line.rstrip('\n').partition('\t')
+                batch.append((token, line_numbers))
+
+
+def _write_sorted(path, postings):
+    """Write a dict of token to list of comma-separated line numbers as a
+    sorted index.
+    """
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        for token in sorted(postings):
+            f.write('%s\t%s\n' % (token, ','.join(postings[token])))
+    os.rename(temp_path, path)
+
+
+class _RunBuilder(object):
+    """Collects the postings of consecutive lines of a segment, writing them
+    out as a run every RUN_LINES lines.
+    """
+
+    def __init__(self, segment_path, num_lines=0):
+        self.segment_path = segment_path
+        self.postings = collections.defaultdict(list)
+        self.run_from = num_lines  # First line not yet in a run
+        self.num_lines = num_lines
+
+    def add(self, postings, num_lines, offset):
+        """Add a list of (token, comma-separated line numbers) for the lines
+        up to num_lines, which end at offset in the .terms.log.
+        """
+        for token, line_numbers in postings:
+            self.postings[token].append(line_numbers)
+        self.num_lines = num_lines
+        if self.num_lines - self.run_from >= RUN_LINES:
+            self.write_run(offset)
+
+    def write_run(self, offset):
+        if self.num_lines == self.run_from:
+            return
+        _write_sorted(_run_path(self.segment_path, offset, self.num_lines),
+                      self.postings)
+        self.postings = collections.defaultdict(list)
+        self.run_from = self.num_lines
+
+
+class PostingsWriter(object):
+    """Incrementally indexes the lines written to a segment. Lines must be
+    added in order, and are only visible to searches after flush().
+    """
+
+    def __init__(self, segment_path):
+        path = _chunks_path(segment_path)
+        runs = _list_runs(segment_path)
+        offset, num_lines = runs[-1][:2] if runs else (0, 0)
+
+        # Pick up the batches written since the last run
+        self.runs = _RunBuilder(segment_path, num_lines)
+        for postings, num_lines, offset in _read_batches(path, offset):
+            self.runs.add(postings, num_lines, offset)
+        self.num_lines = self.runs.num_lines
+
+        self.file = open(path, 'ab')
+        os.ftruncate(self.file.fileno(), offset)
+        self.offset = offset
+        self.pending = collections.defaultdict(list)
+
+    def add(self, line_number, line):
+        """Index a line of the segment, numbered from 0."""
+        if line_number < self.num_lines:
+            return  # Already indexed
+        for token in tokenize(line):
+            self.pending[token].append(line_number)
+        self.num_lines = line_number + 1
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        postings = [(token, ','.join(str(n) for n in numbers))
+                    for token, numbers in sorted(self.pending.iteritems())]
+        chunk = ''.join('%s\t%s\n' % posting for posting in postings)
+        chunk += '#%d\n' % self.num_lines
+        self.file.write(chunk)
+        self.file.flush()
+        self.offset += len(chunk)
+        self.pending = collections.defaultdict(list)
+
+        self.runs.add(postings, self.num_lines, self.offset)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def needs_sealing(segment_path):
+    return (not os.path.isfile(_sorted_path(segment_path)) or
+            os.path.exists(_chunks_path(segment_path)))
+
+
+def _read_run(number, path):
+    with open(path, 'rb') as f:
+        for line in f:
+            token, _, line_numbers = line.rstrip('\n').partition('\t')
+            yield token, number, line_numbers
+
+
+def seal(segment_path, num_lines, open_segment):
+    """Write the sorted index of a closed segment of num_lines lines,
+    merging its runs and postings and indexing any lines they don't cover
+    from the file returned by open_segment(). Then remove the runs and
+    postings.
+    """
+    sorted_path = _sorted_path(segment_path)
+    chunks_path = _chunks_path(segment_path)
+
+    if not os.path.isfile(sorted_path):
+        runs = _list_runs(segment_path)
+        offset, indexed = runs[-1][:2] if runs else (0, 0)
+        builder = _RunBuilder(segment_path, indexed)
+        for postings, indexed, offset in _read_batches(chunks_path, offset):
+            builder.add(postings, indexed, offset)
+        builder.write_run(offset)
+
+        if builder.num_lines < num_lines:
+            f = open_segment()
+            try:
+                lines = itertools.islice(f, builder.num_lines, num_lines)
+                for line_number, line in enumerate(lines, builder.num_lines):
+                    builder.add([(token, str(line_number))
+                                 for token in tokenize(line)],
+                                line_number + 1, offset)
+            finally:
+                f.close()
+            builder.write_run(offset)
+
+        # Runs cover consecutive lines, so merging them by token then run
+        # keeps each token's line numbers in order
+        merged = heapq.merge(*[_read_run(number, path) for number, (_, _, path)
+                               in enumerate(_list_runs(segment_path))])
+        temp_path = '%s.%d.tmp' % (sorted_path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            for token, postings in itertools.groupby(merged,
+                                                     lambda p: p[0]):
+                f.write('%s\t%s\n' % (token, ','.join(
+                    line_numbers for _, _, line_numbers in postings)))
+        os.rename(temp_path, sorted_path)
+
+    for _, _, path in _list_runs(segment_path):
+        os.remove(path)
+    if os.path.exists(chunks_path):
+        os.remove(chunks_path)
+
+
+def _lookup_sorted(index_map, size, token):
+    """Binary search a sorted index for a token's line numbers."""
+    low, high = 0, size
+    while low < high:
+        middle = (low + high) // 2
+        # Find the start of the line containing the middle byte
+        start = index_map.rfind('\n', 0, middle) + 1
+        end = index_map.find('\n', start)
+        tab = index_map.find('\t', start, end)
+        line_token = index_map[start:tab]
+        if line_token == token:
+            return [int(n) for n in index_map[tab + 1:end].split(',')]
+        elif line_token < token:
+            low = end + 1
+        else:
+            high = start
+    return []
+
+
+def _map(path):
+    """Return (mmap, size) of a sorted index, with '' for an empty one."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        index_map = (mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                     if size else '')
+    return index_map, size
+
+
+def _get_sealed_postings(sorted_path, tokens):
+    if sorted_path in _sorted_indexes:
+        _sorted_indexes[sorted_path] = _sorted_indexes.pop(sorted_path)
+    else:
+        _sorted_indexes[sorted_path] = _map(sorted_path)
+        if len(_sorted_indexes) > _MAX_MAPPED_INDEXES:
+            # Unmapped once no search is still using it
+            _sorted_indexes.popitem(last=False)
+
+    index_map, size = _sorted_indexes[sorted_path]
+    return dict((token, set(_lookup_sorted(index_map, size, token)))
+                for token in tokens)
+
+
+def _get_unsealed_postings(segment_path, tokens):
+    postings = dict((token, set()) for token in tokens)
+
+    offset = 0
+    for offset, _, path in _list_runs(segment_path):
+        index_map, size = _map(path)
+        try:
+            for token in tokens:
+                postings[token].update(_lookup_sorted(index_map, size, token))
+        finally:
+            if size:
+                index_map.close()
+
+    for batch, _, _ in _read_batches(_chunks_path(segment_path), offset):
+        for token, line_numbers in batch:
+            if token in postings:
+                postings[token].update(int(n)
+                                       for n in line_numbers.split(','))
+    return postings
+
+
+def _get_postings(log, segment, tokens):
+    """Return a dict of each token to the set of lines of the segment
+    containing it.
+    """
+    segment_path = os.path.join(log.log_dir, segment['name'])
+    sorted_path = _sorted_path(segment_path)
+
+    postings = None
+    for _ in xrange(2):
+        if sorted_path in _sorted_indexes or os.path.isfile(sorted_path):
+            return _get_sealed_postings(sorted_path, tokens)
+        try:
+            postings = _get_unsealed_postings(segment_path, tokens)
+        except (IOError, OSError):
+            continue  # Most likely sealed while we read; look again
+        if not os.path.isfile(sorted_path):
+            break  # Otherwise we may have missed the runs written to seal it
+
+    if postings is None:
+        raise IOError("Couldn't read the search index of %s" % segment_path)
+    return postings
+
+
+def search(log, query, limit=20):
+    """Return the numbers of up to limit lines of the DeployLog log that
+    contain every token in query, newest first.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+
+    matches = []
+    for segment in reversed(log.segments()):
+        postings = _get_postings(log, segment, tokens)
+        lines = set.intersection(*postings.values())
+
+        for line in sorted(lines, reverse=True):
+            if line < segment['num_lines']:
+                matches.append(segment['first_line'] + line)
+                if len(matches) >= limit:
+                    return matches
+
+    return matches
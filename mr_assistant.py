@@ -1,97 +1,285 @@
 #!/usr/bin/env python
 
-"""Mr Deploy's office assistant. Controls the execution of Mr Deploy and relays
-messages via Redis Pub/Sub.
+"""Mr Deploy's office assistant. Controls the execution of Mr Deploy, logs her
+output to disk and relays messages via Redis Pub/Sub.
+
+There's a Mr Deploy for each deploy target (see deploy_targets.py), each
+with her own output channel, status and log.
 """
 
 import json
+import os
+import select
+import signal
 import subprocess
+import sys
 import threading
 import time
 
 import redis
 
+import assistant_status
+import deploy_log
+import deploy_targets
+import notifications
+import output_ring
+import redis_connection
+import sampling_profiler
+
+
+red = redis_connection.connect()
+
+# Output is read from Mr Deploy in chunks of up to this many bytes, and
+# published to Redis in batches of up to PUBLISH_BATCH_LINES lines, held back
+# at most PUBLISH_BATCH_SECS waiting for more lines to batch with.
+READ_CHUNK_BYTES = 64 * 1024
+PUBLISH_BATCH_LINES = 500
+PUBLISH_BATCH_SECS = 0.005
+
+# mr_deploy.py options naming one target's remote or working copy, which
+# deploy_targets.json sets per target when there are several
+PER_TARGET_OPTIONS = ['--clone_url', '--repo_dir']
+
+# Seconds Mr Deploy gets to exit after being asked to stop before she's killed
+STOP_TIMEOUT_SECS = 10
+
+# Whether we're profiling, for the dashboard
+PROFILING_KEY = 'mr_deploy_profiling'
+
+
+def read_line_batches(fd, max_lines=PUBLISH_BATCH_LINES,
+                      max_wait_secs=PUBLISH_BATCH_SECS):
+    """Read the file descriptor fd until EOF, yielding lists of the complete
+    lines read (each with its trailing newline). A batch is yielded once it
+    has max_lines lines or its first line is max_wait_secs old. Any final
+    unterminated line is yielded as is.
+    """
+    partial = []  # Pieces of the line currently being read
+    batch = []
+    deadline = None
+
+    while True:
+        timeout = None if deadline is None else max(0, deadline - time.time())
+        readable, _, _ = select.select([fd], [], [], timeout)
+        if not readable:
+            yield batch
+            batch, deadline = [], None
+            continue
+
+        data = os.read(fd, READ_CHUNK_BYTES)
+        if not data:
+            break
+
+        pieces = data.split('\n')
+        if len(pieces) > 1:
+            partial.append(pieces[0])
+            pieces[0] = ''.join(partial)
+            partial = [pieces.pop()]
+            batch.extend(piece + '\n' for piece in pieces)
+        else:
+            partial.append(data)
+
+        if batch and deadline is None:
+            deadline = time.time() + max_wait_secs
+        if len(batch) >= max_lines:
+            yield batch
+            batch, deadline = [], None
 
-red = redis.StrictRedis()
+    last_line = ''.join(partial)
+    if last_line:
+        batch.append(last_line)
+    if batch:
+        yield batch
 
 
 class MrDeploy(object):
-    """Class wrapper to control the running of Mr Deploy via a subprocess.
-    Asks Redis for commands and streams deploy output to Redis Pub/Sub.
+    """Class wrapper to control the running of the Mr Deploy of one deploy
+    target via a subprocess. Writes deploy output to the target's deploy log
+    and streams it to Redis Pub/Sub.
     """
 
-    def __init__(self, output_channel, status_channel):
+    def __init__(self, target, status, args=()):
+        self.target = target
+        self.status = status  # Our assistant_status.StatusPublisher
+        self.args = list(args)
         self.proc = None
-        self.output_channel = output_channel
-        self.status_channel = status_channel
-
-        threading.Thread(target=self._log_to_file).start()
+        self.standby = None
+        self.profiling = False
+        self.output_channel = target.key('mr_deploy_output')
+        self.status_channel = target.key('mr_deploy_status')
+        self.running_key = target.key('mr_deploy_running')
+        self.log_writer = deploy_log.DeployLogWriter(
+            target.path(deploy_log.LOG_DIR))
 
     def is_running(self):
         return self.proc and self.proc.poll() is None
 
     def _set_running(self, status):
         json_status = json.dumps(status)
-        red.set('mr_deploy_running', json_status)
+        red.set(self.running_key, json_status)
         red.publish(self.status_channel, json_status)
+        self.status.set_running(self.target.name, status)
+
+    def _spawn(self):
+        """Start a Mr Deploy process that waits on stdin to be activated.
+        It gets its own process group so that stopping it can take any
+        commands it's running along with it.
+        """
+        return subprocess.Popen(
+            ["python", "-u", "mr_deploy.py", "--standby",
+                "--target", self.target.name] + self.args,
+            shell=False,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            preexec_fn=os.setsid,
+        )
+
+    def _spawn_standby(self):
+        if self.standby is None or self.standby.poll() is not None:
+            self.standby = self._spawn()
 
     def start(self):
         if self.is_running():
             print "Mr Deploy already running; stop first."
             return
 
-        self.proc = subprocess.Popen(
-            ["python", "-u", "mr_deploy.py"],
-            shell=False,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            bufsize=1,  # buffer by line
-        )
+        requested_at = time.time()
+        how = 'warm'
+        if self.standby is None or self.standby.poll() is not None:
+            self.standby, how = self._spawn(), 'cold'
+        self.proc, self.standby = self.standby, None
+
+        # She may still be starting up, so rather than signal her to start
+        # profiling we tell her to, once she's ready
+        self.proc.stdin.write('go %f %s%s\n' % (
+            requested_at, how, ' profile' if self.profiling else ''))
+        self.proc.stdin.close()
 
         self._set_running(True)
 
-        threading.Thread(target=self._publish_stream).start()
-        threading.Thread(target=self._update_status).start()
+        threading.Thread(target=self._publish_stream,
+                         args=(self.proc,)).start()
+        threading.Thread(target=self._update_status,
+                         args=(self.proc,)).start()
+
+        # Have the next one ready and waiting
+        self._spawn_standby()
 
     def stop(self):
+        """Ask Mr Deploy to stop, giving her STOP_TIMEOUT_SECS to finish up
+        before killing her and anything she's still running.
+        """
+        if not self.is_running():
+            return
+
+        self.proc.terminate()
+        deadline = time.time() + STOP_TIMEOUT_SECS
+        while self.proc.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+
+        if self.proc.poll() is None:
+            print "Mr Deploy didn't stop in %ds; killing her." % (
+                STOP_TIMEOUT_SECS)
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass  # Nothing left in her process group
+        self.proc.wait()
+
+    def _signal_proc(self, sig):
+        """Send sig to Mr Deploy herself, not the commands she's running."""
         if self.is_running():
-            self.proc.terminate()
-            self.proc.wait()
+            try:
+                self.proc.send_signal(sig)
+            except OSError:
+                pass  # Just exited
+
+    def set_profiling(self, profiling):
+        """Start or stop profiling Mr Deploy, including any Mr Deploy started
+        while profiling.
+        """
+        self.profiling = profiling
+        self._signal_proc(signal.SIGUSR1 if profiling else signal.SIGUSR2)
 
     def restart(self):
         self.stop()
-        time.sleep(1)
         self.start()
 
-    def _update_status(self):
-        self.proc.wait()
-        self._set_running(False)
+    def _update_status(self, proc):
+        proc.wait()
+        if proc is self.proc:
+            self._set_running(False)
 
-    def _publish_stream(self):
-        """Continuously publishes to Redis mr_deploy's output. Intended to be
-        run in a separate thread.
+    def _publish_stream(self, proc):
+        """Continuously writes mr_deploy's output to the deploy log and
+        publishes it to Redis, in batches of lines per round trip. Intended to
+        be run in a separate thread.
         """
-        while self.is_running():
-            line = ""
-            for data in self.proc.stdout.readline():
-                line += data
-                if not data:
-                    break
+        for lines in read_line_batches(proc.stdout.fileno()):
+            self.log_writer.write(lines)
+            try:
+                output_ring.append(red, self.output_channel, lines)
+            except redis.RedisError as e:
+                # The lines are safely logged; live viewers will just miss
+                # them until Redis comes back.
+                print "Failed to publish output: %s" % e
 
-            if line:
-                red.publish(self.output_channel, line)
 
-    def _log_to_file(self):
-        pubsub = red.pubsub()
-        pubsub.subscribe(self.output_channel)
+class MrDeployPool(object):
+    """The Mr Deploys of all the deploy targets, run side by side. Asks
+    Redis for commands for them.
+    """
+
+    def __init__(self, targets, args=()):
+        self.status = assistant_status.StatusPublisher(red, targets)
+        self.workers = [MrDeploy(target, self.status, args)
+                        for target in targets]
+        self.profiler = sampling_profiler.SamplingProfiler('mr_assistant')
+        red.set(PROFILING_KEY, json.dumps(False))
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
 
-        BY_LINE = 1
-        with open('log/mr_deploy.log', 'a+', buffering=BY_LINE) as log_file:
-            for item in pubsub.listen():
-                if item['type'] == 'message':
-                    log_file.write(item['data'])
+    def stop(self):
+        """Stop all the Mr Deploys at once."""
+        stoppers = [threading.Thread(target=worker.stop)
+                    for worker in self.workers]
+        for stopper in stoppers:
+            stopper.start()
+        for stopper in stoppers:
+            stopper.join()
+
+    def close(self):
+        self.status.publish_down()
+        self.profiler.stop()
+        for worker in self.workers:
+            worker.log_writer.close()
+
+    def set_profiling(self, profiling):
+        """Start or stop profiling us and all the Mr Deploys. Stopping has
+        each write out their profile.
+        """
+        if profiling:
+            self.profiler.start()
+        for worker in self.workers:
+            worker.set_profiling(profiling)
+        if not profiling:
+            self.profiler.stop()
+        red.set(PROFILING_KEY, json.dumps(profiling))
+
+    def _get_workers(self, target_name):
+        if target_name is None:
+            return self.workers
+        return [worker for worker in self.workers
+                if worker.target.name == target_name]
 
     def subscribe(self, channel):
+        """Carry out commands on channel: "profile start" or "profile stop",
+        or "start", "restart" or "stop" followed by the name of the target
+        to apply it to, or by nothing to apply it to all.
+        """
         pubsub = red.pubsub()
         pubsub.subscribe(channel)
 
@@ -99,20 +287,61 @@ class MrDeploy(object):
             if item['type'] == 'message':
                 cmd = item['data']
                 print 'Received command %s' % cmd
-                if cmd == "start":
-                    self.start()
-                elif cmd == "restart":
-                    self.restart()
-                elif cmd == "stop":
-                    self.stop()
-                else:
+                if cmd == "profile start":
+                    self.set_profiling(True)
+                    continue
+                elif cmd == "profile stop":
+                    self.set_profiling(False)
+                    continue
+
+                action, _, target_name = cmd.partition(" ")
+                workers = self._get_workers(target_name or None)
+                if action not in ("start", "restart", "stop"):
                     print "Unknown command. Ignoring."
+                elif not workers:
+                    print "Unknown deploy target. Ignoring."
+                else:
+                    for worker in workers:
+                        getattr(worker, action)()
 
 
 def main():
-    mr_deploy = MrDeploy('mr_deploy_output', 'mr_deploy_status')
-    mr_deploy.start()
-    mr_deploy.subscribe('mr_deploy_commands')
+    # Any arguments are passed on to every mr_deploy.py, so mustn't be ones
+    # that only make sense for one target
+    targets = deploy_targets.load()
+    args = sys.argv[1:]
+    if len(targets) > 1:
+        for option in PER_TARGET_OPTIONS:
+            if any(arg == option or arg.startswith(option + '=')
+                   for arg in args):
+                sys.exit("%s would apply to every deploy target; set it "
+                         "per target in %s instead" % (
+                             option, deploy_targets.CONFIG_PATH))
+
+    # Send Mr Deploy's HipChat notifications in the background, so they
+    # survive her being stopped or restarted
+    notifier = threading.Thread(
+        target=notifications.NotificationWorker(red).run)
+    notifier.daemon = True
+    notifier.start()
+
+    pool = MrDeployPool(targets, args)
+
+    # Let the servers know we're alive, and what the Mr Deploys are up to
+    heartbeat = threading.Thread(target=pool.status.run)
+    heartbeat.daemon = True
+    heartbeat.start()
+
+    # Mr Deploys run in their own process groups, so stop them ourselves
+    def stop_and_exit(signum, frame):
+        pool.stop()
+        pool.close()
+        sys.exit(0)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, stop_and_exit)
+
+    pool.start()
+    pool.subscribe('mr_deploy_commands')
 
 
 if __name__ == "__main__":
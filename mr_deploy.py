@@ -2,105 +2,647 @@
 
 """Continuous deploy script: deploys a staging version of Khan Academy whenever
 a changeset is pushed to the website stable repository.
+
+Each Mr Deploy deploys one target (see deploy_targets.py), by default master
+to staging. Mr Assistant runs one for each target configured.
 """
 
 # TODO(david): Integrate with Jenkins: only deploy when all tests pass, or just
 #     run make allcheck
 # TODO(david): Proper logging with timestamps.
 
+import signal
+
+# Mr Assistant starts and stops our profiler with SIGUSR1 and SIGUSR2 (see
+# main()), whose default is to kill us. Until we're ready for them, e.g.
+# while importing, ignore them.
+signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+import collections
+import contextlib
+import fcntl
+import fnmatch
+import glob
+import hashlib
+import itertools
+import json
+import multiprocessing
 import optparse
 import os
-import signal
+import random
+import re
 import shutil
+import sqlite3
 import subprocess
 import sys
+import threading
 import time
 
-import hipchat.config
-import hipchat.room
-
+import redis
+
+import build_cache
+import changeset_cache
+import deploy_history
+import deploy_log
+import deploy_metrics
+import deploy_targets
+import hg_cmdserver
+import notifications
+import redis_connection
+import sampling_profiler
 import secrets
 
-hipchat.config.token = secrets.hipchat_token
 
+# We check for new changesets as soon as we hear of a push on TRIGGER_CHANNEL
+# (see /deploy/hook in server.py), but also poll in case we missed one. See
+# PollScheduler for how often.
+TRIGGER_CHANNEL = 'mr_deploy_triggers'
+
+# Pushes arriving within this many seconds of each other are deployed
+# together, but we won't hold off deploying for more than MAX_DEBOUNCE_SECS.
+DEBOUNCE_SECS = 10
+MAX_DEBOUNCE_SECS = 60
 
-POLL_INVERVAL_SECS = 15
 REPO_NAME = "webapp"
 REPO_DIR = os.path.join(os.path.dirname(__file__), REPO_NAME)
+# A pristine copy of the repository's history with no working copy, which we
+# pull into from CLONE_URL and then clone or pull REPO_DIR from. Local clones
+# hardlink history, so rebuilding REPO_DIR from here is quick.
+MIRROR_DIR = REPO_DIR + ".mirror"
 CLONE_URL = "https://khanacademy.kilnhg.com/Code/Website/Group/%s" % REPO_NAME
 
-# The number of Kiln errors we must see before reporting them
-KILN_ERROR_THRESHOLD = 25
+# What we're deploying: the branch (or bookmark) BRANCH to the App Engine
+# version VERSION, as set by main() for the target we're run for
+target = deploy_targets.DeployTarget(deploy_targets.DEFAULT_TARGET)
+BRANCH = target.branch
+VERSION = target.version
+
+# Where we remember the changeset last deployed to VERSION
+VERSION_FILE = '%s.version.txt' % target.name
+
+# Where we remember the head of BRANCH at CLONE_URL when there was last
+# nothing incoming (see get_incoming_changes())
+REMOTE_HEAD_FILE = '%s.remote_head.txt' % target.name
+
+# Held while we're working on a target, so that there's only ever one Mr
+# Deploy per target
+TARGET_LOCK_FILE = '%s.lock' % target.name
+
+# Most `make install_deps` and deploy script runs, which are heavy, at once
+# across the Mr Deploys of all targets. Each run holds one of the lock files
+# BUILD_SLOT_LOCK_FILE % 0 to BUILD_SLOTS - 1.
+BUILD_SLOTS = multiprocessing.cpu_count()
+BUILD_SLOT_LOCK_FILE = 'build_slot.%d.lock'
+
+# The number of Kiln errors in a row we must see before reporting them
+KILN_ERROR_THRESHOLD = 5
+
+# We refuse to deploy changes to files matching these patterns (as for
+# fnmatch, so "*" also matches "/"), since they affect every version at once
+DANGEROUS_FILE_PATTERNS = ["index.yaml"]
+DANGEROUS_FILE_RE = re.compile(
+    "|".join(fnmatch.translate(pattern)
+             for pattern in DANGEROUS_FILE_PATTERNS))
+
+# Most changesets to ask hg about in one command
+HG_LOG_BATCH_SIZE = 200
+
+# Where we remember the fingerprint of the dependencies we last installed
+# successfully, along with stats on how often that let us skip installing.
+# `make install_deps` installs into the box's site-packages, shared by the Mr
+# Deploys of all targets, so they share this too, and only install while
+# holding DEPS_LOCK_FILE.
+DEPS_CACHE_FILE = 'deps.fingerprint.json'
+DEPS_LOCK_FILE = 'install_deps.lock'
+
+# Files in the repository that `make install_deps` installs from. The rule for
+# install_deps in the Makefile, and those of its prerequisites, are
+# fingerprinted too.
+DEPENDENCY_FILE_PATTERNS = [
+    "requirements*.txt",
+    "*/requirements*.txt",
+    "package.json",
+    "npm-shrinkwrap.json",
+]
+
+# Outputs of the deploy script's build (e.g. compressed JavaScript), which
+# it reuses rather than rebuilds if they're already in the working copy. We
+# restore those whose inputs are unchanged from build_outputs_cache before
+# each deploy. Set by main() from build_cache.CONFIG_PATH.
+BUILD_OUTPUTS = []
+build_outputs_cache = build_cache.BuildCache()
 
 last_version_attempted = None
 
-# Keeps track of how frequently we see errors when talking to Kiln
-count_of_kiln_errors = 0
+# Runs the hg queries made every poll without starting a new hg each time
+hg = hg_cmdserver.HgCommandServer(REPO_DIR)
+
+red = redis_connection.connect()
+
+# Started and stopped by Mr Assistant, with SIGUSR1 and SIGUSR2
+profiler = sampling_profiler.SamplingProfiler('mr_deploy')
+
+
+class PollScheduler(object):
+    """Decides how long to wait before polling for new changesets again.
+
+    Right after seeing changes we poll every MIN_INTERVAL_SECS. While nothing
+    happens the interval grows by IDLE_BACKOFF each poll, up to
+    MAX_IDLE_INTERVAL_SECS, and while Kiln keeps failing it doubles each
+    poll, up to MAX_FAILURE_INTERVAL_SECS. Each wait is randomly jittered by
+    up to JITTER of the interval.
+
+    The scheduler's state is kept in Redis under STATE_KEY for the dashboard.
+    """
+
+    MIN_INTERVAL_SECS = 15
+    MAX_IDLE_INTERVAL_SECS = 300
+    MAX_FAILURE_INTERVAL_SECS = 600
+    IDLE_BACKOFF = 1.5
+    JITTER = 0.1
+    STATE_KEY = 'mr_deploy_scheduler'
+
+    def __init__(self):
+        self.interval = self.MIN_INTERVAL_SECS
+        self.consecutive_failures = 0
+        self.next_poll_at = None
+
+    def record_activity(self):
+        """There were new changesets."""
+        self.interval = self.MIN_INTERVAL_SECS
+        self.consecutive_failures = 0
+
+    def record_idle(self):
+        """There was nothing new."""
+        self.interval = min(self.interval * self.IDLE_BACKOFF,
+                            self.MAX_IDLE_INTERVAL_SECS)
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        """We couldn't reach Kiln."""
+        self.consecutive_failures += 1
+        self.interval = min(
+            self.MIN_INTERVAL_SECS * 2 ** self.consecutive_failures,
+            self.MAX_FAILURE_INTERVAL_SECS)
+
+    def next_delay(self):
+        """Return the number of seconds to wait until the next poll."""
+        delay = self.interval * random.uniform(1 - self.JITTER,
+                                               1 + self.JITTER)
+        self.next_poll_at = time.time() + delay
+        self._save_state()
+        return delay
+
+    def _save_state(self):
+        try:
+            red.set(self.STATE_KEY, json.dumps({
+                'interval': self.interval,
+                'consecutive_failures': self.consecutive_failures,
+                'next_poll_at': self.next_poll_at,
+            }))
+        except redis.RedisError as e:
+            print "Couldn't save poll scheduler state: %s" % e
+
+
+scheduler = PollScheduler()
+
+
+class PushTrigger(object):
+    """Listens for pushes announced on a Redis channel, so the poll loop can
+    wake up for them.
+    """
+
+    # Seconds to wait before resubscribing after losing the Redis connection
+    RECONNECT_DELAY_SECS = 5
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.pushed = threading.Event()
+
+        listener = threading.Thread(target=self._listen)
+        listener.daemon = True
+        listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = red.pubsub()
+                pubsub.subscribe(self.channel)
+                for item in pubsub.listen():
+                    if item['type'] == 'message':
+                        self.pushed.set()
+            except redis.ConnectionError as e:
+                print "Lost Redis connection listening for pushes: %s" % e
+                time.sleep(self.RECONNECT_DELAY_SECS)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for a push, returning whether there
+        was one. After a push, keep waiting until there have been no more for
+        DEBOUNCE_SECS so that a burst of pushes is handled at once.
+        """
+        if not self.pushed.wait(timeout):
+            return False
+        self.pushed.clear()
+
+        deadline = time.time() + MAX_DEBOUNCE_SECS
+        while time.time() < deadline:
+            if not self.pushed.wait(min(DEBOUNCE_SECS,
+                                        deadline - time.time())):
+                break
+            self.pushed.clear()
+
+        return True
 
 
 def get_last_deployed():
-    """Return the last deployed staging version, as stored in
-    staging.version.txt. If the file is missing, return None.
+    """Return the changeset last deployed to VERSION, as stored in
+    VERSION_FILE. If the file is missing, return None.
     """
-    if not os.path.isfile('staging.version.txt'):
+    if not os.path.isfile(VERSION_FILE):
         return None
 
-    with open('staging.version.txt', 'r') as f:
+    with open(VERSION_FILE, 'r') as f:
         return f.read()
 
 
 def set_last_deployed(changeset):
-    """Set the last deployed staging version in staging.version.txt."""
-    with open('staging.version.txt', 'w') as f:
+    """Set the changeset last deployed to VERSION in VERSION_FILE."""
+    with open(VERSION_FILE, 'w') as f:
         f.write(changeset)
 
 
-def get_incoming_changes():
-    """Returns a string of incoming changesets, or None if no new changes."""
-    global count_of_kiln_errors
+def _open_lock_file(path):
+    f = open(path, 'a')
+    # Commands we start mustn't hold on to our locks
+    fcntl.fcntl(f, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    return f
+
+
+_target_lock_file = None
+
+
+def lock_target():
+    """Take TARGET_LOCK_FILE, waiting for any other Mr Deploy of our target
+    to exit first. The lock is held until we exit.
+    """
+    global _target_lock_file
+    lock_file = _target_lock_file = _open_lock_file(TARGET_LOCK_FILE)
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        print "Waiting for another Mr Deploy of %s to exit" % target.name
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+
+@contextlib.contextmanager
+def build_slot():
+    """Hold one of the BUILD_SLOTS build slots, waiting for one to come free
+    if need be. Raises deploy_metrics.Cancelled if cancel_commands() is
+    called while waiting.
+    """
+    waiting = False
+    while True:
+        for slot in xrange(BUILD_SLOTS):
+            lock_file = _open_lock_file(BUILD_SLOT_LOCK_FILE % slot)
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lock_file.close()
+                continue
+
+            try:
+                yield
+            finally:
+                lock_file.close()
+            return
+
+        if _cancelling.is_set():
+            raise deploy_metrics.Cancelled("Cancelled waiting for a build "
+                                           "slot")
+        if not waiting:
+            print "Waiting for one of %d build slots to come free" % (
+                BUILD_SLOTS)
+            waiting = True
+        time.sleep(1)
+
+
+def _get_makefile_rules(makefile_text, target, rules=None):
+    """Return a dict of the text of the Makefile rule for target and,
+    recursively, those for its prerequisites, keyed by target name.
+    """
+    if rules is None:
+        rules = {}
+
+    lines = makefile_text.splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith(target + ':'):
+            rule = [line]
+            rule.extend(l for l in itertools.takewhile(
+                lambda l: l.startswith('\t'), lines[i + 1:]))
+            rules[target] = '\n'.join(rule)
+
+            for prerequisite in line.split(':', 1)[1].split():
+                if prerequisite not in rules:
+                    _get_makefile_rules(makefile_text, prerequisite, rules)
+            break
+
+    return rules
+
+
+def get_deps_fingerprint():
+    """Return a hash of everything `make install_deps` depends on in the
+    repository's working copy. Without a Makefile, that's just the files
+    matching DEPENDENCY_FILE_PATTERNS.
+    """
+    fingerprint = hashlib.sha1()
+
+    paths = set()
+    for pattern in DEPENDENCY_FILE_PATTERNS:
+        paths.update(glob.glob(os.path.join(REPO_DIR, pattern)))
+    for path in sorted(paths):
+        fingerprint.update(os.path.relpath(path, REPO_DIR) + '\0')
+        with open(path, 'rb') as f:
+            fingerprint.update(hashlib.sha1(f.read()).hexdigest())
+
+    makefile_path = os.path.join(REPO_DIR, 'Makefile')
+    rules = {}
+    if os.path.isfile(makefile_path):
+        with open(makefile_path) as f:
+            rules = _get_makefile_rules(f.read(), 'install_deps')
+    for target in sorted(rules):
+        fingerprint.update('\0' + rules[target])
 
+    return fingerprint.hexdigest()
+
+
+# Commands run by check_call(), so that cancel_commands() can stop them
+_commands = set()
+_commands_lock = threading.Lock()
+_cancelling = threading.Event()
+
+
+def check_call(args, **kwargs):
+    """Like subprocess.check_call(), but raises deploy_metrics.Cancelled if
+    the command is stopped by cancel_commands() from another thread.
+    """
+    proc = subprocess.Popen(args, **kwargs)
+    with _commands_lock:
+        _commands.add(proc)
+        if _cancelling.is_set():
+            proc.terminate()
+    try:
+        returncode = proc.wait()
+    finally:
+        with _commands_lock:
+            _commands.discard(proc)
+
+    if _cancelling.is_set():
+        raise deploy_metrics.Cancelled("%s was cancelled" % " ".join(args))
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, args)
+
+
+def cancel_commands():
+    """Stop all commands being run by check_call(), and any it's asked to
+    run until reset_commands() is called.
+    """
+    with _commands_lock:
+        _cancelling.set()
+        for proc in _commands:
+            try:
+                proc.terminate()
+            except OSError:
+                pass  # Already exited
+
+
+def reset_commands():
+    _cancelling.clear()
+
+
+@contextlib.contextmanager
+def deps_lock():
+    """Hold DEPS_LOCK_FILE, waiting for any other Mr Deploy installing
+    dependencies to finish first. Raises deploy_metrics.Cancelled if
+    cancel_commands() is called while waiting.
+    """
+    lock_file = _open_lock_file(DEPS_LOCK_FILE)
+    try:
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError:
+                pass
+
+            if _cancelling.is_set():
+                raise deploy_metrics.Cancelled("Cancelled waiting to install "
+                                               "dependencies")
+            if not waiting:
+                print ("Waiting for another Mr Deploy to finish installing "
+                       "dependencies")
+                waiting = True
+            time.sleep(1)
+
+        yield
+    finally:
+        lock_file.close()
+
+
+def load_deps_cache():
+    if not os.path.isfile(DEPS_CACHE_FILE):
+        return {'fingerprint': None, 'install_secs': 0,
+                'num_skipped': 0, 'secs_saved': 0}
+
+    with open(DEPS_CACHE_FILE) as f:
+        return json.load(f)
+
+
+def save_deps_cache(cache):
+    with open(DEPS_CACHE_FILE + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.rename(DEPS_CACHE_FILE + '.tmp', DEPS_CACHE_FILE)
+
+
+def install_deps():
+    """Run `make install_deps`, unless what it would install is what's
+    installed already, by the Mr Deploy of this or any other target.
+    """
+    fingerprint = get_deps_fingerprint()
+    with deps_lock():
+        cache = load_deps_cache()
+
+        if fingerprint == cache['fingerprint']:
+            cache['num_skipped'] += 1
+            cache['secs_saved'] += cache['install_secs']
+            save_deps_cache(cache)
+            print ("Dependencies unchanged; skipping make install_deps. "
+                   "Skipped %d times so far, saving about %ds." % (
+                       cache['num_skipped'], cache['secs_saved']))
+            return
+
+        # Whatever was installed won't be once we start
+        cache['fingerprint'] = None
+        save_deps_cache(cache)
+
+        start = time.time()
+        # TODO(david): sudo needed because not using virtualenv on EC2.
+        #     Fix it.
+        with build_slot():
+            check_call(["sudo", "make", "install_deps"], cwd=REPO_DIR)
+
+        cache['fingerprint'] = fingerprint
+        cache['install_secs'] = time.time() - start
+        save_deps_cache(cache)
+        print "Installed dependencies in %ds" % cache['install_secs']
+
+
+def restore_build_outputs(changeset):
+    """Restore each of BUILD_OUTPUTS built before from the same inputs as at
+    changeset into the working copy, and remove the rest so the deploy
+    script builds them afresh. Returns a dict of the keys of those removed
+    by path, to save with save_build_outputs() once built.
+    """
+    if not BUILD_OUTPUTS:
+        return {}
+
+    manifest = build_cache.parse_manifest(hg.check_output([
+        "manifest", "--debug", "-r", changeset,
+    ]))
+
+    unbuilt = {}
+    for output in BUILD_OUTPUTS:
+        start = time.time()
+        key = output.get_key(manifest)
+        try:
+            hit = build_outputs_cache.restore(
+                key, os.path.join(REPO_DIR, output.path))
+        except (IOError, OSError, shutil.Error, sqlite3.Error) as e:
+            print "Couldn't restore %s from the build cache: %s" % (
+                output.path, e)
+            hit = False
+        record_timing('build_output_restore', 'hit' if hit else 'miss',
+                      time.time() - start)
+        if not hit:
+            unbuilt[output.path] = key
+
+    num_hits = len(BUILD_OUTPUTS) - len(unbuilt)
+    print "Restored %d of %d build outputs from the cache (%d%%)%s" % (
+        num_hits, len(BUILD_OUTPUTS), 100 * num_hits / len(BUILD_OUTPUTS),
+        "; to build: %s" % ", ".join(sorted(unbuilt)) if unbuilt else "")
+    return unbuilt
+
+
+def save_build_outputs(unbuilt):
+    """Cache the outputs the deploy script built, given the dict returned
+    by restore_build_outputs(). Never raises, so caching can't change the
+    outcome of a deploy.
+    """
+    for path, key in sorted(unbuilt.iteritems()):
+        src = os.path.join(REPO_DIR, path)
+        if not os.path.lexists(src):
+            print "The deploy script didn't build %s; not caching it" % path
+            continue
+        try:
+            if not build_outputs_cache.store(key, src):
+                print "%s is bigger than the whole build cache" % path
+        except (IOError, OSError, shutil.Error, sqlite3.Error) as e:
+            print "Couldn't save %s to the build cache: %s" % (path, e)
+
+
+def get_remote_head():
+    """Return the short node id of BRANCH at CLONE_URL. Takes one round
+    trip to the remote, with no discovery of what changesets we're missing.
+    """
+    output = hg.check_output([
+        "identify", "--id", "-r", BRANCH, CLONE_URL,
+    ])
+    # The id is all hg prints, on the last line
+    return output.splitlines()[-1].strip()
+
+
+def get_last_seen_head():
+    """Return the remote head recorded by set_last_seen_head(), or None."""
+    if not os.path.isfile(REMOTE_HEAD_FILE):
+        return None
+
+    with open(REMOTE_HEAD_FILE) as f:
+        return f.read()
+
+
+def set_last_seen_head(node):
+    """Record that there was nothing incoming while the remote head of
+    BRANCH was node.
+    """
+    with open(REMOTE_HEAD_FILE, 'w') as f:
+        f.write(node)
+
+
+def discover_incoming():
+    """Return the lines `hg incoming` lists for the changesets incoming to
+    BRANCH, oldest first, each starting with the changeset's full node.
+    """
     try:
-        result = subprocess.check_output(["hg", "incoming"], cwd=REPO_DIR)
-        count_of_kiln_errors = 0
-        return result
+        output = hg.check_output([
+            "incoming",
+            "-r", BRANCH,
+            "--template", "{node} {author|person}: {desc|firstline}\n",
+        ])
     except subprocess.CalledProcessError as e:
-        # `hg incoming` will return
-        #   1 if there are no incoming changes, which we ignore
-        #   255 if Kiln is currently down, which we only report over threshold
         if e.returncode == 1:
+            return []  # Nothing incoming
+        raise
+
+    # hg says what it's comparing with first
+    return [line for line in output.splitlines()
+            if re.match(r"^[0-9a-f]{40} ", line)]
+
+
+def get_incoming_changes():
+    """Return the lines describing the changesets incoming to BRANCH, oldest
+    first, each starting with the changeset's full node. Returns None if
+    there are none.
+
+    Nearly every poll finds nothing, so first we just ask for the remote
+    head of BRANCH. Only if that's moved since we last found nothing do we
+    have hg find what's incoming, which takes many more round trips. The
+    number and duration of each are recorded as the remote_probe and
+    incoming_discovery timings of deploy_metrics.
+    """
+    timing, start = 'remote_probe', time.time()
+    try:
+        head = get_remote_head()
+        if head == get_last_seen_head():
+            record_timing(timing, 'unchanged', time.time() - start)
+            scheduler.record_idle()
             return None
+        record_timing(timing, 'changed', time.time() - start)
+
+        timing, start = 'incoming_discovery', time.time()
+        incoming = discover_incoming()
+        record_timing(timing, 'incoming' if incoming else 'none',
+                      time.time() - start)
 
+    except subprocess.CalledProcessError as e:
+        record_timing(timing, 'failed', time.time() - start)
+        # hg will return 255 if Kiln is currently down, which we only report
+        # over threshold
         if e.returncode == 255:
-            if count_of_kiln_errors < KILN_ERROR_THRESHOLD:
-                count_of_kiln_errors += 1
+            scheduler.record_failure()
+            # Report every threshold-crossing
+            if scheduler.consecutive_failures % KILN_ERROR_THRESHOLD:
                 return None
-            else:
-                # Restart the count so we report every threshold-crossing
-                count_of_kiln_errors = 0
 
         raise e
 
+    if not incoming:
+        set_last_seen_head(head)
+        scheduler.record_idle()
+        return None
 
-def get_earliest_incoming():
-    """Get the earliest incoming changeset hash. Will raise
-    subprocess.CalledProcessError if there are no incoming changesets.
-
-    Rant: This function would not be needed and we could just re-use
-    get_last_changeset() if hg supported inclusive/exclusive ranges (which
-    would also allow us to conveniently express the empty range)
-    """
-    output = subprocess.check_output([
-        "hg", "incoming",
-        "-l", "1",
-        "--template", "{node}",
-    ], cwd=REPO_DIR)
-
-    lines = output.split("\n")
-    if len(lines) >= 3 and "searching for changes" in lines[1]:
-        return lines[2]
-    else:
-        raise Exception("Oh crap, getting earliest incoming changeset failed. "
-                "Command output: %s" % output)
+    scheduler.record_activity()
+    return incoming
 
 
 def decrypt_secrets():
@@ -122,63 +664,174 @@ def decrypt_secrets():
     subprocess.check_call(["chmod", "600", "secrets.py"], cwd=REPO_DIR)
 
 
+def _set_hg_paths(repo_dir, **paths):
+    """Set the named paths (e.g. default) in the repository's .hg/hgrc."""
+    with open(os.path.join(repo_dir, ".hg", "hgrc"), "w") as f:
+        f.write("[paths]\n")
+        for name, url in sorted(paths.items()):
+            f.write("%s = %s\n" % (name, url))
+
+
+def update_mirror():
+    """Pull new changesets from CLONE_URL into the local mirror, creating the
+    mirror first if needed.
+    """
+    if os.path.isdir(os.path.join(MIRROR_DIR, ".hg")):
+        print "Updating local mirror %s" % MIRROR_DIR
+        subprocess.check_call(["hg", "pull"], cwd=MIRROR_DIR)
+        return
+
+    if os.path.isdir(os.path.join(REPO_DIR, ".hg")):
+        # Seed the mirror from the history we already have
+        print "Creating local mirror %s from %s" % (MIRROR_DIR, REPO_DIR)
+        subprocess.check_call(["hg", "clone", "--noupdate", REPO_DIR,
+                               MIRROR_DIR])
+        _set_hg_paths(MIRROR_DIR, default=CLONE_URL)
+        subprocess.check_call(["hg", "pull"], cwd=MIRROR_DIR)
+    else:
+        print "Creating local mirror %s of %s" % (MIRROR_DIR, CLONE_URL)
+        subprocess.check_call(["hg", "clone", "--noupdate", CLONE_URL,
+                               MIRROR_DIR])
+
+
 def clone_repo():
-    print "Cloning %s" % CLONE_URL
-    # TODO(david): Clone only latest revision to be faster?
-    subprocess.check_call(["hg", "clone", CLONE_URL])
-    subprocess.check_call(["hg", "update", "master"], cwd=REPO_DIR)
+    """Create the working copy REPO_DIR from the local mirror, creating the
+    mirror first if needed.
+    """
+    hg.close()
+
+    if not os.path.isdir(os.path.join(MIRROR_DIR, ".hg")):
+        update_mirror()
+
+    # The mirror may not have everything up to the remote head we last saw
+    if os.path.isfile(REMOTE_HEAD_FILE):
+        os.remove(REMOTE_HEAD_FILE)
+
+    print "Cloning %s from %s" % (REPO_DIR, MIRROR_DIR)
+    subprocess.check_call(["hg", "clone", "--noupdate", MIRROR_DIR, REPO_DIR])
+
+    # Keep looking for incoming changes at the source rather than the mirror
+    _set_hg_paths(REPO_DIR, default=CLONE_URL, mirror=MIRROR_DIR)
+    subprocess.check_call(["hg", "update", BRANCH], cwd=REPO_DIR)
+
+
+def pull_subrepos():
+    """Pull new changes into each of the working copy's subrepositories, so
+    that updating to a changeset that needs them won't fail.
+    """
+    hgsub_path = os.path.join(REPO_DIR, ".hgsub")
+    if not os.path.isfile(hgsub_path):
+        return
+
+    with open(hgsub_path) as f:
+        for line in f:
+            path, equals, source = line.partition("=")
+            path, source = path.strip(), source.strip()
+            subrepo_dir = os.path.join(REPO_DIR, path)
+            if not equals or not os.path.isdir(subrepo_dir):
+                continue
+
+            print "Pulling subrepository %s" % path
+            if source.startswith("[git]"):
+                subprocess.check_call(["git", "fetch"], cwd=subrepo_dir)
+            elif not source.startswith("["):
+                subprocess.check_call(["hg", "pull"], cwd=subrepo_dir)
 
 
 def update_repo():
-    """Attempt to update the repository by hg pull, but clone if that fails."""
+    """Attempt to update the repository by pulling from the local mirror. If
+    that fails, pull subrepositories and try again, and then fall back to
+    re-cloning from the mirror.
+    """
     print "Updating %s" % REPO_DIR
+
+    # The command server won't notice changes made by these other hg's
+    hg.close()
+
+    update_mirror()
+
     try:
-        subprocess.check_call(["hg", "pull"], cwd=REPO_DIR)
-        subprocess.check_call(["hg", "update", "master"], cwd=REPO_DIR)
+        subprocess.check_call(["hg", "pull", MIRROR_DIR], cwd=REPO_DIR)
+        subprocess.check_call(["hg", "update", BRANCH], cwd=REPO_DIR)
+        return
     except subprocess.CalledProcessError as e:
-        print "hg pull && hg up master failed: %s" % e
-        print "Removing %s and re-cloning" % REPO_DIR
+        print "hg pull && hg up %s failed: %s" % (BRANCH, e)
+
+    try:
+        pull_subrepos()
+        subprocess.check_call(["hg", "update", "--clean", BRANCH],
+                              cwd=REPO_DIR)
+    except subprocess.CalledProcessError as e:
+        print "Pulling subrepositories and updating failed: %s" % e
+        print "Removing %s and re-cloning from %s" % (REPO_DIR, MIRROR_DIR)
 
-        # TODO(david): Try pulling subrepos before falling back to clone.
         shutil.rmtree(REPO_DIR)
         clone_repo()
 
 
-def get_last_changeset():
-    return subprocess.check_output(["hg", "log", "-r", "master", "--template",
-            "{node|short}"], cwd=REPO_DIR)
-
+def get_changesets(revset):
+    """Return (nodes, changesets) for the changesets in revset: a list of
+    their full nodes, oldest first, and a dict by node of each one's author
+    and list of files touched. Only changesets not already in changeset_cache
+    are looked up in full.
+    """
+    nodes = hg.check_output(["log", "-r", revset,
+                             "--template", "{node}\n"]).split()
 
-def get_last_author():
+    try:
+        changesets = changeset_cache.get(nodes)
+    except sqlite3.Error as e:
+        print "Couldn't read changeset cache: %s" % e
+        changesets = {}
+
+    unknown = [node for node in nodes if node not in changesets]
+    looked_up = {}
+    for i in xrange(0, len(unknown), HG_LOG_BATCH_SIZE):
+        output = hg.check_output([
+            "log",
+            "-r", " + ".join(unknown[i:i + HG_LOG_BATCH_SIZE]),
+            "--template", "{node}\t{author|person}\t{files}\n",
+        ])
+        for line in output.splitlines():
+            node, author, files = line.split("\t", 2)
+            looked_up[node] = {'author': author, 'files': files.split()}
+
+    if looked_up:
+        try:
+            changeset_cache.put(looked_up)
+        except sqlite3.Error as e:
+            print "Couldn't update changeset cache: %s" % e
+        changesets.update(looked_up)
+
+    return nodes, changesets
+
+
+def get_last_changeset_and_author():
+    """Return the short hash and author name of the BRANCH changeset."""
     # Not notifying authors for now because it may be annoying. If people
     # request for @mentions, will add that then.
-    return subprocess.check_output([
-        "hg", "log", "-r", "master",
-        "--template", "{author|person}",
-    ], cwd=REPO_DIR)
+    nodes, changesets = get_changesets(BRANCH)
+    return nodes[-1][:12], changesets[nodes[-1]]['author']
 
 
-def get_affected_files(first_changeset, last_changeset='master'):
-    """Get all changed, added, or deleted files between two given changesets,
-    inclusive.
+def get_affected_files(first_changeset, last_changeset=None):
+    """Get all changed, added, or deleted files between two given changesets
+    (the second defaulting to BRANCH), inclusive.
     """
-    files = subprocess.check_output([
-        "hg", "log",
-        "--rev", "%s:%s" % (first_changeset, last_changeset),
-        "--template", "{files} ",
-    ], cwd=REPO_DIR)
-    return set(files.split())
+    last_changeset = last_changeset or BRANCH
+    _, changesets = get_changesets("%s:%s" % (first_changeset, last_changeset))
+    return set(filename for changeset in changesets.itervalues()
+               for filename in changeset['files'])
 
 
 def notify_hipchat(room_id, color, message):
-    # Pure kwargs don't work here because 'from' is a Python keyword...
-    hipchat.room.Room.message(**{
-        'room_id': room_id,
-        'from': 'Mr Deploy',
-        'message': message,
-        'color': color,
-        'message_format': 'text',
-    })
+    """Queue a message for Mr Assistant to send to HipChat. Never raises, so
+    notifying can't change the outcome of a deploy.
+    """
+    try:
+        notifications.enqueue(red, room_id, color, message)
+    except redis.RedisError as e:
+        print "Couldn't queue HipChat notification: %s" % e
 
 
 def notify_abort(room_id):
@@ -186,11 +839,13 @@ def notify_abort(room_id):
             "nap until the devs sort things out. (zzz)")
 
 
-def check_dangerous_files(first_changeset, last_changeset='master',
-                          notify=True):
-    dangerous_files = {"index.yaml"}
-    affected_files = get_affected_files(first_changeset, last_changeset)
-    dangerous_changes = dangerous_files & affected_files
+def check_dangerous_files(affected_files, notify=True):
+    """Return whether any of affected_files (e.g. as returned by
+    get_affected_files()) are too dangerous to deploy, notifying HipChat if
+    so.
+    """
+    dangerous_changes = sorted(filename for filename in affected_files
+                               if DANGEROUS_FILE_RE.match(filename))
 
     if dangerous_changes:
         changes_str = ", ".join(dangerous_changes)
@@ -209,63 +864,213 @@ def check_dangerous_files(first_changeset, last_changeset='master',
     return False
 
 
-def deploy_to_staging(notify=True, force=False):
-    """Deploys stable to a staging version if there are incoming changes.
+class SkipDeploy(Exception):
+    """Raised by a deploy stage when there's nothing new to deploy."""
 
-    notify - Whether to ping 1s and 0s room about success or failure.
-    force - Whether to deploy even if there are no incoming changes.
+
+class DeployPipeline(object):
+    """Runs the stages of a deploy, each in its own thread as soon as the
+    stages it depends on have succeeded, so that independent stages overlap.
+    A stage needed only by later ones (e.g. install_deps, needed only by the
+    deploy itself) thus runs speculatively alongside checks that may yet
+    call the deploy off.
+
+    Once a stage raises, no more are started and the commands others are
+    running are cancelled (see cancel_commands()), except that a stage
+    raising SkipDeploy only stops the stages that depend on it, so that the
+    checks independent of it still get to call the deploy off. run() then
+    raises the exception when the stages still going have finished: a
+    SystemExit (e.g. from a check) over any other, and any other over
+    SkipDeploy, as they'd have been raised had the stages run in order.
     """
-    global last_version_attempted
 
-    try:
-        incoming_changes = get_incoming_changes()
-        if incoming_changes:
-            print incoming_changes
-            first_changeset = get_earliest_incoming()
-            update_repo()
+    def __init__(self, timer):
+        self.timer = timer
+        self.stages = collections.OrderedDict()
+
+    def add(self, name, func, deps=(), timed=True):
+        """Add a stage that calls func once the named stages, which must
+        already have been added, have succeeded. Timed stages are timed with
+        the deploy's DeployTimer.
+        """
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError("Stage %s depends on unknown stage %s" % (
+                    name, dep))
+        self.stages[name] = (func, deps, timed)
+
+    def _run_stage(self, name):
+        func, _, timed = self.stages[name]
+        try:
+            if timed:
+                with self.timer.stage(name):
+                    func()
+            else:
+                func()
+            error = None
+        except BaseException:
+            error = sys.exc_info()
+
+        with self.cond:
+            if error:
+                self.errors.append(error)
+                if not issubclass(error[0], SkipDeploy) and not self.failed:
+                    self.failed = True
+                    cancel_commands()
+            else:
+                self.succeeded.add(name)
+            self.finished.add(name)
+            self.cond.notify()
+
+    def _start_ready_stages(self):
+        for name, (_, deps, _) in self.stages.iteritems():
+            if name not in self.started and self.succeeded.issuperset(deps):
+                self.started.add(name)
+                thread = threading.Thread(target=self._run_stage,
+                                          args=(name,))
+                thread.daemon = True
+                thread.start()
+
+    def run(self):
+        self.cond = threading.Condition()
+        self.started, self.succeeded, self.finished = set(), set(), set()
+        self.errors = []
+        self.failed = False
+        reset_commands()
+
+        try:
+            with self.cond:
+                while True:
+                    if not self.failed:
+                        self._start_ready_stages()
+                    if self.finished == self.started:
+                        break
+                    # With a timeout, so that signals still get handled
+                    self.cond.wait(1)
+        except BaseException:
+            cancel_commands()
+            raise
+
+        if self.errors:
+            def precedence(error):
+                error_type = error[0]
+                return (not issubclass(error_type, SystemExit),
+                        issubclass(error_type, SkipDeploy))
+            error_type, error, traceback = min(self.errors, key=precedence)
+            raise error_type, error, traceback
 
-            if check_dangerous_files(first_changeset, notify=notify):
-                sys.exit(1)
 
-        last_changeset = get_last_changeset()
-        last_author = get_last_author()
+def deploy_to_staging(notify=True, force=False):
+    """Deploys BRANCH to VERSION if there are incoming changes.
 
-        if last_changeset == get_last_deployed():
-            # staging is already up to date, probably don't want to deploy
+    notify - Whether to ping 1s and 0s room about success or failure.
+    force - Whether to deploy even if there are no incoming changes.
+
+    Returns the outcome: succeeded, failed or skipped.
+    """
+    timer = deploy_metrics.DeployTimer(red, target)
+    log_from = get_deploy_log().num_lines()
+    outcome = 'failed'
+    # Filled in by the stages as they go
+    info = {'changeset': None, 'author': None, 'num_files': None,
+            'dangerous': False, 'affected_files': None,
+            'unbuilt_outputs': {}}
+
+    def get_files():
+        info['affected_files'] = get_affected_files(first_changeset)
+        info['num_files'] = len(info['affected_files'])
+
+    def check_files():
+        if check_dangerous_files(info['affected_files'], notify=notify):
+            info['dangerous'] = True
+            sys.exit(1)
+
+    def check_changeset():
+        info['changeset'], info['author'] = get_last_changeset_and_author()
+
+        if info['changeset'] == get_last_deployed():
+            # VERSION is already up to date, probably don't want to deploy
             if not force:
-                return
+                raise SkipDeploy()
 
-        elif last_changeset == last_version_attempted:
+        elif info['changeset'] == last_version_attempted:
             # We failed last time on this version, don't try again (unless this
             # script is restarted entirely)
-            return
+            raise SkipDeploy()
 
+    def restore_outputs():
+        info['unbuilt_outputs'] = restore_build_outputs(info['changeset'])
+
+    def copy_secrets():
         decrypt_secrets()
         shutil.copy2("secrets_dev.py", REPO_DIR)
-        # TODO(david): sudo needed because not using virtualenv on EC2. Fix it.
-        subprocess.check_call(["sudo", "make", "install_deps"], cwd=REPO_DIR)
+
+    def deploy():
+        global last_version_attempted
 
         print "Running deploy script!"
 
-        last_version_attempted = last_changeset
+        last_version_attempted = info['changeset']
+
+        with build_slot():
+            check_call([
+                "python", "-u", "deploy/deploy.py",
+                "--version", VERSION,
+                "--no-up",
+                "--no-hipchat",
+                "--no-browser",
+            ], cwd=REPO_DIR)
 
-        subprocess.check_call([
-            "python", "-u", "deploy/deploy.py",
-            "--version", "staging",
-            "--no-up",
-            "--no-hipchat",
-            "--no-browser",
-        ], cwd=REPO_DIR)
+        save_build_outputs(info['unbuilt_outputs'])
+
+    try:
+        pipeline = DeployPipeline(timer)
 
-        set_last_deployed(last_changeset)
+        updated = []
+        checked = []
+        incoming_changes = get_incoming_changes()
+        if incoming_changes:
+            print "Incoming changesets:"
+            print "\n".join(incoming_changes)
+            first_changeset = incoming_changes[0].split()[0]
+            pipeline.add('update_repo', update_repo)
+            pipeline.add('get_affected_files', get_files, ['update_repo'])
+            pipeline.add('check_dangerous_files', check_files,
+                         ['get_affected_files'])
+            updated = ['update_repo']
+            checked = ['check_dangerous_files']
+
+        pipeline.add('check_changeset', check_changeset, updated,
+                     timed=False)
+        pipeline.add('decrypt_secrets', copy_secrets, ['check_changeset'])
+        # Always ran after decrypt_secrets, so the Makefile may rely on the
+        # secrets being in place
+        pipeline.add('install_deps', install_deps, ['decrypt_secrets'])
+        pipeline.add('restore_build_outputs', restore_outputs,
+                     ['check_changeset'])
+        pipeline.add('deploy', deploy,
+                     checked + ['decrypt_secrets', 'install_deps',
+                                'restore_build_outputs'])
+        pipeline.run()
+
+        set_last_deployed(info['changeset'])
+        outcome = 'succeeded'
 
         print "Deploy script succeeded!"
 
         if notify:
             notify_hipchat(secrets.hipchat_room_id, "gray", "just "
-                    "deployed to http://staging.khan-academy.appspot.com with "
+                    "deployed to http://%s.khan-academy.appspot.com with "
                     "last website changeset %s by %s" % (
-                        last_changeset, last_author))
+                        VERSION, info['changeset'], info['author']))
+
+    except SkipDeploy:
+        outcome = 'skipped'
+
+    except SystemExit:
+        if info['dangerous']:
+            outcome = 'aborted'
+        raise
 
     except subprocess.CalledProcessError as e:
         print "Deploy failed :("
@@ -278,8 +1083,69 @@ def deploy_to_staging(notify=True, force=False):
                     "Oh (poo), I'm borked (sadpanda). Will a kind soul visit "
                     "ci.khanacademy.org and make me feel better? (heart)")
 
+    finally:
+        timer.finish(outcome)
+        if timer.spans:
+            record_history(timer, outcome, info['changeset'], info['author'],
+                           info['num_files'], log_from)
+
+    return outcome
+
+
+def get_deploy_log():
+    """Return our target's deploy log, as written by Mr Assistant."""
+    return deploy_log.DeployLog(target.path(deploy_log.LOG_DIR))
+
+
+def record_history(timer, outcome, changeset, author, num_files, log_from):
+    """Add a deploy attempt to the deploy history. The range of log lines
+    recorded may be off by the few lines Mr Assistant hasn't flushed to the
+    log yet.
+    """
+    try:
+        deploy_history.record(
+            started_at=timer.started_at,
+            finished_at=time.time(),
+            changeset=changeset,
+            author=author,
+            num_files=num_files,
+            outcome=outcome,
+            stage_secs=timer.get_stage_secs(),
+            log_from=log_from,
+            log_to=get_deploy_log().num_lines(),
+            target=target.name)
+    except sqlite3.Error as e:
+        print "Couldn't record deploy in history: %s" % e
+
+
+def wait_until_activated():
+    """Wait for Mr Assistant to put this standby process to work, which she
+    does by writing "go <time of request> <warm|cold> [profile]" to stdin.
+    Return the time she was asked to start us, whether we were waiting ready
+    ("warm") or only just started ("cold") and whether to start profiling,
+    or None if she goes away first.
+    """
+    line = sys.stdin.readline()
+    if not line:
+        return None
+    words = line.split()
+    return float(words[1]), words[2], 'profile' in words[3:]
+
+
+def record_timing(name, outcome, secs):
+    """Record a timing other than of a deploy stage with deploy_metrics,
+    e.g. how long it took from being asked to start to first polling for
+    changes (restart_to_first_poll) or how long each poll took (poll).
+    """
+    try:
+        deploy_metrics.record(red, name, outcome, secs,
+                              kind=deploy_metrics.TIMING)
+    except redis.RedisError as e:
+        print "Couldn't record timing of %s: %s" % (name, e)
+
 
 def manual_exit():
+    profiler.stop()
     print "Affirmative! I'll take a nap now, commander.\n"
     sys.exit(0)
 
@@ -289,18 +1155,63 @@ def get_cmd_line_args():
 
     parser.add_option('-d', '--deploy_and_quit',
         action="store_true",
-        help="Deploy to staging then exit (do not daemonize).", default=False)
+        help="Deploy then exit (do not daemonize).", default=False)
 
     parser.add_option('-n', '--no_notify',
         action="store_true",
         help="Don't notify HipChat.", default=False)
 
+    parser.add_option('--target',
+        help="Name of the deploy target to deploy (see deploy_targets.py).",
+        default=deploy_targets.DEFAULT_TARGET)
+
+    parser.add_option('--clone_url',
+        help="Repository to deploy from (e.g. a local test repository), "
+             "instead of the target's.")
+
+    parser.add_option('--repo_dir',
+        help="Where to keep the working copy of the repository, instead of "
+             "the target's.")
+
+    parser.add_option('--standby',
+        action="store_true",
+        help="Start up, then wait for a line on stdin before doing any work "
+             "(used by Mr Assistant for fast restarts).", default=False)
+
     return parser.parse_args()
 
 
-# TODO(david): Ask a Kiln admin to add a webhook on stable instead of polling
 def main():
+    global target, BRANCH, VERSION, VERSION_FILE, REMOTE_HEAD_FILE
+    global TARGET_LOCK_FILE
+    global CLONE_URL, REPO_DIR, MIRROR_DIR, BUILD_OUTPUTS
+
     options, _ = get_cmd_line_args()
+    target = deploy_targets.get(options.target)
+    BRANCH = target.branch
+    VERSION = target.version
+    VERSION_FILE = '%s.version.txt' % target.name
+    REMOTE_HEAD_FILE = '%s.remote_head.txt' % target.name
+    TARGET_LOCK_FILE = '%s.lock' % target.name
+    CLONE_URL = options.clone_url or target.clone_url or CLONE_URL
+    REPO_DIR = hg.repo_dir = (options.repo_dir or target.repo_dir or
+                              target.path(REPO_DIR))
+    MIRROR_DIR = REPO_DIR.rstrip("/") + ".mirror"
+    BUILD_OUTPUTS, build_outputs_cache.max_bytes = build_cache.load()
+    scheduler.STATE_KEY = target.key(PollScheduler.STATE_KEY)
+
+    profiler.name = target.path(profiler.name)
+    sampling_profiler.install_signal_handlers(profiler)
+
+    activation = None
+    if options.standby:
+        activation = wait_until_activated()
+        if activation is None:
+            return 0
+        if activation[2]:
+            profiler.start()
+
+    lock_target()
 
     if not os.path.exists(REPO_DIR):
         clone_repo()
@@ -313,13 +1224,22 @@ def main():
     for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
         signal.signal(sig, lambda signal, frame: manual_exit())
 
+    push_trigger = PushTrigger(TRIGGER_CHANNEL)
+
     print "I'm awake! Back to work. :)"
 
-    # Poll to see if there are any new changesets
+    if activation:
+        requested_at, how, _ = activation
+        record_timing('restart_to_first_poll', how, time.time() - requested_at)
+
+    # Check for new changesets whenever there's a push, or every so often
     while True:
-        deploy_to_staging(not options.no_notify)
+        start = time.time()
+        outcome = deploy_to_staging(not options.no_notify)
+        record_timing('poll', outcome, time.time() - start)
 
-        time.sleep(POLL_INVERVAL_SECS)
+        if push_trigger.wait(scheduler.next_delay()):
+            print "Heard about a push, checking for changes"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,249 @@
+"""A durable queue of HipChat notifications, so that a slow or unreachable
+HipChat never holds up or breaks a deploy.
+
+Mr Deploy enqueues notifications on a Redis list and carries on. Mr
+Assistant's NotificationWorker drains the list in the background, moving
+each batch onto a processing list (so nothing is lost if it dies mid-send)
+and retrying with exponential backoff until HipChat takes it, for up to
+MAX_RETRY_SECS. Messages to the same room that arrive together are sent as
+one, in the color of the most severe of them.
+
+How long each notification took from being queued to being delivered is
+recorded with deploy_metrics as the 'hipchat_notification' timing.
+"""
+
+import httplib
+import itertools
+import json
+import socket
+import time
+import traceback
+import urllib
+import urllib2
+
+import redis
+
+import deploy_metrics
+
+try:
+    import secrets
+    HIPCHAT_TOKEN = secrets.hipchat_token
+    HIPCHAT_API_URL = getattr(secrets, 'hipchat_api_url',
+                              'https://api.hipchat.com/v1/rooms/message')
+except ImportError:
+    HIPCHAT_TOKEN = HIPCHAT_API_URL = None
+
+QUEUE_KEY = 'mr_deploy_notifications'
+PROCESSING_KEY = 'mr_deploy_notifications_sending'
+
+# Once a notification arrives, wait this long for more to send with it, and
+# send at most MAX_BATCH_MESSAGES at once
+COALESCE_SECS = 2
+MAX_BATCH_MESSAGES = 20
+
+# Failed sends are retried after RETRY_MIN_SECS, doubling up to
+# RETRY_MAX_SECS. Notifications still unsent MAX_RETRY_SECS after their
+# batch was taken are given up on, so that a HipChat outage holds up the
+# queue for at most that long per batch.
+RETRY_MIN_SECS = 1
+RETRY_MAX_SECS = 60
+MAX_RETRY_SECS = 5 * 60
+
+SEND_TIMEOUT_SECS = 10
+
+# HipChat message colors from least to most severe
+COLORS = ['gray', 'green', 'purple', 'yellow', 'red']
+
+METRICS_TIMING = 'hipchat_notification'
+
+
+def enqueue(red, room_id, color, message):
+    """Queue a notification to be sent to a HipChat room."""
+    red.lpush(QUEUE_KEY, json.dumps({
+        'room_id': room_id,
+        'color': color,
+        'message': message,
+        'queued_at': time.time(),
+    }))
+
+
+def send_to_hipchat(room_id, color, message):
+    """Post a message to a HipChat room, raising on failure."""
+    url = '%s?%s' % (HIPCHAT_API_URL, urllib.urlencode({
+        'format': 'json',
+        'auth_token': HIPCHAT_TOKEN,
+    }))
+    data = urllib.urlencode({
+        'room_id': room_id,
+        'from': 'Mr Deploy',
+        'message': message,
+        'color': color,
+        'message_format': 'text',
+    })
+    urllib2.urlopen(url, data, SEND_TIMEOUT_SECS).read()
+
+
+def coalesce(notifications):
+    """Combine notifications to the same room into one, keeping rooms in
+    the order they were first notified. Returns a list of (room_id, color,
+    message, notifications combined).
+    """
+    rooms = []
+    by_room = {}
+    for notification in notifications:
+        room_id = notification['room_id']
+        if room_id not in by_room:
+            rooms.append(room_id)
+            by_room[room_id] = []
+        by_room[room_id].append(notification)
+
+    combined = []
+    for room_id in rooms:
+        group = by_room[room_id]
+        color = max((n['color'] for n in group),
+                    key=lambda c: COLORS.index(c) if c in COLORS else 0)
+        message = '\n'.join(n['message'] for n in group)
+        combined.append((room_id, color, message, group))
+    return combined
+
+
+class NotificationWorker(object):
+    """Sends queued notifications. Only one should run at a time.
+
+    send is called as send(room_id, color, message) and should raise if the
+    message couldn't be delivered.
+    """
+
+    def __init__(self, red, send=send_to_hipchat):
+        self.red = red
+        self.send = send
+
+    def _requeue_unsent(self):
+        """Put notifications left mid-send by a previous worker back at the
+        front of the queue.
+        """
+        unsent = self.red.lrange(PROCESSING_KEY, 0, -1)
+        if unsent:
+            # Both lists are oldest last, so the oldest must be pushed last
+            pipe = self.red.pipeline()
+            for raw in unsent:
+                pipe.rpush(QUEUE_KEY, raw)
+            pipe.delete(PROCESSING_KEY)
+            pipe.execute()
+
+    def _take_batch(self):
+        """Wait for a notification, then take any more that arrive within
+        COALESCE_SECS. Returns the raw notifications, oldest first.
+        """
+        raw = None
+        while raw is None:
+            raw = self.red.brpoplpush(QUEUE_KEY, PROCESSING_KEY, 60)
+        batch = [raw]
+        deadline = time.time() + COALESCE_SECS
+        while len(batch) < MAX_BATCH_MESSAGES:
+            timeout = int(round(deadline - time.time()))
+            if timeout <= 0:
+                break
+            raw = self.red.brpoplpush(QUEUE_KEY, PROCESSING_KEY, timeout)
+            if raw is None:
+                break
+            batch.append(raw)
+        return batch
+
+    def _send_with_retries(self, room_id, color, message, give_up_at):
+        """Return whether the message was delivered. It's tried at least
+        once, and not retried after give_up_at.
+        """
+        delay = RETRY_MIN_SECS
+        for attempt in itertools.count(1):
+            try:
+                self.send(room_id, color, message)
+                return True
+            except urllib2.HTTPError as e:
+                print "Failed to notify HipChat room %s (attempt %d): %s" % (
+                    room_id, attempt, e)
+                if 400 <= e.code < 500 and e.code != 429:
+                    return False  # Retrying won't help
+            except (urllib2.URLError, httplib.HTTPException, socket.error,
+                    ValueError) as e:
+                print "Failed to notify HipChat room %s (attempt %d): %s" % (
+                    room_id, attempt, e)
+            if time.time() + delay > give_up_at:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, RETRY_MAX_SECS)
+
+    def _record_latency(self, notifications, outcome):
+        now = time.time()
+        try:
+            for notification in notifications:
+                deploy_metrics.record(self.red, METRICS_TIMING, outcome,
+                                      now - notification['queued_at'],
+                                      kind=deploy_metrics.TIMING)
+        except redis.RedisError as e:
+            print "Couldn't record notification latency: %s" % e
+
+    def _decode(self, raw):
+        """Return the notification queued as raw, or None if it's
+        malformed.
+        """
+        try:
+            notification = json.loads(raw)
+            if all(key in notification for key in
+                   ('room_id', 'color', 'message', 'queued_at')):
+                return notification
+        except (TypeError, ValueError):
+            pass
+        return None
+
+    def process_batch(self):
+        """Send the next batch of notifications, blocking until there is
+        one. Malformed notifications are dropped, as is the batch if
+        sending it fails unexpectedly.
+        """
+        batch = self._take_batch()
+        notifications = []
+        for raw in batch:
+            notification = self._decode(raw)
+            if notification is None:
+                print "Dropping malformed notification: %r" % raw
+            else:
+                notifications.append(notification)
+
+        give_up_at = time.time() + MAX_RETRY_SECS
+        try:
+            for room_id, color, message, group in coalesce(notifications):
+                if self._send_with_retries(room_id, color, message,
+                                           give_up_at):
+                    self._record_latency(group, 'delivered')
+                else:
+                    print "Giving up on notifying HipChat room %s: %s" % (
+                        room_id, message)
+                    self._record_latency(group, 'dropped')
+        except Exception:
+            # Rather than send the batch again and hit the same bug forever
+            print "Failed to send notifications; dropping %r" % batch
+            traceback.print_exc()
+
+        pipe = self.red.pipeline(transaction=False)
+        for raw in batch:
+            pipe.lrem(PROCESSING_KEY, 1, raw)
+        pipe.execute()
+
+    def run(self):
+        """Send notifications forever. Intended to be run in a separate
+        thread.
+        """
+        while True:
+            try:
+                self._requeue_unsent()
+                while True:
+                    self.process_batch()
+            except redis.RedisError as e:
+                print "Notification queue unavailable: %s" % e
+                time.sleep(RETRY_MIN_SECS)
+            except Exception:
+                # Never let a bug stop notifications for good
+                print "Notification worker failed; carrying on"
+                traceback.print_exc()
+                time.sleep(RETRY_MIN_SECS)
@@ -0,0 +1,59 @@
+"""A capped, replayable record of Mr Deploy's recent output in Redis.
+
+Every output line gets an id from a monotonically increasing counter and is
+both published on the output channel and kept in a sorted set (scored by id)
+trimmed to the last RING_SIZE lines. Streaming clients that reconnect can
+then ask for just the lines after the last id they saw.
+
+Messages published on the output channel are encoded as "<id>:<line>".
+Each output channel has its own ring and counter.
+"""
+
+RING_KEY = '%s_ring'  # % channel
+SEQ_KEY = '%s_seq'  # % channel
+
+# Number of most recent output lines kept for replay
+RING_SIZE = 10000
+
+
+def encode(entry_id, line):
+    return '%d:%s' % (entry_id, line)
+
+
+def decode(message):
+    """Return (id, line) for an encoded output message."""
+    entry_id, _, line = message.partition(':')
+    return int(entry_id), line
+
+
+def append(red, channel, lines):
+    """Assign ids to the given lines, add them to the ring and publish them
+    on channel.
+    """
+    if not lines:
+        return
+
+    last_id = red.incr(SEQ_KEY % channel, len(lines))
+    first_id = last_id - len(lines) + 1
+
+    pipe = red.pipeline(transaction=False)
+    for entry_id, line in enumerate(lines, first_id):
+        message = encode(entry_id, line)
+        pipe.zadd(RING_KEY % channel, entry_id, message)
+        pipe.publish(channel, message)
+    pipe.zremrangebyrank(RING_KEY % channel, 0, -RING_SIZE - 1)
+    pipe.execute()
+
+
+def since(red, channel, last_id):
+    """Return (complete, messages): the encoded output messages on channel
+    with ids greater than last_id, in order, and whether those are all the
+    lines after last_id or some have already been trimmed from the ring.
+    """
+    if int(red.get(SEQ_KEY % channel) or 0) < last_id:
+        # The counter was reset (e.g. Redis lost its data), so all is new
+        return False, red.zrange(RING_KEY % channel, 0, -1)
+
+    messages = red.zrangebyscore(RING_KEY % channel, last_id + 1, '+inf')
+    complete = not messages or decode(messages[0])[0] <= last_id + 1
+    return complete, messages
@@ -22,6 +22,12 @@ export PYTHONUNBUFFERED=1
 echo "Starting Mr Deploy's assistant"
 python mr_assistant.py > log/mr_assistant.log &
 
+# Start up the single-process server for the dashboard's long-lived streams,
+# which the proxy sends /deploy/stream and /deploy/status to
+echo "Starting stream server"
+FLASK_CONFIG=flask_prod_config.py python stream_server.py \
+  --bind unix:/tmp/mr_deploy_stream.sock > log/stream_server.log 2>&1 &
+
 # Start up gunicorn server with multiple Flask workers as the foreground process
 echo "Starting app server"
 FLASK_CONFIG=flask_prod_config.py gunicorn \
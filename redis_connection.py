@@ -0,0 +1,13 @@
+"""The Redis shared by Mr Deploy, Mr Assistant and the servers."""
+
+import os
+
+import redis
+
+# On another port if MR_DEPLOY_REDIS_PORT is set, e.g. by bench/e2e.py, which
+# runs its own Redis so as not to disturb the keys of any other Mr Deploy
+PORT = int(os.environ.get('MR_DEPLOY_REDIS_PORT', 6379))
+
+
+def connect():
+    return redis.StrictRedis(port=PORT)
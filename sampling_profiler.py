@@ -0,0 +1,147 @@
+"""A low-overhead sampling profiler for Mr Deploy and Mr Assistant, switched
+on and off while they run.
+
+While running, a background thread looks at every other thread's stack
+SAMPLE_SECS apart and counts each distinct stack seen. Stopping writes the
+counts to PROFILE_DIR in the "folded" format of Brendan Gregg's
+flamegraph.pl and speedscope: one line per stack, its frames from the root
+down separated by semicolons and followed by the number of samples, e.g.
+
+    MainThread;main (mr_deploy.py:890);deploy_to_staging (mr_deploy.py:695) 12
+
+The sampler needs the GIL to take a sample, so time spent in C code that
+holds it shows up late, attributed to whatever runs next.
+"""
+
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+
+PROFILE_DIR = 'log/profiles'
+
+# Seconds between samples
+SAMPLE_SECS = 0.01
+
+
+def _frame_name(code):
+    name = '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+    return name.replace(';', ':')
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of all threads of this process between start()
+    and stop(). Profiles are named after name and the pid.
+    """
+
+    def __init__(self, name, sample_secs=SAMPLE_SECS,
+                 profile_dir=PROFILE_DIR):
+        self.name = name
+        self.sample_secs = sample_secs
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self.thread = None
+        self.started_at = None
+        self.stacks = collections.Counter()
+        self.frame_names = {}  # By code object
+
+    def is_running(self):
+        return self.thread is not None
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.stacks = collections.Counter()
+            self.started_at = time.time()
+            self.thread = threading.Thread(target=self._sample_until_stopped)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Stop sampling and write the profile. Returns its path, or None if
+        we weren't running.
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if not thread:
+                return None
+            thread.join()
+            return self._write()
+
+    def _sample_until_stopped(self):
+        me = threading.current_thread()
+        while self.thread is me:
+            time.sleep(self.sample_secs)
+            self._sample(me.ident)
+
+    def _sample(self, own_ident):
+        thread_names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().iteritems():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = self.frame_names.get(code)
+                if name is None:
+                    name = self.frame_names[code] = _frame_name(code)
+                stack.append(name)
+                frame = frame.f_back
+            stack.append(thread_names.get(ident, 'Thread-%d' % ident))
+            stack.reverse()
+            self.stacks[';'.join(stack)] += 1
+
+    def _write(self):
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        path = os.path.join(self.profile_dir, '%s.%s.%d.folded' % (
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at)),
+            self.name, os.getpid()))
+
+        # Written aside then renamed, so it's never served half-written
+        with open(path + '.tmp', 'w') as f:
+            for stack, count in sorted(self.stacks.iteritems()):
+                f.write('%s %d\n' % (stack, count))
+        os.rename(path + '.tmp', path)
+        print "Wrote profile of %d samples to %s" % (
+            sum(self.stacks.itervalues()), path)
+        return path
+
+
+def install_signal_handlers(profiler):
+    """Start profiler on SIGUSR1 and stop it on SIGUSR2, which is how Mr
+    Assistant profiles Mr Deploy.
+    """
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.stop())
+    # Don't interrupt whatever system call we're in (e.g. reading from hg)
+    for sig in (signal.SIGUSR1, signal.SIGUSR2):
+        signal.siginterrupt(sig, False)
+
+
+def list_profiles(profile_dir=PROFILE_DIR):
+    """Return a list of dicts describing the profiles written, newest
+    first.
+    """
+    try:
+        names = os.listdir(profile_dir)
+    except OSError:
+        return []
+
+    profiles = []
+    for name in names:
+        if not name.endswith('.folded'):
+            continue
+        stat = os.stat(os.path.join(profile_dir, name))
+        profiles.append({
+            'name': name,
+            'bytes': stat.st_size,
+            'written_at': stat.st_mtime,
+        })
+    profiles.sort(key=lambda profile: profile['written_at'], reverse=True)
+    return profiles
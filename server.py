@@ -2,70 +2,469 @@
 
 """A simple web server to see and control Mr Deploy. Talks to Mr Deploy using
 Redis through her assistant, Mr Assistant.
+
+Most views take a `target` argument naming the deploy target (see
+deploy_targets.py) to show, defaulting to deploy_targets.DEFAULT_TARGET.
 """
 
+import collections
 import flask
 import json
-import redis
-import subprocess
+import time
+import zlib
 
+import assistant_status
 import auth
+import deploy_history
+import deploy_log
+import deploy_metrics
+import deploy_targets
+import log_search
+import output_ring
+import redis_connection
+import sampling_profiler
+import stream_hub
 
 
 app = flask.Flask(__name__)
 app.config.from_envvar('FLASK_CONFIG')
 auth.configure_app(app, required=not app.debug)
 
-red = redis.StrictRedis()
+red = redis_connection.connect()
+
+# Number of lines of the deploy log to inline in the dashboard page. Older
+# lines are fetched from /deploy/log as the console is scrolled up.
+INITIAL_LOG_LINES = 500
+
+# Most lines of the deploy log that can be requested at once from /deploy/log
+MAX_LOG_LINES = 5000
+
+# Most matches, and lines of context around each, from /deploy/log/search
+MAX_SEARCH_MATCHES = 100
+MAX_SEARCH_CONTEXT = 20
+
+# Idle streams get a comment line this often, so that proxies don't time them
+# out and connections to clients that have gone away get noticed and closed
+HEARTBEAT_SECS = 15
+
+# Longest a /deploy/status long-poll can wait for a change
+MAX_STATUS_WAIT_SECS = 60
+
+# Output lines are streamed in frames of up to FRAME_MAX_LINES lines, held
+# back at most FRAME_SECS waiting for more lines to fill them
+FRAME_MAX_LINES = 200
+FRAME_SECS = 0.05
+
+targets = collections.OrderedDict((target.name, target)
+                                  for target in deploy_targets.load())
+
+# One Redis subscription per target per worker process, shared by all
+# streaming clients of the target. Status updates are coalesced; a client
+# lagging more than 1000 lines behind on output starts losing the oldest
+# lines.
+hubs = dict((name, stream_hub.StreamHub(
+                red,
+                [target.key('mr_deploy_output'),
+                 target.key('mr_deploy_status')],
+                coalesced_channels=[target.key('mr_deploy_status')],
+                max_queue_size=1000))
+            for name, target in targets.iteritems())
+
+
+def get_target():
+    """Return the target named by the request's `target` argument."""
+    name = flask.request.args.get('target', deploy_targets.DEFAULT_TARGET)
+    if name not in targets:
+        flask.abort(404)
+    return targets[name]
+
+
+# This worker's copy of Mr Assistant's status document
+status_cache = assistant_status.StatusCache(red)
+
+
+def get_status(doc, target):
+    """Return whether target's Mr Deploy is running according to the status
+    document doc, and her scheduler's state. She isn't if Mr Assistant is
+    down.
+    """
+    if not assistant_status.is_up(doc) or target.name not in doc['targets']:
+        return False, None
+    target_status = doc['targets'][target.name]
+    return target_status['running'], target_status['scheduler']
+
+
+def get_deploy_log(target):
+    return deploy_log.DeployLog(target.path(deploy_log.LOG_DIR))
+
 
+def sse(event, data, event_id=None):
+    """Format a server-sent event with the given name, data and optional id.
+    See http://www.html5rocks.com/en/tutorials/eventsource/basics/
+    """
+    data = '\n'.join('data: %s' % line for line in data.split('\n'))
+    if event_id is None:
+        return 'event: %s\n%s\n\n' % (event, data)
+    return 'id: %d\nevent: %s\n%s\n\n' % (event_id, event, data)
 
-def event_stream():
-    pubsub = red.pubsub()
-    pubsub.subscribe(['mr_deploy_output', 'mr_deploy_status'])
-    for item in pubsub.listen():
-        if item['type'] == 'message':
-            # This is the format for an SSE specifying an event name with data
-            # See http://www.html5rocks.com/en/tutorials/eventsource/basics/
-            yield 'event: %s\ndata: %s\n\n' % (item['channel'], item['data'])
+
+def output_frame(lines, last_id):
+    """Format lines of output as one event, whose data is the lines
+    separated by newlines.
+    """
+    return sse('mr_deploy_output',
+               '\n'.join(line.rstrip('\n') for line in lines), last_id)
+
+
+def client_events(client, last_event_id=None, target=None):
+    """Generate the server-sent events for a client subscribed to target's
+    hub, replaying any output after last_event_id first.
+
+    Output lines are sent in frames of up to FRAME_MAX_LINES lines, each
+    waiting at most FRAME_SECS for more lines to fill it.
+    """
+    target = target or targets[deploy_targets.DEFAULT_TARGET]
+    output_channel = target.key('mr_deploy_output')
+    status_channel = target.key('mr_deploy_status')
+
+    if last_event_id is not None:
+        complete, messages = output_ring.since(red, output_channel,
+                                               last_event_id)
+        if not complete:
+            # Too much was missed to replay; the client should reload
+            yield sse('mr_deploy_gap', str(last_event_id))
+            last_event_id = None
+
+        for i in xrange(0, len(messages), FRAME_MAX_LINES):
+            entries = [output_ring.decode(message)
+                       for message in messages[i:i + FRAME_MAX_LINES]]
+            last_event_id = entries[-1][0]
+            yield output_frame([line for _, line in entries], last_event_id)
+
+    message = None
+    while True:
+        if message is None:
+            message = client.get(HEARTBEAT_SECS)
+            if message is None:
+                yield ': heartbeat\n\n'
+                continue
+
+        channel, data = message
+        message = None
+        if channel == output_channel:
+            lines = []
+            deadline = time.time() + FRAME_SECS
+            while True:
+                entry_id, line = output_ring.decode(data)
+                if last_event_id is None or entry_id > last_event_id:
+                    lines.append(line)
+                    last_event_id = entry_id
+                if len(lines) >= FRAME_MAX_LINES:
+                    break
+
+                message = client.get(max(0, deadline - time.time()))
+                if message is None or message[0] != output_channel:
+                    break  # Anything else is sent after this frame
+                channel, data = message
+                message = None
+
+            if lines:
+                yield output_frame(lines, last_event_id)
+        elif channel == status_channel:
+            yield sse('mr_deploy_status', data)
+        elif channel == 'dropped':
+            yield sse('mr_deploy_dropped', data)
+
+
+def event_stream(target, last_event_id=None):
+    """Stream target's Mr Deploy's output and status as server-sent events.
+    If given the id of the last output line a reconnecting client saw, first
+    replay the lines it missed.
+    """
+    # Subscribe before replaying so no line falls between the two
+    hub = hubs[target.name]
+    client = hub.subscribe()
+    try:
+        # Get the response headers out without waiting for the first event
+        yield ': connected\n\n'
+
+        for event in client_events(client, last_event_id, target):
+            yield event
+    finally:
+        hub.unsubscribe(client)
+
+
+def gzip_stream(chunks):
+    """Gzip a stream, flushing after every chunk so nothing is held back."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
 
 
 @app.route('/deploy/status', methods=['GET'])
 @auth.login_required
 def status():
-    # TODO(david): Should return false if mr_assistant.py is not working.
-    running = red.get('mr_deploy_running')
-    running = running and json.loads(running)
+    """The status of the target's Mr Deploy, whether each target's is
+    running, and whether Mr Assistant is up at all.
+
+    Served from this worker's copy of the status document with an ETag.
+    Given If-None-Match and `wait`, waits up to that many seconds for the
+    status to change before answering 304 Not Modified.
+    """
+    target = get_target()
+    wait = max(0, min(flask.request.args.get('wait', 0, type=float),
+                      MAX_STATUS_WAIT_SECS))
+    if_none_match = flask.request.if_none_match
+
+    doc = status_cache.get()
+    etag = assistant_status.get_etag(doc)
+    if wait and etag in if_none_match:
+        doc = status_cache.wait_for_change(etag, wait)
+        etag = assistant_status.get_etag(doc)
+
+    if etag in if_none_match:
+        response = flask.Response(status=304)
+    else:
+        running, scheduler = get_status(doc, target)
+        response = flask.jsonify(
+            assistant='up' if assistant_status.is_up(doc) else 'down',
+            running=running,
+            scheduler=scheduler,
+            targets=[{
+                'name': t.name,
+                'branch': t.branch,
+                'version': t.version,
+                'running': get_status(doc, t)[0],
+            } for t in targets.itervalues()],
+        )
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/deploy/history', methods=['GET'])
+@auth.login_required
+def history():
+    """Past deploy attempts, newest first, `limit` at a time. Pass the
+    returned `next_before` as `before` to get the next page. Can be filtered
+    by `outcome`, `changeset` or `target` (by default, attempts to all
+    targets are returned). Each attempt links to its lines of its target's
+    deploy log.
+    """
+    args = flask.request.args
+    limit = max(1, min(args.get('limit', 20, type=int), 100))
+    target = args.get('target')
+    if target is not None:
+        target = get_target().name
+    deploys = deploy_history.query(
+        before_id=args.get('before', None, type=int),
+        limit=limit,
+        outcome=args.get('outcome'),
+        changeset=args.get('changeset'),
+        target=target)
+
+    for deploy in deploys:
+        if deploy['log_from'] is not None:
+            deploy['log_url'] = flask.url_for('log_range',
+                **{'from': deploy['log_from'],
+                   'to': deploy['log_to'],
+                   'target': deploy['target']})
+
+    return flask.jsonify(
+        deploys=deploys,
+        next_before=deploys[-1]['id'] if len(deploys) == limit else None,
+    )
+
+
+@app.route('/deploy/metrics', methods=['GET'])
+@auth.login_required
+def metrics():
+    """Rolling timing statistics for each deploy pipeline stage and other
+    timing (across all targets), plus the stage timings of the target's
+    current and last deploys.
+    """
+    current, last = deploy_metrics.get_deploys(red, get_target())
     return flask.jsonify(
-        running=running,
+        stages=deploy_metrics.get_stats(red, deploy_metrics.STAGE),
+        timings=deploy_metrics.get_stats(red, deploy_metrics.TIMING),
+        current=current,
+        last=last,
     )
 
 
+@app.route('/deploy/metrics/prometheus', methods=['GET'])
+@auth.hook_token_required
+def prometheus_metrics():
+    """Timing statistics for scraping by Prometheus."""
+    return flask.Response(
+        ''.join(deploy_metrics.to_prometheus(
+                    deploy_metrics.get_stats(red, kind), kind)
+                for kind in (deploy_metrics.STAGE, deploy_metrics.TIMING)),
+        mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/deploy/please/<command>', methods=['POST'])
 @auth.login_required
 def deploy_command(command):
-    red.publish('mr_deploy_commands', command)
+    """Start, stop or restart the target's Mr Deploy, or with the form
+    argument all=1, every target's.
+    """
+    if flask.request.form.get('all'):
+        red.publish('mr_deploy_commands', command)
+    else:
+        red.publish('mr_deploy_commands',
+                    '%s %s' % (command, get_target().name))
     return status()
 
 
-# TODO(david): This blocks the HTTP connection and so we use gunicorn spawning
-#     multiple server processes to handle simultaneous connections. Perhaps
-#     just rewrite this trivial server in Node + Socket.IO or just poll.
+@app.route('/deploy/please/profile/<action>', methods=['POST'])
+@auth.login_required
+def profile_command(action):
+    """Start or stop profiling Mr Assistant and Mr Deploy."""
+    if action not in ('start', 'stop'):
+        flask.abort(404)
+    red.publish('mr_deploy_commands', 'profile %s' % action)
+    return flask.jsonify(profiling=(action == 'start'))
+
+
+@app.route('/deploy/profile', methods=['GET'])
+@auth.login_required
+def profiles():
+    """The profiles written so far, newest first, each with a link to
+    download its stacks in the folded format flamegraph.pl and speedscope
+    read.
+    """
+    profiling = red.get('mr_deploy_profiling')
+    profiles = sampling_profiler.list_profiles()
+    for profile in profiles:
+        profile['url'] = flask.url_for('profile', name=profile['name'])
+    return flask.jsonify(
+        profiling=profiling and json.loads(profiling),
+        profiles=profiles,
+    )
+
+
+@app.route('/deploy/profile/<name>', methods=['GET'])
+@auth.login_required
+def profile(name):
+    if not name.endswith('.folded'):
+        flask.abort(404)
+    return flask.send_from_directory(sampling_profiler.PROFILE_DIR, name,
+                                     mimetype='text/plain',
+                                     as_attachment=True)
+
+
+@app.route('/deploy/hook', methods=['POST'])
+@auth.hook_token_required
+def deploy_hook():
+    """Called by the repository's webhook on every push, to make Mr Deploy
+    check for new changesets right away instead of at her next poll.
+    """
+    red.publish('mr_deploy_triggers', 'push')
+    return flask.jsonify(triggered=True)
+
+
+# Each stream holds its connection open; see stream_server.py for serving
+# them all from one process.
 @app.route('/deploy/stream')
 @auth.login_required
 def stream():
-    return flask.Response(event_stream(), mimetype="text/event-stream")
+    # Browsers send the id of the last event seen when reconnecting
+    last_event_id = flask.request.headers.get('Last-Event-ID', type=int)
+    events = event_stream(get_target(), last_event_id)
+    headers = {'Vary': 'Accept-Encoding'}
+    if 'gzip' in flask.request.headers.get('Accept-Encoding', ''):
+        events = gzip_stream(events)
+        headers['Content-Encoding'] = 'gzip'
+    return flask.Response(events, mimetype="text/event-stream",
+                          headers=headers)
+
+
+def read_log_pages(store, first_line, end_line):
+    """Yield the lines of the deploy log from first_line to end_line,
+    MAX_LOG_LINES at a time.
+    """
+    for page_from in xrange(first_line, end_line, MAX_LOG_LINES):
+        _, _, data = store.read_lines(
+            page_from, min(MAX_LOG_LINES, end_line - page_from))
+        yield data
+
+
+@app.route('/deploy/log')
+@auth.login_required
+def log_range():
+    """Serve a range of lines of the deploy log as plain text. Takes `from`,
+    the 0-based line to start at (defaults to the last `limit` lines), and
+    either `limit`, the number of lines (at most MAX_LOG_LINES), or `to`,
+    the line to stop before, for ranges of any length (e.g. a whole deploy's
+    lines). The range actually served is given in the X-Log-* headers.
+    """
+    args = flask.request.args
+    limit = max(0, min(args.get('limit', INITIAL_LOG_LINES, type=int),
+                       MAX_LOG_LINES))
+    first_line = args.get('from', None, type=int)
+    end_line = args.get('to', None, type=int)
+
+    store = get_deploy_log(get_target())
+    if first_line is None:
+        first_line, end_line, data = store.tail(limit)
+    elif end_line is None:
+        first_line, end_line, data = store.read_lines(first_line, limit)
+    else:
+        num_lines = store.num_lines()
+        first_line = max(0, min(first_line, num_lines))
+        end_line = max(first_line, min(end_line, num_lines))
+        data = read_log_pages(store, first_line, end_line)
+
+    response = flask.Response(data, mimetype='text/plain')
+    response.headers['X-Log-From'] = str(first_line)
+    response.headers['X-Log-To'] = str(end_line)
+    response.headers['X-Log-Total'] = str(store.num_lines())
+    return response
+
+
+@app.route('/deploy/log/search')
+@auth.login_required
+def log_search_results():
+    """Search the deploy log for lines containing every word of `q`. Returns
+    the newest `limit` matches, each with its line number and `context`
+    lines either side.
+    """
+    args = flask.request.args
+    limit = max(1, min(args.get('limit', 20, type=int), MAX_SEARCH_MATCHES))
+    context = max(0, min(args.get('context', 2, type=int),
+                         MAX_SEARCH_CONTEXT))
+
+    store = get_deploy_log(get_target())
+    lines = log_search.search(store, args.get('q', ''), limit)
+    ranges = []
+    for line in lines:
+        first_line = max(0, line - context)
+        ranges.append((first_line, line + context + 1 - first_line))
+    # Read together, so each segment's only decompressed once
+    contexts = store.read_ranges(ranges)
 
+    matches = []
+    for line, (first_line, _, data) in zip(lines, contexts):
+        matches.append({
+            'line': line,
+            'context_from': first_line,
+            'context': unicode(data, 'utf8', 'replace').split('\n')[:-1],
+        })
 
-def tail(filename, num_lines):
-    return subprocess.check_output(['tail', '-n', str(num_lines), filename])
+    return flask.jsonify(matches=matches)
 
 
 @app.route('/')
 @auth.login_required
 def index():
-    deploy_log = tail('log/mr_deploy.log', num_lines=12345)
-    deploy_log_decoded = unicode(deploy_log, 'utf8')
-    return flask.render_template('index.html', deploy_log=deploy_log_decoded)
+    target = get_target()
+    first_line, _, data = get_deploy_log(target).tail(INITIAL_LOG_LINES)
+    return flask.render_template('index.html',
+        targets=targets.values(),
+        target=target,
+        deploy_log=unicode(data, 'utf8', 'replace'),
+        deploy_log_first_line=first_line)
 
 
 def main():
@@ -2,6 +2,22 @@ $(function() {
 
 var RETRY_TIMEOUT_MS = 30 * 1000;
 
+var STATUS_POLL_INTERVAL_MS = 15 * 1000;
+
+// Longest the server should hold a status request waiting for a change
+var STATUS_WAIT_SECS = 30;
+
+// Number of older deploy log lines to fetch when scrolled to the top
+var LOG_PAGE_LINES = 500;
+
+// Most lines of output to keep in the console while following new output.
+// Older lines are dropped in chunks of CONSOLE_TRIM_LINES.
+var MAX_CONSOLE_LINES = 5000;
+var CONSOLE_TRIM_LINES = 1000;
+
+// The deploy target shown, whose name is passed to every request
+var TARGET = $("body").attr("data-target");
+
 $.fn.toggleDisabled = function(disable) {
     return this.each(function() {
         var $this = $(this);
@@ -16,10 +32,15 @@ $.fn.toggleDisabled = function(disable) {
 /**
  * Sets Mr Deploy's status.
  * @param {boolean} running Whether Mr Deploy is running.
+ * @param {string=} assistant "down" if Mr Assistant isn't answering.
  */
-var setStatus = function(running) {
+var setStatus = function(running, assistant) {
     var status = running ? "I&rsquo;m working!" :
             "I&rsquo;m napping... zed zed zed...";
+    if (assistant === "down") {
+        status = "My assistant isn&rsquo;t answering! Is mr_assistant.py " +
+                "running?";
+    }
 
     $("#status")
         .toggleClass("alert-success", running)
@@ -33,17 +54,198 @@ var setStatus = function(running) {
         .find("[data-action='stop']").toggleDisabled(!running).end()
         .find("[data-action='restart']").toggleDisabled(!running).end()
     ;
+    if (assistant === "down") {
+        $("#buttons .btn").toggleDisabled(true);
+    }
+};
+
+/**
+ * Marks which targets' Mr Deploys are running on their tabs.
+ * @param {Array.<Object>} targets Each target's name and whether running.
+ */
+var setTargetStatuses = function(targets) {
+    $.each(targets, function(i, target) {
+        $("#targets li[data-target='" + target.name + "'] .target-indicator")
+            .toggleClass("target-running", !!target.running);
+    });
+};
+
+// The poll scheduler state last heard of, to count down from
+var lastScheduler = null;
+
+/**
+ * Shows when Mr Deploy will next check for changes.
+ * @param {Object} scheduler Mr Deploy's poll scheduler state, if any.
+ */
+var setSchedule = function(scheduler) {
+    lastScheduler = scheduler;
+    var text = "";
+    if (scheduler && scheduler.next_poll_at) {
+        var secs = Math.max(0,
+                Math.round(scheduler.next_poll_at - new Date() / 1000));
+        text = "Next check for changes in " + secs + "s";
+        if (scheduler.consecutive_failures) {
+            text += " (Kiln failed the last " +
+                    scheduler.consecutive_failures + " checks)";
+        }
+    }
+    $("#status .schedule-msg").text(text);
+};
+
+/**
+ * Draws the stage timings of a deploy as a waterfall.
+ * @param {Object} deploy Timings of a deploy from /deploy/metrics, if any.
+ * @param {boolean} inProgress Whether the deploy is still going.
+ */
+var renderWaterfall = function(deploy, inProgress) {
+    var $waterfall = $("#waterfall").empty();
+    if (!deploy || !deploy.spans.length) {
+        $waterfall.text("No deploys timed yet.");
+        return;
+    }
+
+    var now = new Date() / 1000,
+        total = Math.max((deploy.finished_at || now) - deploy.started_at, 1),
+        percent = function(secs) {
+            return (100 * secs / total) + "%";
+        };
+
+    $("<p>")
+        .text(inProgress ? "Deploying now:" :
+                "Last deploy (" + deploy.outcome + "):")
+        .appendTo($waterfall);
+
+    $.each(deploy.spans, function(i, span) {
+        var secs = (span.end || now) - span.start,
+            $row = $("<div>").addClass("waterfall-row").appendTo($waterfall);
+
+        $("<span>").addClass("waterfall-stage").text(span.stage)
+            .appendTo($row);
+        $("<div>").addClass("waterfall-track")
+            .append($("<div>")
+                .addClass("waterfall-bar waterfall-" + span.outcome)
+                .css({
+                    left: percent(span.start - deploy.started_at),
+                    width: percent(secs)
+                }))
+            .appendTo($row);
+        $("<span>").addClass("waterfall-secs").text(secs.toFixed(1) + "s")
+            .appendTo($row);
+    });
+};
+
+var pollMetrics = function() {
+    $.getJSON("/deploy/metrics", {target: TARGET}, function(data) {
+        renderWaterfall(data.current || data.last, !!data.current);
+    });
 };
 
-// TODO(david): Send status updates with the server-sent events stream
+/**
+ * Shows the most recent deploy attempts, with links to their output.
+ */
+var loadHistory = function() {
+    $.getJSON("/deploy/history", {limit: 10, target: TARGET}, function(data) {
+        var $tbody = $("#history tbody").empty();
+        $.each(data.deploys, function(i, deploy) {
+            var $log = deploy.log_url ?
+                    $("<a>").attr("href", deploy.log_url).text("log") : "";
+            $("<tr>")
+                .append($("<td>").text(
+                        new Date(deploy.started_at * 1000).toLocaleString()))
+                .append($("<td>").text(deploy.changeset || ""))
+                .append($("<td>").text(deploy.author || ""))
+                .append($("<td>").text(deploy.num_files === null ? "" :
+                        deploy.num_files))
+                .append($("<td>").text(Math.round(
+                        deploy.finished_at - deploy.started_at) + "s"))
+                .append($("<td>").text(deploy.outcome))
+                .append($("<td>").append($log))
+                .appendTo($tbody);
+        });
+    });
+};
+
+/**
+ * Long-polls for status changes: the server answers as soon as the status
+ * differs from what we last saw (which jQuery tracks by ETag), or with 304
+ * Not Modified after STATUS_WAIT_SECS.
+ */
 var pollStatus = function() {
-    $.getJSON("/deploy/status", function(data) {
-        setStatus(data.running);
+    $.ajax({
+        url: "/deploy/status",
+        data: {target: TARGET, wait: STATUS_WAIT_SECS},
+        dataType: "json",
+        ifModified: true,
+        success: function(data, textStatus) {
+            if (textStatus !== "notmodified") {
+                setStatus(data.running, data.assistant);
+                setSchedule(data.scheduler);
+                setTargetStatuses(data.targets);
+            }
+            pollStatus();
+        },
+        error: function() {
+            window.setTimeout(pollStatus, STATUS_POLL_INTERVAL_MS);
+        }
     });
-    // TODO(david): Handle server error response
 };
 
 
+// Lines of output waiting to be added to the console on the next animation
+// frame, and the number of lines the console holds
+var pendingOutput = [];
+var consoleLines = 0;
+
+var countLines = function(text) {
+    return text ? text.split("\n").length - 1 : 0;
+};
+
+/**
+ * Queues lines of output to be appended to the console.
+ * @param {Array.<string>} lines The lines, which are shown as text.
+ */
+var appendOutput = function(lines) {
+    if (!pendingOutput.length) {
+        window.requestAnimationFrame(flushOutput);
+    }
+    pendingOutput.push.apply(pendingOutput, lines);
+};
+
+/**
+ * Appends all queued lines of output to the console at once.
+ */
+var flushOutput = function() {
+    if (!pendingOutput.length) {
+        return;  // The console was reloaded since
+    }
+
+    var $consoleText = $("#console-text"),
+        consoleText = $consoleText[0],
+        text = pendingOutput.join("\n") + "\n";
+
+    // Follow new output only if we're already scrolled down
+    var following = Math.abs(consoleText.scrollTop +
+            $consoleText.height() - consoleText.scrollHeight) < 100;
+
+    consoleText.appendChild(document.createTextNode(text));
+    consoleLines += pendingOutput.length;
+    pendingOutput = [];
+
+    // Only trim while following, so as not to yank lines being read
+    if (following && consoleLines > MAX_CONSOLE_LINES + CONSOLE_TRIM_LINES) {
+        var lines = $consoleText.text().split("\n"),
+            numTrimmed = lines.length - 1 - MAX_CONSOLE_LINES;
+        $consoleText
+            .text(lines.slice(numTrimmed).join("\n"))
+            .data("first-line", $consoleText.data("first-line") + numTrimmed);
+        consoleLines = MAX_CONSOLE_LINES;
+    }
+
+    if (following) {
+        consoleText.scrollTop = consoleText.scrollHeight;
+    }
+};
+
 /**
  * Set up an SSE stream to get deploy output and status "pushed" from server.
  */
@@ -51,35 +253,38 @@ var setupStream = function() {
 
     // IE does not support Server-Sent Events, but there exist polyfills if for
     // some unfathomable reason we want to support IE (Bill Gates comes again?)
-    var source = new EventSource('/deploy/stream');
+    var source = new EventSource('/deploy/stream?target=' +
+            encodeURIComponent(TARGET));
 
+    // Each event holds one or more lines of output
     source.addEventListener('mr_deploy_output', function(event) {
-        var line = $("<div>").text(event.data).html(),
-            $consoleText = $("#console-text"),
-            oldScrollHeight = $consoleText[0].scrollHeight;
-
-        $consoleText.append(line + "\n");
+        appendOutput(event.data.split("\n"));
+    });
 
-        // Scroll to the bottom only if we're already scrolled down
-        var scrollBottom = $consoleText.scrollTop() + $consoleText.height();
-        if (Math.abs(scrollBottom - oldScrollHeight) < 100) {
-            $consoleText.scrollTop($consoleText[0].scrollHeight);
-        }
+    // The server skips output lines when we can't keep up with them
+    source.addEventListener('mr_deploy_dropped', function(event) {
+        appendOutput(["[... " + event.data + " lines skipped ...]"]);
     });
 
     source.addEventListener('mr_deploy_status', function(event) {
         setStatus(JSON.parse(event.data));
     });
 
+    // We missed more output while disconnected than the server can replay
+    source.addEventListener('mr_deploy_gap', function(event) {
+        reloadLog();
+    });
+
     source.addEventListener('error', function(event) {
         if (window.console) {
             console.log('Error in SSE stream:', event);
         }
 
-        // The browser will automatically attempt to reconnect on error, but if
-        // it's not successful after some time, just reload the page.
+        // The browser automatically reconnects and the server replays any
+        // output we missed, unless the server refused the stream outright
+        // (e.g. we need to log in again). Then just reload the page.
         window.setTimeout(function() {
-            if (source.readyState !== EventSource.OPEN) {
+            if (source.readyState === EventSource.CLOSED) {
                 window.location.reload();
             }
         }, RETRY_TIMEOUT_MS);
@@ -87,21 +292,91 @@ var setupStream = function() {
 
 };
 
+/**
+ * Replace the console contents with the latest lines of the deploy log.
+ */
+var reloadLog = function() {
+    $.ajax({
+        url: "/deploy/log",
+        data: {limit: LOG_PAGE_LINES, target: TARGET},
+        dataType: "text",
+        success: function(text, textStatus, xhr) {
+            var $consoleText = $("#console-text");
+            pendingOutput = [];
+            consoleLines = countLines(text);
+            $consoleText
+                .text(text)
+                .data("first-line", +xhr.getResponseHeader("X-Log-From"))
+                .scrollTop($consoleText[0].scrollHeight);
+        }
+    });
+};
+
+/**
+ * Fetch the page of deploy log lines preceding the ones already shown and
+ * prepend them to the console, keeping the current scroll position.
+ */
+var loadingOlderLog = false;
+var loadOlderLog = function() {
+    var $consoleText = $("#console-text"),
+        firstLine = $consoleText.data("first-line");
+
+    if (loadingOlderLog || !firstLine) {
+        return;
+    }
+    loadingOlderLog = true;
+
+    var from = Math.max(0, firstLine - LOG_PAGE_LINES);
+    $.ajax({
+        url: "/deploy/log",
+        data: {from: from, limit: firstLine - from, target: TARGET},
+        dataType: "text",
+        success: function(text, textStatus, xhr) {
+            var oldScrollHeight = $consoleText[0].scrollHeight;
+            consoleLines += countLines(text);
+            $consoleText
+                .prepend($("<div>").text(text).html())
+                .data("first-line", +xhr.getResponseHeader("X-Log-From"));
+            $consoleText.scrollTop($consoleText.scrollTop() +
+                    $consoleText[0].scrollHeight - oldScrollHeight);
+        },
+        complete: function() {
+            loadingOlderLog = false;
+        }
+    });
+};
+
 var init = function() {
     $("#buttons").on("click", ".btn", function(event) {
         $("#buttons .btn").toggleDisabled(true);
 
         var action = $(event.currentTarget).data("action");
-        $.post("/deploy/please/" + action);
+        $.post("/deploy/please/" + action + "?target=" +
+                encodeURIComponent(TARGET));
     });
 
+    consoleLines = countLines($("#console-text").text());
+
     // TODO(david): On resize as well
     // TODO(david): Preferably do this in CSS and not hardcode height
     $("#console-text")
         .css("height", $(window).height() - 340)
-        .scrollTop($("#console-text")[0].scrollHeight);
+        .scrollTop($("#console-text")[0].scrollHeight)
+        .on("scroll", function() {
+            if ($(this).scrollTop() === 0) {
+                loadOlderLog();
+            }
+        });
 
     pollStatus();
+    // Count down to the next check for changes
+    window.setInterval(function() {
+        setSchedule(lastScheduler);
+    }, 1000);
+    pollMetrics();
+    window.setInterval(pollMetrics, STATUS_POLL_INTERVAL_MS);
+    loadHistory();
+    window.setInterval(loadHistory, STATUS_POLL_INTERVAL_MS);
     setupStream();
 };
 
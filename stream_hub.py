@@ -0,0 +1,117 @@
+"""Fans out Mr Deploy's Redis Pub/Sub messages to many streaming clients
+within one server process, over a single Redis subscription.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import redis
+
+
+class ClientQueue(object):
+    """A bounded queue of (channel, data) messages for one streaming client.
+
+    When a slow client falls behind by more than max_size messages, the
+    oldest messages are dropped and the client is told how many it missed.
+    Messages on coalesced channels (e.g. status updates) only ever keep their
+    latest value, since intermediate values are stale by the time they're
+    read.
+    """
+
+    def __init__(self, max_size, coalesced_channels=()):
+        self.max_size = max_size
+        self.coalesced_channels = set(coalesced_channels)
+        self.messages = collections.deque()
+        self.latest = collections.OrderedDict()
+        self.num_dropped = 0
+        self.cond = threading.Condition()
+
+    def put(self, channel, data):
+        with self.cond:
+            if channel in self.coalesced_channels:
+                self.latest.pop(channel, None)
+                self.latest[channel] = data
+            else:
+                if len(self.messages) >= self.max_size:
+                    self.messages.popleft()
+                    self.num_dropped += 1
+                self.messages.append((channel, data))
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """Return the next (channel, data) message, blocking until one is
+        available or until timeout seconds pass, in which case return None.
+
+        Dropped messages are reported as a message on the 'dropped' channel
+        with the number of messages missed as data.
+        """
+        with self.cond:
+            if not self._has_message():
+                self.cond.wait(timeout)
+                if not self._has_message():
+                    return None
+
+            if self.latest:
+                return self.latest.popitem(last=False)
+            if self.num_dropped:
+                num_dropped, self.num_dropped = self.num_dropped, 0
+                return 'dropped', str(num_dropped)
+            return self.messages.popleft()
+
+    def _has_message(self):
+        return bool(self.latest or self.num_dropped or self.messages)
+
+
+class StreamHub(object):
+    """Holds one Redis subscription per process and copies every message to
+    each subscribed ClientQueue. The subscription is opened lazily on the
+    first subscribe(), so that it belongs to the worker process and not the
+    pre-fork parent.
+    """
+
+    # Seconds to wait before resubscribing after losing the Redis connection
+    RECONNECT_DELAY_SECS = 1
+
+    def __init__(self, red, channels, coalesced_channels=(),
+                 max_queue_size=1000):
+        self.red = red
+        self.channels = channels
+        self.coalesced_channels = coalesced_channels
+        self.max_queue_size = max_queue_size
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.listener = None
+
+    def subscribe(self):
+        client = ClientQueue(self.max_queue_size, self.coalesced_channels)
+        with self.lock:
+            self.clients.add(client)
+            if self.listener is None:
+                self.listener = threading.Thread(target=self._listen)
+                self.listener.daemon = True
+                self.listener.start()
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.red.pubsub()
+                pubsub.subscribe(self.channels)
+                for item in pubsub.listen():
+                    if item['type'] == 'message':
+                        self._publish(item['channel'], item['data'])
+            except redis.ConnectionError as e:
+                logging.error("Lost Redis subscription, retrying. [%s]" % e)
+                time.sleep(self.RECONNECT_DELAY_SECS)
+
+    def _publish(self, channel, data):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.put(channel, data)
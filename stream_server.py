@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""Serves the long-lived dashboard streams (/deploy/stream and
+/deploy/status) from a single gevent process, so that thousands of open
+streams cost a greenlet and a ClientQueue each rather than a gunicorn worker
+between a few of them. All streams share the process's one Redis
+subscription (see stream_hub.StreamHub).
+
+Everything else, like the authenticated control endpoints, is still served
+by the gunicorn workers; requests for other paths get a 404 here. Put it
+behind the same proxy as them, routing just the stream paths to it:
+
+    FLASK_CONFIG=flask_prod_config.py python stream_server.py \\
+        --bind unix:/tmp/mr_deploy_stream.sock
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import optparse
+import os
+import socket
+
+import gevent.pool
+from gevent import pywsgi
+
+import server
+
+STREAM_PATHS = ('/deploy/stream', '/deploy/status')
+
+
+def stream_app(environ, start_response):
+    if environ.get('PATH_INFO') not in STREAM_PATHS:
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['Not a stream; ask the app server.\n']
+    return server.app(environ, start_response)
+
+
+def get_listener(bind):
+    """Return a listening socket for "host:port" or "unix:path"."""
+    if bind.startswith('unix:'):
+        path = bind[len('unix:'):]
+        if os.path.exists(path):
+            os.remove(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        os.chmod(path, 0777)
+    else:
+        host, port = bind.rsplit(':', 1)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, int(port)))
+    listener.listen(1024)
+    return listener
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--bind', default='localhost:5002',
+        help="host:port or unix:path to listen on.")
+    parser.add_option('--max_connections', type='int', default=10000,
+        help="Most streams to serve at once; more connections wait.")
+    options, _ = parser.parse_args()
+
+    print "Serving streams on %s" % options.bind
+    pywsgi.WSGIServer(get_listener(options.bind), stream_app,
+                      spawn=gevent.pool.Pool(options.max_connections),
+                      log=None).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
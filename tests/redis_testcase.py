@@ -0,0 +1,27 @@
+"""A base class for tests that need Redis."""
+
+import unittest
+
+import redis
+
+# Tests have this database of the local Redis to themselves, emptied before
+# each test
+TEST_DB = 15
+
+
+class RedisTestCase(unittest.TestCase):
+    """Gives each test an empty Redis database as self.red, or skips it if
+    there's no Redis running.
+    """
+
+    def setUp(self):
+        self.red = redis.StrictRedis(db=TEST_DB)
+        try:
+            self.red.flushdb()
+        except redis.ConnectionError:
+            self.skipTest("Redis isn't running")
+
+    def patch(self, obj, name, value):
+        """Set an attribute for the rest of the test."""
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
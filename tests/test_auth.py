@@ -0,0 +1,158 @@
+import hashlib
+import multiprocessing
+import threading
+import time
+
+import redis
+
+import auth
+from redis_testcase import RedisTestCase, TEST_DB
+
+# Seconds the stand-in for Google takes to verify a token
+VERIFY_SECS = 0.5
+
+CALLS_KEY = 'test_auth_calls:%s'  # % token
+
+
+def fake_google(access_token):
+    """Like auth.verify_with_google(), counting its calls in Redis so that
+    those of other processes count too. Tokens starting "valid" belong to
+    <token>@example.com, those starting "down" can't be verified and the
+    rest are invalid.
+    """
+    auth.red.incr(CALLS_KEY % access_token)
+    time.sleep(VERIFY_SECS)
+    if access_token.startswith('valid'):
+        return '%s@example.com' % access_token
+    elif access_token.startswith('down'):
+        return None
+    return ''
+
+
+def verify_concurrently(access_token, num_threads):
+    """Return the results of verifying a token from num_threads threads at
+    once.
+    """
+    results = [None] * num_threads
+
+    def verify(i):
+        results[i] = auth._get_verified_user(access_token)
+
+    threads = [threading.Thread(target=verify, args=(i,))
+               for i in xrange(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def verify_in_process(access_token, num_threads, results):
+    # redis-py's connection pool resets itself on first use after a fork,
+    # which isn't safe to race from several threads
+    auth.red = redis.StrictRedis(db=TEST_DB)
+    results.extend(verify_concurrently(access_token, num_threads))
+
+
+class TokenVerificationTest(RedisTestCase):
+    def setUp(self):
+        super(TokenVerificationTest, self).setUp()
+        self.patch(auth, 'red', self.red)
+        auth.set_verifier(fake_google)
+        self.addCleanup(auth.set_verifier, auth.verify_with_google)
+        auth._local_cache.clear()
+        self.addCleanup(auth._local_cache.clear)
+
+    def calls(self, access_token):
+        return int(self.red.get(CALLS_KEY % access_token) or 0)
+
+    def lock_key(self, access_token):
+        return auth._LOCK_KEY % hashlib.sha1(access_token).hexdigest()
+
+    def lock_elsewhere(self, access_token, ms):
+        """Lock a token as if another process were verifying it."""
+        self.red.execute_command('PSETEX', self.lock_key(access_token), ms,
+                                 'other')
+
+    def test_concurrent_requests_verify_once(self):
+        results = verify_concurrently('valid', 20)
+        self.assertEqual(['valid@example.com'] * 20, results)
+        self.assertEqual(1, self.calls('valid'))
+
+    def test_verified_token_is_cached(self):
+        verify_concurrently('valid', 5)
+        start = time.time()
+        results = verify_concurrently('valid', 5)
+        self.assertEqual(['valid@example.com'] * 5, results)
+        self.assertEqual(1, self.calls('valid'))
+        self.assertLess(time.time() - start, VERIFY_SECS)
+
+    def test_verified_token_is_shared_through_redis(self):
+        verify_concurrently('valid', 1)
+        auth._local_cache.clear()
+        self.assertEqual('valid@example.com',
+                         auth._get_verified_user('valid'))
+        self.assertEqual(1, self.calls('valid'))
+
+    def test_rejected_token_is_cached(self):
+        self.assertEqual([None] * 10, verify_concurrently('invalid', 10))
+        self.assertEqual([None] * 10, verify_concurrently('invalid', 10))
+        self.assertEqual(1, self.calls('invalid'))
+
+    def test_unverifiable_token_isnt_cached(self):
+        self.assertEqual([None] * 5, verify_concurrently('down', 5))
+        self.assertEqual([None] * 5, verify_concurrently('down', 5))
+        self.assertEqual(2, self.calls('down'))
+
+    def test_processes_verify_once(self):
+        # Forked processes each with their own local cache, sharing Redis
+        results = multiprocessing.Manager().list()
+        processes = [multiprocessing.Process(target=verify_in_process,
+                                             args=('valid', 5, results))
+                     for _ in xrange(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(['valid@example.com'] * 20, list(results))
+        self.assertEqual(1, self.calls('valid'))
+
+    def test_waits_for_another_process_verifying(self):
+        # Longer than VERIFY_TIMEOUT_SECS used to be
+        self.patch(auth, 'VERIFY_TIMEOUT_SECS', 0.2)
+        token_hash = hashlib.sha1('valid').hexdigest()
+        self.lock_elsewhere('valid', 5000)
+
+        def finish():
+            time.sleep(1)
+            self.red.setex(auth._TOKEN_KEY % token_hash, 60,
+                           'other@example.com')
+            self.red.delete(self.lock_key('valid'))
+
+        thread = threading.Thread(target=finish)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.assertEqual(['other@example.com'] * 3,
+                         verify_concurrently('valid', 3))
+        self.assertEqual(0, self.calls('valid'))
+
+    def test_verifies_once_another_processes_lock_expires(self):
+        self.lock_elsewhere('valid', 300)
+        self.assertEqual(['valid@example.com'] * 3,
+                         verify_concurrently('valid', 3))
+        self.assertEqual(1, self.calls('valid'))
+
+    def test_keeps_a_lock_taken_over_after_expiring(self):
+        def slow_google(access_token):
+            # Our lock expires, and another process takes it
+            self.red.set(self.lock_key(access_token), 'other')
+            return fake_google(access_token)
+
+        auth.set_verifier(slow_google)
+        self.assertEqual('valid@example.com',
+                         auth._get_verified_user('valid'))
+        self.assertEqual('other', self.red.get(self.lock_key('valid')))
+
+    def test_releases_its_lock(self):
+        auth._get_verified_user('valid')
+        self.assertIsNone(self.red.get(self.lock_key('valid')))
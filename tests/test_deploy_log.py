@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import deploy_log
+import log_search
+
+NUM_LINES = 100
+
+
+def expected(first_line, end_line):
+    return ''.join('line %d\n' % n for n in xrange(first_line, end_line))
+
+
+def wait_for_compression(log_dir):
+    """Wait for every closed segment of the log to be compressed, and so
+    sealed.
+    """
+    deadline = time.time() + 5
+    while not all(segment['compressed'] for segment
+                  in deploy_log.read_manifest(log_dir)[:-1]):
+        if time.time() > deadline:
+            raise AssertionError("Segments of %s weren't compressed"
+                                 % log_dir)
+        time.sleep(0.05)
+
+
+class DeployLogTest(unittest.TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_dir)
+
+        # Segments of about 10 lines, all but the last compressed
+        writer = deploy_log.DeployLogWriter(self.log_dir, segment_bytes=75)
+        self.addCleanup(writer.close)
+        for n in xrange(NUM_LINES):
+            writer.write(['line %d' % n])
+        writer.flush()
+        wait_for_compression(self.log_dir)
+
+        self.log = deploy_log.DeployLog(self.log_dir)
+        self.assertGreater(len(self.log.segments()), 5)
+
+    def test_read_lines_across_segments(self):
+        self.assertEqual((5, 25, expected(5, 25)),
+                         self.log.read_lines(5, 20))
+
+    def test_read_lines_clamps_to_the_log(self):
+        self.assertEqual((95, 100, expected(95, 100)),
+                         self.log.read_lines(95, 20))
+        self.assertEqual((100, 100, ''), self.log.read_lines(120, 20))
+
+    def test_read_ranges(self):
+        ranges = [(50, 3), (12, 5), (14, 10), (98, 5), (0, 0), (51, 1)]
+        self.assertEqual([(50, 53, expected(50, 53)),
+                          (12, 17, expected(12, 17)),
+                          (14, 24, expected(14, 24)),
+                          (98, 100, expected(98, 100)),
+                          (0, 0, ''),
+                          (51, 52, expected(51, 52))],
+                         self.log.read_ranges(ranges))
+
+    def test_read_ranges_opens_each_segment_once(self):
+        opened = []
+        open_segment = self.log._open_segment
+
+        def counting_open_segment(segment):
+            opened.append(segment['name'])
+            return open_segment(segment)
+
+        self.log._open_segment = counting_open_segment
+        self.log.read_ranges([(n, 3) for n in xrange(NUM_LINES - 1, 0, -4)])
+        self.assertEqual(sorted(set(opened)), sorted(opened))
+
+
+class DeployLogWriterTest(unittest.TestCase):
+    def setUp(self):
+        # The legacy log is only looked for relative to the working directory
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.work_dir)
+
+    def test_close_stops_flushing(self):
+        writer = deploy_log.DeployLogWriter(segment_bytes=75)
+        writer.write(['line 0'])
+        writer.close()
+        self.assertFalse(writer.flusher.is_alive())
+
+    def test_adopts_legacy_log(self):
+        os.mkdir('log')
+        with open(deploy_log.LEGACY_LOG_PATH, 'wb') as f:
+            f.write(expected(0, 10))
+
+        writer = deploy_log.DeployLogWriter()
+        self.addCleanup(writer.close)
+        writer.write(['line 10'])
+        writer.flush()
+        self.assertFalse(os.path.exists(deploy_log.LEGACY_LOG_PATH))
+
+        log = deploy_log.DeployLog()
+        self.assertEqual((0, 11, expected(0, 11)), log.read_lines(0, 20))
+
+        # Searchable once sealed in the background
+        wait_for_compression(deploy_log.LOG_DIR)
+        self.assertEqual([10, 9], log_search.search(log, 'line', 2))
@@ -0,0 +1,93 @@
+import json
+import time
+import urllib2
+
+import notifications
+from redis_testcase import RedisTestCase
+
+
+def http_error(code):
+    return urllib2.HTTPError(notifications.HIPCHAT_API_URL, code,
+                             "HTTP %d" % code, {}, None)
+
+
+class FakeHipChat(object):
+    """Stands in for notifications.send_to_hipchat(), raising the given
+    errors on the first calls.
+    """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.attempts = 0
+        self.sent = []
+
+    def __call__(self, room_id, color, message):
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((room_id, color, message))
+
+
+class NotificationWorkerTest(RedisTestCase):
+    def setUp(self):
+        super(NotificationWorkerTest, self).setUp()
+        self.patch(notifications, 'RETRY_MIN_SECS', 0.01)
+        self.patch(notifications, 'RETRY_MAX_SECS', 0.02)
+        self.patch(notifications, 'COALESCE_SECS', 1)
+
+    def process(self, hipchat):
+        notifications.NotificationWorker(self.red, hipchat).process_batch()
+        self.assertEqual(0, self.red.llen(notifications.PROCESSING_KEY))
+
+    def test_retries_server_errors(self):
+        hipchat = FakeHipChat(http_error(503), http_error(500))
+        notifications.enqueue(self.red, 1, 'green', "Deployed")
+        self.process(hipchat)
+        self.assertEqual(3, hipchat.attempts)
+        self.assertEqual([(1, 'green', "Deployed")], hipchat.sent)
+
+    def test_retries_while_unreachable(self):
+        hipchat = FakeHipChat(urllib2.URLError("Connection refused"))
+        notifications.enqueue(self.red, 1, 'green', "Deployed")
+        self.process(hipchat)
+        self.assertEqual([(1, 'green', "Deployed")], hipchat.sent)
+
+    def test_gives_up_after_max_retry_secs(self):
+        self.patch(notifications, 'MAX_RETRY_SECS', 0.2)
+        hipchat = FakeHipChat(*[http_error(503)] * 100)
+        for room_id in (1, 2):
+            notifications.enqueue(self.red, room_id, 'red', "Failed")
+        start = time.time()
+        self.process(hipchat)
+        # Less the wait for the batch to fill
+        secs = time.time() - start - notifications.COALESCE_SECS
+        self.assertLess(secs, 0.5)
+        self.assertEqual([], hipchat.sent)
+        self.assertLess(hipchat.attempts, 100)
+
+    def test_gives_up_on_client_errors(self):
+        hipchat = FakeHipChat(http_error(400))
+        notifications.enqueue(self.red, 1, 'red', "Rejected")
+        self.process(hipchat)
+        self.assertEqual(1, hipchat.attempts)
+        self.assertEqual([], hipchat.sent)
+
+    def test_coalesces_notifications_to_a_room(self):
+        hipchat = FakeHipChat()
+        for room_id, color in [(2, 'gray'), (1, 'green'), (2, 'red'),
+                               (2, 'green')]:
+            notifications.enqueue(self.red, room_id, color,
+                                  "%s for %d" % (color, room_id))
+        self.process(hipchat)
+        self.assertEqual([(2, 'red', "gray for 2\nred for 2\ngreen for 2"),
+                          (1, 'green', "green for 1")], hipchat.sent)
+
+    def test_resends_notifications_left_mid_send(self):
+        self.red.lpush(notifications.PROCESSING_KEY, json.dumps({
+            'room_id': 1, 'color': 'gray', 'message': "Left behind",
+            'queued_at': 0}))
+        hipchat = FakeHipChat()
+        worker = notifications.NotificationWorker(self.red, hipchat)
+        worker._requeue_unsent()
+        self.process(hipchat)
+        self.assertEqual([(1, 'gray', "Left behind")], hipchat.sent)
@@ -0,0 +1,68 @@
+import itertools
+import os
+import threading
+import time
+
+import mr_deploy
+from redis_testcase import RedisTestCase
+
+# Slack allowed in each timing, for threads and Redis round trips
+SLACK_SECS = 0.3
+
+_channel_numbers = itertools.count()
+
+
+class PushTriggerTest(RedisTestCase):
+    def setUp(self):
+        super(PushTriggerTest, self).setUp()
+        self.patch(mr_deploy, 'DEBOUNCE_SECS', 0.5)
+        self.patch(mr_deploy, 'MAX_DEBOUNCE_SECS', 2)
+        self.patch(mr_deploy, 'red', self.red)
+
+        # A channel per test, as listeners can't be stopped
+        self.channel = 'test_push_trigger.%d.%d' % (os.getpid(),
+                                                    next(_channel_numbers))
+        self.trigger = mr_deploy.PushTrigger(self.channel)
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            self.red.publish(self.channel, 'ping')
+            if self.trigger.pushed.wait(0.1):
+                break
+        self.trigger.pushed.clear()
+
+    def push_every(self, interval, count):
+        def push():
+            for i in xrange(count):
+                if i:
+                    time.sleep(interval)
+                self.red.publish(self.channel, 'push')
+
+        thread = threading.Thread(target=push)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def timed_wait(self, timeout):
+        start = time.time()
+        pushed = self.trigger.wait(timeout)
+        return pushed, time.time() - start
+
+    def test_times_out_without_a_push(self):
+        pushed, secs = self.timed_wait(0.5)
+        self.assertFalse(pushed)
+        self.assertAlmostEqual(secs, 0.5, delta=SLACK_SECS)
+
+    def test_wakes_once_debounce_secs_after_a_burst(self):
+        # Five pushes over 0.8s
+        self.push_every(0.2, 5)
+        pushed, secs = self.timed_wait(5)
+        self.assertTrue(pushed)
+        self.assertAlmostEqual(secs, 1.3, delta=SLACK_SECS)
+
+        pushed, _ = self.timed_wait(0.5)
+        self.assertFalse(pushed)
+
+    def test_steady_pushes_wake_at_max_debounce_secs(self):
+        self.push_every(0.2, 20)
+        pushed, secs = self.timed_wait(5)
+        self.assertTrue(pushed)
+        self.assertAlmostEqual(secs, 2, delta=SLACK_SECS)
@@ -0,0 +1,49 @@
+import itertools
+import os
+
+os.environ.setdefault('FLASK_CONFIG', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'flask_debug_config.py'))
+
+import deploy_targets
+import output_ring
+import server
+from redis_testcase import RedisTestCase
+
+
+class IdleClient(object):
+    """A stream hub client that never gets a message."""
+
+    def get(self, timeout=None):
+        return None
+
+
+class ReconnectTest(RedisTestCase):
+    def setUp(self):
+        super(ReconnectTest, self).setUp()
+        self.patch(server, 'red', self.red)
+        self.patch(output_ring, 'RING_SIZE', 5)
+        self.target = deploy_targets.DeployTarget(
+            deploy_targets.DEFAULT_TARGET)
+        output_ring.append(self.red, self.target.key('mr_deploy_output'),
+                           ['line %d' % i for i in xrange(1, 21)])
+
+    def first_events(self, last_event_id, count):
+        return list(itertools.islice(
+            server.client_events(IdleClient(), last_event_id, self.target),
+            count))
+
+    def test_replays_missed_lines(self):
+        self.assertEqual(
+            ['id: 20\nevent: mr_deploy_output\n'
+             'data: line 18\ndata: line 19\ndata: line 20\n\n'],
+            self.first_events(17, 1))
+
+    def test_reports_gap_past_the_ring(self):
+        self.assertEqual(
+            ['event: mr_deploy_gap\ndata: 3\n\n',
+             'id: 20\nevent: mr_deploy_output\n'
+             'data: line 16\ndata: line 17\ndata: line 18\ndata: line 19\n'
+             'data: line 20\n\n',
+             ': heartbeat\n\n'],
+            self.first_events(3, 3))